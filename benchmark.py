@@ -0,0 +1,284 @@
+import gc
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import sqlite3
+import subprocess
+import tracemalloc
+from collections import Counter, defaultdict
+from datetime import date, timedelta
+
+import bot
+from bot import Cursore, SqliteStorage
+
+# Benchmark delle fasi di /statistiche e delle scritture su chat sintetiche.
+# Gira su SQLite (in memoria o su file), senza Telegram né PostgreSQL.
+#   python benchmark.py --giocatori 20 200 --partite 1000 10000 --output risultati.json
+
+CHAT_ID = 1
+
+def genera_chat(storage, n_giocatori, n_partite, seme):
+    rnd = random.Random(seme)
+    nomi = [f"Giocatore{i:03d}" for i in range(n_giocatori)]
+    storage.aggiungi_giocatori(nomi, CHAT_ID)
+    with storage.transazione() as c:
+        c.execute('SELECT nome, id FROM giocatori WHERE chat_id = %s', (CHAT_ID,))
+        ids = dict(c.fetchall())
+    inizio = date(2015, 1, 1)
+    partite = []
+    prestazioni = []
+    for partita_id in range(1, n_partite + 1):
+        campo = rnd.sample(nomi, 10)
+        squadra_a, squadra_b = campo[:5], campo[5:]
+        gol_a, gol_b = rnd.randint(0, 10), rnd.randint(0, 10)
+        risultato = f"{gol_a}-{gol_b}"
+        esiti = bot.esiti_squadre(risultato)
+        partite.append((partita_id, inizio + timedelta(days=partita_id // 3), ','.join(squadra_a), ','.join(squadra_b), risultato, CHAT_ID))
+        for squadra, nomi_squadra, gol_squadra in (('A', squadra_a, gol_a), ('B', squadra_b, gol_b)):
+            gol = dict.fromkeys(nomi_squadra, 0)
+            assist = dict.fromkeys(nomi_squadra, 0)
+            for _ in range(gol_squadra):
+                marcatore = rnd.choice(nomi_squadra)
+                gol[marcatore] += 1
+                if rnd.random() < 0.6:
+                    assist[rnd.choice([n for n in nomi_squadra if n != marcatore])] += 1
+            for nome in nomi_squadra:
+                prestazioni.append((partita_id, ids[nome], squadra, gol[nome], assist[nome]) + esiti[squadra] + (CHAT_ID,))
+    # Inserimento diretto a blocchi: salva_partita viene misurata a parte
+    with storage.transazione() as c:
+        storage.esegui_valori(c, 'INSERT INTO partite (id, data, squadra_a, squadra_b, risultato, chat_id) VALUES %s', partite)
+        storage._inserisci_prestazioni(c, prestazioni)
+    storage.ricostruisci_aggregati(CHAT_ID)
+    storage.ricostruisci_rating(CHAT_ID)
+    return nomi, partite[-1][1]
+
+def leggi_prestazioni(storage):
+    # Le righe come le leggeva /statistiche prima del motore a colonne
+    with storage.transazione() as c:
+        c.execute('SELECT partita_id, giocatore_id, squadra, gol, assist, vittoria, pareggio, sconfitta FROM prestazioni WHERE chat_id = %s', (CHAT_ID,))
+        return c.fetchall()
+
+def coppie_ciclo_annidato(prestazioni, giocatori=None):
+    # Conteggio compagni/avversari della versione originale: per ogni partita di ogni giocatore
+    # riscorre tutte le prestazioni della chat. Restituisce i conteggi completi per id, non solo
+    # i primi 3, perché l'ordine a parità di partite è cambiato (ora è per nome).
+    giocatore_partite = defaultdict(list)
+    for pr in prestazioni:
+        giocatore_partite[pr[1]].append(pr)
+    compagni_dict, avversari_dict = {}, {}
+    for gid in giocatore_partite if giocatori is None else giocatori:
+        compagni = Counter()
+        avversari = Counter()
+        for pr in giocatore_partite[gid]:
+            partita_id = pr[0]
+            squadra_gioc = pr[2]
+            prs = [p for p in prestazioni if p[0] == partita_id]
+            for p in prs:
+                if p[1] == gid:
+                    continue
+                if p[2] == squadra_gioc:
+                    compagni[p[1]] += 1
+                else:
+                    avversari[p[1]] += 1
+        compagni_dict[gid] = dict(compagni)
+        avversari_dict[gid] = dict(avversari)
+    return compagni_dict, avversari_dict
+
+def misura(func, ripetizioni=1):
+    # Primo passaggio senza tracemalloc per il tempo, secondo passaggio per il picco di memoria
+    gc.collect()
+    query = Cursore.query_eseguite
+    inizio = time.perf_counter()
+    for _ in range(ripetizioni):
+        risultato = func()
+    secondi = time.perf_counter() - inizio
+    query = Cursore.query_eseguite - query
+    gc.collect()
+    tracemalloc.start()
+    func()
+    picco = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return risultato, {
+        'secondi': round(secondi / ripetizioni, 6),
+        'query': query / ripetizioni,
+        'picco_kb': round(picco / 1024, 1),
+        'ripetizioni': ripetizioni,
+    }
+
+def scenario(n_giocatori, n_partite, args):
+    storage = SqliteStorage(args.db)
+    storage.applica_migrazioni()
+    bot.db = storage
+    rnd = random.Random(args.seme)
+    fasi = {}
+    try:
+        inizio = time.perf_counter()
+        nomi, ultima_data = genera_chat(storage, n_giocatori, n_partite, args.seme)
+        generazione = time.perf_counter() - inizio
+
+        # --- Lettura e calcolo ---
+        # Caricamento dello storico colonnare (scansione a blocchi), poi report a storico già in cache
+        storico, fasi['caricamento_storico'] = misura(lambda: storage.carica_storico(CHAT_ID, blocco=args.blocco))
+        memoria_storico = storico.memoria()
+        ultimo_anno = (ultima_data - timedelta(days=365), None)
+        _, fasi['ricostruzione_aggregati'] = misura(lambda: storage.ricostruisci_aggregati(CHAT_ID))
+        bot.storico_cache.invalida(CHAT_ID)
+        # A cache fredda un report di periodo legge solo le partite del periodo e non riempie la cache
+        _, fasi['prepara_statistiche_periodo_freddo'] = misura(lambda: bot.prepara_statistiche(CHAT_ID, ultimo_anno))
+        _, fasi['prepara_statistiche_freddo'] = misura(lambda: bot.prepara_statistiche(CHAT_ID))
+        report, fasi['prepara_statistiche'] = misura(lambda: bot.prepara_statistiche(CHAT_ID))
+        _, fasi['prepara_statistiche_periodo'] = misura(lambda: bot.prepara_statistiche(CHAT_ID, ultimo_anno))
+
+        # --- Aggregazioni sullo storico colonnare ---
+        # A freddo comprendono la lettura dello storico dal database, a caldo lavorano sullo
+        # storico già caricato, su tutte le partite e sull'ultimo anno
+        def a_freddo(aggregazione):
+            def fase():
+                letto = storage.carica_storico(CHAT_ID, blocco=args.blocco)
+                return getattr(letto, aggregazione)(0, len(letto))
+            return fase
+        m0, m1 = storico.intervallo(ultimo_anno)
+        _, fasi['totali_freddo'] = misura(a_freddo('totali'))
+        _, fasi['totali'] = misura(lambda: storico.totali(0, len(storico)), args.ripetizioni)
+        _, fasi['totali_periodo'] = misura(lambda: storico.totali(m0, m1), args.ripetizioni)
+        _, fasi['compagni_avversari_freddo'] = misura(a_freddo('coppie'))
+
+        # --- Compagni e avversari: ciclo annidato originale contro bitset sullo storico ---
+        # Oltre --vecchio-max-partite il ciclo annidato (quadratico nelle prestazioni) gira solo su
+        # --vecchio-giocatori giocatori e il tempo totale è stimato in proporzione alle loro presenze
+        _, fasi['compagni_avversari'] = misura(lambda: storico.coppie(0, len(storico)), args.ripetizioni)
+        _, fasi['compagni_avversari_periodo'] = misura(lambda: storico.coppie(m0, m1), args.ripetizioni)
+        prestazioni = leggi_prestazioni(storage)
+        presenze = Counter(pr[1] for pr in prestazioni)
+        campione = None if n_partite <= args.vecchio_max_partite else sorted(presenze)[:args.vecchio_giocatori]
+        _, fase = misura(lambda: coppie_ciclo_annidato(prestazioni, campione))
+        if campione is not None:
+            fase['giocatori_misurati'] = len(campione)
+            fase['secondi'] = round(fase['secondi'] * len(prestazioni) / sum(presenze[g] for g in campione), 6)
+            fase['stimato'] = True
+        fasi['compagni_avversari_ciclo_annidato'] = fase
+        del prestazioni
+
+        # --- PDF (nel processo corrente, per misurarne anche la memoria) ---
+        # Oltre --pdf-max-partite il PDF delle partite richiede minuti, soprattutto sotto tracemalloc
+        if not args.salta_pdf and n_partite <= args.pdf_max_partite:
+            _, fasi['pdf_statistiche'] = misura(lambda: bot.genera_pdf_multi(report['statistiche'], report['cannonieri'], report['assistman'], report['presenze'], report['elo'], report['forma']))
+            _, fasi['pdf_partite'] = misura(lambda: bot.genera_pdf_partite(report['partite']))
+
+        # --- Scritture ---
+        def nuova_partita():
+            campo = rnd.sample(nomi, 10)
+            return {
+                'data': ultima_data,
+                'squadra_a': campo[:5],
+                'squadra_b': campo[5:],
+                'risultato': f"{rnd.randint(0, 8)}-{rnd.randint(0, 8)}",
+                'gol': f"{campo[0]}:2, {campo[6]}:1",
+                'assist': f"{campo[1]}:1",
+            }
+        nuove = []
+        squadre_b = {}
+        def salva():
+            dati = nuova_partita()
+            partita_id = storage.salva_partita(dati, CHAT_ID)
+            nuove.append(partita_id)
+            squadre_b[partita_id] = dati['squadra_b']
+        _, fasi['salva_partita'] = misura(salva, args.ripetizioni)
+
+        def modifica(campo, valore):
+            return lambda: storage.modifica_partita(rnd.choice(nuove), campo, valore(), CHAT_ID)
+        _, fasi['modifica_gol'] = misura(modifica('gol', lambda: f"{rnd.choice(nomi)}:{rnd.randint(1, 4)}"), args.ripetizioni)
+        _, fasi['modifica_risultato'] = misura(modifica('risultato', lambda: f"{rnd.randint(0, 8)}-{rnd.randint(0, 8)}"), args.ripetizioni)
+
+        def modifica_squadra():
+            partita_id = rnd.choice(nuove)
+            squadra_a = rnd.sample([n for n in nomi if n not in squadre_b[partita_id]], 5)
+            storage.modifica_partita(partita_id, 'squadra_a', ', '.join(squadra_a), CHAT_ID)
+        _, fasi['modifica_squadra'] = misura(modifica_squadra, args.ripetizioni)
+
+        # Ogni ripetizione cancella una delle partite appena inserite
+        _, fasi['elimina_partita'] = misura(lambda: storage.elimina_partita(nuove.pop(), CHAT_ID), min(args.ripetizioni, len(nuove) - 1))
+
+        _, incoerenti = storage.ricostruisci_aggregati(CHAT_ID)
+        if incoerenti:
+            print(f"[ATTENZIONE] {incoerenti} righe aggregate incoerenti dopo le scritture", file=sys.stderr)
+        # Lo storico aggiornato in place dalle scritture deve coincidere con uno riletto da zero
+        aggiornato = storage.storico(CHAT_ID)
+        riletto = storage.carica_storico(CHAT_ID)
+        if any(getattr(aggiornato, c) != getattr(riletto, c) for c in bot.StoricoChat.COLONNE_PARTITE + ('inizio',)) \
+                or aggiornato.totali(0, len(aggiornato)) != riletto.totali(0, len(riletto)) \
+                or forme_confrontabili(aggiornato) != forme_confrontabili(riletto):
+            print("[ATTENZIONE] storico in memoria diverso da quello nel database dopo le scritture", file=sys.stderr)
+    finally:
+        storage.chiudi()
+        bot.db = None
+    return {
+        'giocatori': n_giocatori,
+        'partite': n_partite,
+        'prestazioni': n_partite * 10,
+        'generazione_secondi': round(generazione, 3),
+        'storico_kb': round(memoria_storico / 1024, 1),
+        'fasi': fasi,
+    }
+
+def forme_confrontabili(storico):
+    with storico.lock:
+        return {gid: (list(f.ultime), f.serie_vittorie, f.serie_imbattuto) for gid, f in storico.forme().items()}
+
+def commit_corrente():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark di statistiche, PDF e scritture su chat sintetiche")
+    parser.add_argument('--giocatori', type=int, nargs='+', default=[20, 200], help="giocatori per chat (10-200)")
+    parser.add_argument('--partite', type=int, nargs='+', default=[100, 1000, 10000], help="partite per chat (10-50000)")
+    parser.add_argument('--ripetizioni', type=int, default=20, help="ripetizioni per ogni scrittura")
+    parser.add_argument('--seme', type=int, default=42)
+    parser.add_argument('--db', default=':memory:', help="file SQLite da usare (predefinito: in memoria)")
+    parser.add_argument('--salta-pdf', action='store_true', help="non misurare il rendering dei PDF")
+    parser.add_argument('--pdf-max-partite', type=int, default=1000, help="misura i PDF solo negli scenari fino a questo numero di partite")
+    parser.add_argument('--blocco', type=int, default=bot.STATISTICHE_BLOCCO, help="righe lette per volta dal cursore delle statistiche")
+    parser.add_argument('--vecchio-max-partite', type=int, default=1000, help="misura per intero il conteggio compagni/avversari originale solo fino a questo numero di partite")
+    parser.add_argument('--vecchio-giocatori', type=int, default=5, help="giocatori su cui misurare il conteggio originale oltre --vecchio-max-partite")
+    parser.add_argument('--output', help="file JSON in cui salvare i risultati")
+    args = parser.parse_args()
+    for n in args.giocatori:
+        if not 10 <= n <= 200:
+            parser.error("--giocatori deve essere tra 10 e 200")
+    for n in args.partite:
+        if not 10 <= n <= 50000:
+            parser.error("--partite deve essere tra 10 e 50000")
+    if args.db != ':memory:' and (len(args.giocatori) > 1 or len(args.partite) > 1):
+        parser.error("con --db su file usa un solo scenario alla volta")
+
+    scenari = []
+    for n_giocatori in args.giocatori:
+        for n_partite in args.partite:
+            risultato = scenario(n_giocatori, n_partite, args)
+            scenari.append(risultato)
+            print(f"\n{n_giocatori} giocatori, {n_partite} partite ({risultato['prestazioni']} prestazioni, storico {risultato['storico_kb']} KB)")
+            print(f"  {'fase':<34}{'ms':>12}{'query':>8}{'picco KB':>12}")
+            for nome, fase in risultato['fasi'].items():
+                stima = f"  (stima da {fase['giocatori_misurati']} giocatori)" if fase.get('stimato') else ""
+                print(f"  {nome:<34}{fase['secondi'] * 1000:>12.2f}{fase['query']:>8g}{fase['picco_kb']:>12.1f}{stima}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': commit_corrente(),
+                'eseguito_il': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'seme': args.seme,
+                'scenari': scenari,
+            }, f, indent=2)
+        print(f"\nRisultati salvati in {args.output}")
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,28 @@
 import os
+import io
+import re
+import sys
+import csv
+import json
+import math
+import time
+import argparse
+import asyncio
+import multiprocessing
+import threading
+import sqlite3
+import tempfile
 import psycopg2
-from datetime import datetime
-from collections import Counter, defaultdict
+import psycopg2.extras
+import psycopg2.pool
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial, wraps, lru_cache
+from itertools import combinations, count
+from bisect import bisect_left, bisect_right
+from array import array
+from datetime import date, datetime
+from collections import Counter, OrderedDict, defaultdict, deque
 from telegram import (
     Update,
     InputFile,
@@ -29,47 +50,1854 @@ SQUADRE, DATA, RISULTATO, GOL, ASSIST = range(5)
 MODIFICA_PARTITA_SELEZIONE, MODIFICA_CAMPO, MODIFICA_VALORE = range(5,8)
 ELIMINA_PARTITA_SELEZIONE = 8
 AGGIUNGI_GIOCATORE = 9
+IMPORTA = 10
 
 DATABASE_URL = os.environ.get("DATABASE_URL")
+# "postgres" (predefinito) oppure "sqlite" per girare in locale senza un server PostgreSQL
+STORAGE = os.environ.get("STORAGE", "postgres")
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "calcetto.sqlite3")
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+
+# Executor dedicato alle query: dimensionato come il pool, così nessun thread resta in attesa di una connessione
+db_executor = ThreadPoolExecutor(max_workers=DB_POOL_MAX, thread_name_prefix="db")
+
+# Metriche: endpoint Prometheus locale (0 = disattivato), soglia del log delle query lente, utenti ammessi a /metrics e /ricalcola
+METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "200"))
+ADMIN_IDS = {int(x) for x in os.environ.get("ADMIN_IDS", "").split(",") if x.strip()}
+
+# Modalità webhook (se WEBHOOK_URL è impostato, altrimenti polling) e update gestiti in parallelo
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")
+WEBHOOK_LISTEN = os.environ.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", "8443")))
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+CONCURRENT_UPDATES = int(os.environ.get("CONCURRENT_UPDATES", "8"))
+PARTITE_PER_PAGINA = int(os.environ.get("PARTITE_PER_PAGINA", "10"))
+BILANCIA_PROPOSTE = int(os.environ.get("BILANCIA_PROPOSTE", "3"))
+ELO_INIZIALE = float(os.environ.get("ELO_INIZIALE", "1500"))
+ELO_K = float(os.environ.get("ELO_K", "32"))
+# Importazione: partite scritte per blocco e dimensione massima del file inviato in chat
+IMPORT_BLOCCO = int(os.environ.get("IMPORT_BLOCCO", "500"))
+IMPORT_MAX_MB = float(os.environ.get("IMPORT_MAX_MB", "20"))
+# Righe lette per volta dal cursore che alimenta /statistiche
+STATISTICHE_BLOCCO = int(os.environ.get("STATISTICHE_BLOCCO", "2000"))
+# Processi che generano i PDF dei report
+PDF_WORKERS = int(os.environ.get("PDF_WORKERS", "2"))
+# Cache in memoria: PDF dei report (MB), roster per chat (numero di chat e TTL in secondi),
+# storici colonnari di /statistiche (numero di chat)
+REPORT_CACHE_MB = float(os.environ.get("REPORT_CACHE_MB", "32"))
+ROSTER_CHAT_MAX = int(os.environ.get("ROSTER_CHAT_MAX", "1000"))
+ROSTER_TTL = float(os.environ.get("ROSTER_TTL", "600"))
+STORICO_CHAT_MAX = int(os.environ.get("STORICO_CHAT_MAX", "64"))
+# Limite per chat alle richieste di /statistiche: al massimo N richieste per finestra di secondi
+REPORT_RICHIESTE_MAX = int(os.environ.get("REPORT_RICHIESTE_MAX", "3"))
+REPORT_RICHIESTE_FINESTRA = float(os.environ.get("REPORT_RICHIESTE_FINESTRA", "60"))
+
+BUCKET_LATENZA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+class Metriche:
+    # Istogrammi di latenza in memoria, condivisi tra event loop e thread del database
+    def __init__(self, bucket=BUCKET_LATENZA):
+        self.bucket = bucket
+        self.serie = defaultdict(dict)  # nome -> etichette -> [conteggi per bucket, somma, totale, massimo]
+        self.lock = threading.Lock()
+
+    def osserva(self, nome, secondi, **etichette):
+        chiave = tuple(etichette.items())
+        with self.lock:
+            serie = self.serie[nome].get(chiave)
+            if serie is None:
+                serie = self.serie[nome][chiave] = [[0] * len(self.bucket), 0.0, 0, 0.0]
+            i = bisect_left(self.bucket, secondi)
+            if i < len(self.bucket):
+                serie[0][i] += 1
+            serie[1] += secondi
+            serie[2] += 1
+            serie[3] = max(serie[3], secondi)
+
+    @contextmanager
+    def cronometro(self, nome, **etichette):
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.osserva(nome, time.perf_counter() - inizio, **etichette)
+
+    def esporta(self):
+        # Formato testo di Prometheus: bucket cumulativi, _sum e _count per ogni combinazione di etichette
+        righe = []
+        with self.lock:
+            for nome, per_etichette in sorted(self.serie.items()):
+                righe.append(f"# TYPE {nome} histogram")
+                for chiave, (conteggi, somma, totale, _) in per_etichette.items():
+                    etichette = ",".join(f'{k}="{formatta_etichetta(v)}"' for k, v in chiave)
+                    prefisso = etichette + "," if etichette else ""
+                    cumulato = 0
+                    for limite, n in zip(self.bucket, conteggi):
+                        cumulato += n
+                        righe.append(f'{nome}_bucket{{{prefisso}le="{limite}"}} {cumulato}')
+                    righe.append(f'{nome}_bucket{{{prefisso}le="+Inf"}} {totale}')
+                    righe.append(f"{nome}_sum{{{etichette}}} {somma:.6f}")
+                    righe.append(f"{nome}_count{{{etichette}}} {totale}")
+        return righe
+
+    def riepilogo(self, nome):
+        # (etichette, chiamate, media, massimo) ordinati per tempo totale decrescente
+        with self.lock:
+            voci = [(dict(chiave), s[2], s[1] / s[2], s[3]) for chiave, s in self.serie[nome].items() if s[2]]
+        return sorted(voci, key=lambda v: -v[1] * v[2])
+
+def formatta_etichetta(valore):
+    return str(valore).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metriche = Metriche()
+
+@lru_cache(maxsize=512)
+def etichetta_query(sql):
+    # "SELECT prestazioni", "UPDATE partite", ...: abbastanza per raggruppare senza esplodere le serie
+    verbo = sql.split(None, 1)[0].upper() if sql.strip() else "?"
+    tabella = re.search(r'\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(\w+)', sql, re.IGNORECASE)
+    return f"{verbo} {tabella.group(1)}" if tabella else verbo
+
+class Cursore:
+    # Cursore comune ai backend: le query si scrivono sempre con il segnaposto %s
+    # Totale delle query eseguite dal processo, letto dal benchmark
+    query_eseguite = 0
+
+    def __init__(self, cursore, segnaposto='%s'):
+        self.cursore = cursore
+        self.segnaposto = segnaposto
+
+    def execute(self, sql, parametri=()):
+        if self.segnaposto != '%s':
+            sql = sql.replace('%s', self.segnaposto)
+        with self.misura(sql):
+            self.cursore.execute(sql, parametri)
+
+    @contextmanager
+    def misura(self, sql):
+        # Tempo per query, raggruppato per istruzione e tabella, più il log delle query lente
+        Cursore.query_eseguite += 1
+        inizio = time.perf_counter()
+        try:
+            yield
+        finally:
+            durata = time.perf_counter() - inizio
+            metriche.osserva('calcetto_query_secondi', durata, query=etichetta_query(sql))
+            if durata * 1000 >= SLOW_QUERY_MS:
+                print(f"[QUERY LENTA] {durata * 1000:.0f} ms: {' '.join(sql.split())[:300]}")
+
+    def fetchone(self):
+        return self.cursore.fetchone()
+
+    def fetchall(self):
+        return self.cursore.fetchall()
+
+    def fetchmany(self, n):
+        return self.cursore.fetchmany(n)
+
+def segnaposti_in(valori):
+    # "(%s, %s, ...)" per una IN portabile tra PostgreSQL e SQLite
+    return "(" + ", ".join(["%s"] * len(valori)) + ")"
+
+def valore_copy(v):
+    # Un campo nel formato testo di COPY: \N per NULL, escape di backslash, tab e a capo
+    if v is None:
+        return '\\N'
+    if isinstance(v, date):
+        return v.isoformat()
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+class Storage:
+    # Tutte le operazioni sui dati usate dagli handler. I backend forniscono solo
+    # transazioni, inserimenti multi-riga e schema: l'SQL qui sotto è comune a entrambi.
+    MIGRAZIONI = []
+    DDL_MIGRAZIONI = """
+        CREATE TABLE IF NOT EXISTS schema_migrazioni (
+            versione INTEGER PRIMARY KEY,
+            descrizione TEXT NOT NULL,
+            applicata_il TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """
+
+    def transazione(self):
+        raise NotImplementedError
+
+    def esegui_valori(self, c, sql, righe):
+        # Esegue sql (che contiene "VALUES %s") con tutte le righe in un'unica istruzione
+        raise NotImplementedError
+
+    def scorri(self, c, sql, parametri=(), blocco=STATISTICHE_BLOCCO):
+        # Righe del risultato a blocchi di `blocco`, senza materializzarle tutte con fetchall
+        c.execute(sql, parametri)
+        while True:
+            righe = c.fetchmany(blocco)
+            if not righe:
+                return
+            yield from righe
+
+    def copia_righe(self, c, tabella, colonne, righe):
+        # Inserimento massivo per l'importazione; i backend possono usare un canale più veloce
+        self.esegui_valori(c, f'INSERT INTO {tabella} ({", ".join(colonne)}) VALUES %s', righe)
+
+    def _riserva_id_partite(self, c, n):
+        # n id consecutivi per partite inserite a blocchi con copia_righe
+        raise NotImplementedError
+
+    def chiudi(self):
+        pass
+
+    def _blocca_migrazioni(self, c):
+        pass
+
+    def applica_migrazioni(self):
+        with self.transazione() as c:
+            c.execute(self.DDL_MIGRAZIONI)
+        applicate = []
+        for versione, descrizione, istruzioni in self.MIGRAZIONI:
+            with self.transazione() as c:
+                self._blocca_migrazioni(c)
+                c.execute('SELECT 1 FROM schema_migrazioni WHERE versione = %s', (versione,))
+                if c.fetchone():
+                    continue
+                for sql in istruzioni:
+                    c.execute(sql)
+                c.execute('INSERT INTO schema_migrazioni (versione, descrizione) VALUES (%s, %s)', (versione, descrizione))
+                applicate.append(versione)
+                print(f"[MIGRAZIONE] {versione}: {descrizione}")
+        return applicate
+
+    # --- Versione dei dati ---
+
+    def versione_dati(self, chat_id):
+        # Versione corrente dei dati della chat: le cache servono solo voci di questa versione
+        with self.transazione() as c:
+            c.execute('SELECT versione FROM versioni_chat WHERE chat_id = %s', (chat_id,))
+            row = c.fetchone()
+            return row[0] if row else 0
+
+    def _nuova_versione(self, c, chat_id):
+        # Da chiamare in ogni transazione che scrive dati della chat: la nuova versione diventa
+        # visibile insieme alla scrittura, anche ai processi che non l'hanno fatta (es. --importa)
+        c.execute("""
+            INSERT INTO versioni_chat (chat_id, versione) VALUES (%s, 1)
+            ON CONFLICT (chat_id) DO UPDATE SET versione = versioni_chat.versione + 1
+            RETURNING versione
+        """, (chat_id,))
+        return c.fetchone()[0]
+
+    # --- Giocatori ---
+
+    def roster(self, chat_id):
+        # Nome -> id di tutti i giocatori della chat, dalla cache quando possibile.
+        # La versione va letta prima della query, come per lo storico
+        versione = self.versione_dati(chat_id)
+        roster = roster_cache.get(chat_id, versione)
+        if roster is None:
+            with self.transazione() as c:
+                c.execute('SELECT nome, id FROM giocatori WHERE chat_id = %s', (chat_id,))
+                roster = dict(c.fetchall())
+            roster_cache.put(chat_id, versione, roster)
+        return roster
+
+    def lista_giocatori(self, chat_id):
+        return sorted(self.roster(chat_id))
+
+    def aggiungi_giocatori(self, nomi, chat_id):
+        nomi = list(dict.fromkeys(nomi))
+        with self.transazione() as c:
+            self.esegui_valori(c, 'INSERT INTO giocatori (nome, chat_id) VALUES %s ON CONFLICT (nome, chat_id) DO NOTHING',
+                               [(nome, chat_id) for nome in nomi])
+            c.execute('SELECT nome, id FROM giocatori WHERE chat_id = %s AND nome IN ' + segnaposti_in(nomi), (chat_id, *nomi))
+            ids = dict(c.fetchall())
+            versione = self._nuova_versione(c, chat_id)
+        # Write-through dopo il commit: la cache non vede mai giocatori di una transazione annullata
+        roster_cache.aggiungi(chat_id, versione, ids)
+
+    def _risolvi_giocatori(self, c, nomi, chat_id):
+        # Nome -> id per tutti i giocatori richiesti: dalla cache del roster se li contiene
+        # tutti, altrimenti con una sola query (che conferma anche i nomi davvero mancanti).
+        # Va bene anche un roster di una versione precedente: gli id che contiene restano validi.
+        nomi = list(nomi)
+        roster = roster_cache.get(chat_id)
+        if roster is not None and all(n in roster for n in nomi):
+            return {n: roster[n] for n in nomi}
+        c.execute('SELECT nome, id FROM giocatori WHERE chat_id = %s AND nome IN ' + segnaposti_in(nomi), (chat_id, *nomi))
+        ids = dict(c.fetchall())
+        mancanti = [n for n in nomi if n not in ids]
+        if mancanti:
+            raise ValueError("Giocatori non registrati: " + ", ".join(mancanti))
+        return ids
+
+    # --- Partite ---
+
+    def _inserisci_prestazioni(self, c, righe):
+        # Tutte le prestazioni in un unico INSERT multi-riga
+        self.esegui_valori(
+            c,
+            'INSERT INTO prestazioni (partita_id, giocatore_id, squadra, gol, assist, vittoria, pareggio, sconfitta, chat_id) VALUES %s',
+            righe
+        )
 
-def get_conn():
-    return psycopg2.connect(DATABASE_URL)
-
-def lista_giocatori(chat_id):
-    with get_conn() as conn:
-        with conn.cursor() as c:
-            c.execute('SELECT nome FROM giocatori WHERE chat_id = %s ORDER BY nome', (chat_id,))
-            nomi = [row[0] for row in c.fetchall()]
-    return nomi
-
-def aggiungi_giocatori_db(nomi, chat_id):
-    with get_conn() as conn:
-        with conn.cursor() as c:
-            for nome in nomi:
-                c.execute(
-                    'INSERT INTO giocatori (nome, chat_id) VALUES (%s, %s) ON CONFLICT (nome, chat_id) DO NOTHING',
-                    (nome, chat_id)
-                )
-
-def salva_partita(data, chat_id):
-    with get_conn() as conn:
-        with conn.cursor() as c:
+    def _aggiorna_aggregati(self, c, chat_id, delta):
+        # Applica le variazioni alla tabella aggregata nella stessa transazione della scrittura
+        righe = [(chat_id, gid) + tuple(d) for gid, d in delta.items() if any(d)]
+        if not righe:
+            return
+        self.esegui_valori(c, """
+            INSERT INTO statistiche_giocatori (chat_id, giocatore_id, presenze, gol, assist, vittorie, pareggi, sconfitte)
+            VALUES %s
+            ON CONFLICT (chat_id, giocatore_id) DO UPDATE SET
+                presenze = statistiche_giocatori.presenze + EXCLUDED.presenze,
+                gol = statistiche_giocatori.gol + EXCLUDED.gol,
+                assist = statistiche_giocatori.assist + EXCLUDED.assist,
+                vittorie = statistiche_giocatori.vittorie + EXCLUDED.vittorie,
+                pareggi = statistiche_giocatori.pareggi + EXCLUDED.pareggi,
+                sconfitte = statistiche_giocatori.sconfitte + EXCLUDED.sconfitte
+        """, righe)
+
+    def salva_partita(self, data, chat_id):
+        esiti = esiti_squadre(data['risultato'])
+        gol = parse_stats(data['gol'])
+        assist = parse_stats(data['assist'])
+        with self.transazione() as c:
+            ids = self._risolvi_giocatori(c, data['squadra_a'] + data['squadra_b'], chat_id)
             c.execute('INSERT INTO partite (data, squadra_a, squadra_b, risultato, chat_id) VALUES (%s, %s, %s, %s, %s) RETURNING id',
                       (data['data'], ','.join(data['squadra_a']), ','.join(data['squadra_b']), data['risultato'], chat_id))
             partita_id = c.fetchone()[0]
-            gol = parse_stats(data['gol'])
-            assist = parse_stats(data['assist'])
-            gol_a, gol_b = map(int, data['risultato'].split('-'))
-            for nome in data['squadra_a']:
-                c.execute('SELECT id FROM giocatori WHERE nome=%s AND chat_id=%s', (nome, chat_id))
-                giocatore_id = c.fetchone()[0]
-                c.execute('INSERT INTO prestazioni (partita_id, giocatore_id, squadra, gol, assist, vittoria, pareggio, sconfitta, chat_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                          (partita_id, giocatore_id, 'A', gol.get(nome,0), assist.get(nome,0), int(gol_a>gol_b), int(gol_a==gol_b), int(gol_a<gol_b), chat_id))
-            for nome in data['squadra_b']:
-                c.execute('SELECT id FROM giocatori WHERE nome=%s AND chat_id=%s', (nome, chat_id))
-                giocatore_id = c.fetchone()[0]
-                c.execute('INSERT INTO prestazioni (partita_id, giocatore_id, squadra, gol, assist, vittoria, pareggio, sconfitta, chat_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                          (partita_id, giocatore_id, 'B', gol.get(nome,0), assist.get(nome,0), int(gol_b>gol_a), int(gol_a==gol_b), int(gol_b<gol_a), chat_id))
+            righe = []
+            for squadra, nomi in (('A', data['squadra_a']), ('B', data['squadra_b'])):
+                for nome in nomi:
+                    righe.append((partita_id, ids[nome], squadra, gol.get(nome,0), assist.get(nome,0)) + esiti[squadra] + (chat_id,))
+            self._inserisci_prestazioni(c, righe)
+            self._aggiorna_aggregati(c, chat_id, delta_prestazioni([r[1:2] + r[3:8] for r in righe]))
+            self._ricalcola_rating(c, chat_id, (data['data'], partita_id))
+            versione = self._nuova_versione(c, chat_id)
+        storico_cache.aggiorna(chat_id, versione, 'inserisci', partita_id, data['data'], data['risultato'], [r[1:5] for r in righe])
+        return partita_id
+
+    def modifica_partita(self, partita_id, campo, nuovo_valore, chat_id):
+        # Aggiorna solo le righe di prestazioni toccate dalla modifica, in un'unica transazione
+        with self.transazione() as c:
+            c.execute('SELECT squadra_a, squadra_b, risultato, data FROM partite WHERE id = %s AND chat_id = %s', (partita_id, chat_id))
+            row = c.fetchone()
+            if not row:
+                raise ValueError("Partita non trovata.")
+            risultato = row[2]
+            c.execute('SELECT giocatori.id, giocatori.nome, prestazioni.gol, prestazioni.assist, prestazioni.squadra, prestazioni.vittoria, prestazioni.pareggio, prestazioni.sconfitta FROM prestazioni JOIN giocatori ON prestazioni.giocatore_id = giocatori.id WHERE partita_id = %s AND prestazioni.chat_id = %s', (partita_id, chat_id))
+            prestazioni = c.fetchall()
+            delta = defaultdict(lambda: [0, 0, 0, 0, 0, 0])
+            aggiornamento = None
+            if campo in ['squadra_a', 'squadra_b']:
+                squadra = 'A' if campo == 'squadra_a' else 'B'
+                nomi = [n.strip() for n in nuovo_valore.split(',') if n.strip()]
+                if len(nomi) != 5 or len(set(nomi)) != 5:
+                    raise ValueError("La squadra deve avere esattamente 5 giocatori diversi!")
+                ids = self._risolvi_giocatori(c, nomi, chat_id)
+                attuali = {p[0] for p in prestazioni if p[4] == squadra}
+                avversari = {p[0] for p in prestazioni if p[4] != squadra}
+                nuovi = set(ids.values())
+                if nuovi & avversari:
+                    raise ValueError("Un giocatore non può essere in entrambe le squadre!")
+                c.execute(f'UPDATE partite SET {campo} = %s WHERE id = %s AND chat_id = %s', (','.join(nomi), partita_id, chat_id))
+                usciti = list(attuali - nuovi)
+                if usciti:
+                    c.execute('DELETE FROM prestazioni WHERE partita_id = %s AND chat_id = %s AND giocatore_id IN ' + segnaposti_in(usciti) + ' RETURNING giocatore_id, gol, assist, vittoria, pareggio, sconfitta', (partita_id, chat_id, *usciti))
+                    delta = delta_prestazioni(c.fetchall(), -1)
+                esito = esiti_squadre(risultato)[squadra]
+                entrati = [(partita_id, ids[n], squadra, 0, 0) + esito + (chat_id,) for n in nomi if ids[n] not in attuali]
+                if entrati:
+                    self._inserisci_prestazioni(c, entrati)
+                    for gid, d in delta_prestazioni([r[1:2] + r[3:8] for r in entrati]).items():
+                        delta[gid] = [x + y for x, y in zip(delta[gid], d)]
+                # Nello storico la partita viene sostituita con le formazioni nuove, nell'ordine inserito
+                gol_assist = {p[0]: (p[2], p[3]) for p in prestazioni}
+                ordine = {n: i for i, n in enumerate((row[1] if squadra == 'A' else row[0]).split(','))}
+                altri = sorted((p for p in prestazioni if p[4] != squadra), key=lambda p: ordine.get(p[1], len(ordine)))
+                righe_storico = [(ids[n], squadra) + gol_assist.get(ids[n], (0, 0)) for n in nomi] + [(p[0], p[4], p[2], p[3]) for p in altri]
+                aggiornamento = ('inserisci', partita_id, row[3], risultato, righe_storico)
+            elif campo == 'risultato':
+                esiti = esiti_squadre(nuovo_valore)
+                c.execute('UPDATE partite SET risultato = %s WHERE id = %s AND chat_id = %s', (nuovo_valore, partita_id, chat_id))
+                c.execute("""
+                    UPDATE prestazioni SET
+                        vittoria = CASE WHEN squadra = 'A' THEN %s ELSE %s END,
+                        pareggio = %s,
+                        sconfitta = CASE WHEN squadra = 'A' THEN %s ELSE %s END
+                    WHERE partita_id = %s AND chat_id = %s
+                """, (esiti['A'][0], esiti['B'][0], esiti['A'][1], esiti['A'][2], esiti['B'][2], partita_id, chat_id))
+                for gid, nome, g, a, sq, v, p, sc in prestazioni:
+                    delta[gid] = [0, 0, 0] + [nuovo - vecchio for nuovo, vecchio in zip(esiti[sq], (v, p, sc))]
+                aggiornamento = ('imposta_risultato', partita_id, nuovo_valore)
+            elif campo == 'gol' or campo == 'assist':
+                nuovi = parse_stats(nuovo_valore)
+                if any(v < 0 for v in nuovi.values()):
+                    raise ValueError("Gol e assist non possono essere negativi.")
+                modificate = []
+                for gid, nome, g, a, sq, v, p, sc in prestazioni:
+                    nuovo_g = nuovi.get(nome, g) if campo == 'gol' else g
+                    nuovo_a = nuovi.get(nome, a) if campo == 'assist' else a
+                    if (nuovo_g, nuovo_a) != (g, a):
+                        modificate.append((partita_id, gid, nuovo_g, nuovo_a))
+                        delta[gid] = [0, nuovo_g - g, nuovo_a - a, 0, 0, 0]
+                if modificate:
+                    # Le colonne di VALUES si chiamano column1..columnN sia in PostgreSQL che in SQLite
+                    self.esegui_valori(c, """
+                        UPDATE prestazioni SET gol = v.column3, assist = v.column4
+                        FROM (VALUES %s) AS v
+                        WHERE prestazioni.partita_id = v.column1 AND prestazioni.giocatore_id = v.column2
+                    """, modificate)
+                aggiornamento = ('imposta_valori', partita_id, campo, {gid: g if campo == 'gol' else a for _, gid, g, a in modificate})
+            self._aggiorna_aggregati(c, chat_id, delta)
+            if campo not in ('gol', 'assist'):
+                # Formazioni e risultato cambiano il rating: si rigioca da questa partita in avanti
+                self._ricalcola_rating(c, chat_id, (row[3], partita_id))
+            versione = self._nuova_versione(c, chat_id)
+        if aggiornamento:
+            storico_cache.aggiorna(chat_id, versione, *aggiornamento)
+
+    def elimina_partita(self, partita_id, chat_id):
+        with self.transazione() as c:
+            c.execute('SELECT data FROM partite WHERE id = %s AND chat_id = %s', (partita_id, chat_id))
+            row = c.fetchone()
+            if not row:
+                return
+            # Il riavvolgimento legge lo storico della partita, che la DELETE cancella a cascata
+            punto = (row[0], partita_id)
+            stato, toccati = self._riavvolgi_rating(c, chat_id, punto)
+            c.execute('DELETE FROM prestazioni WHERE partita_id = %s AND chat_id = %s RETURNING giocatore_id, gol, assist, vittoria, pareggio, sconfitta', (partita_id, chat_id))
+            self._aggiorna_aggregati(c, chat_id, delta_prestazioni(c.fetchall(), -1))
+            c.execute('DELETE FROM partite WHERE id = %s AND chat_id = %s', (partita_id, chat_id))
+            self._rigioca_rating(c, chat_id, punto, stato, toccati)
+            versione = self._nuova_versione(c, chat_id)
+        storico_cache.aggiorna(chat_id, versione, 'rimuovi', partita_id)
+
+    def partite_per_data(self, data, chat_id):
+        with self.transazione() as c:
+            c.execute('SELECT id, squadra_a, squadra_b, risultato FROM partite WHERE data = %s AND chat_id = %s', (data, chat_id))
+            return c.fetchall()
+
+    def dettaglio_partita(self, data, chat_id):
+        with self.transazione() as c:
+            c.execute('SELECT id, squadra_a, squadra_b, risultato FROM partite WHERE data = %s AND chat_id = %s', (data, chat_id))
+            row = c.fetchone()
+            if not row:
+                return None, []
+            c.execute('SELECT giocatori.nome, prestazioni.gol, prestazioni.assist, prestazioni.squadra FROM prestazioni JOIN giocatori ON prestazioni.giocatore_id = giocatori.id WHERE partita_id = %s AND prestazioni.chat_id = %s', (row[0], chat_id))
+            return row, c.fetchall()
+
+    def pagina_partite(self, chat_id, periodo=None, prima_di=None, dopo=None, n=10):
+        # Paginazione keyset su (data, id): ogni pagina è un'unica range scan sull'indice
+        # (chat_id, data, id), qualunque sia la lunghezza dello storico. Restituisce le
+        # righe in ordine cronologico e se esistono partite prima e dopo la pagina.
+        filtro, parametri = filtro_periodo(periodo)
+        with self.transazione() as c:
+            if dopo is not None:
+                c.execute('SELECT id, data, squadra_a, squadra_b, risultato FROM partite WHERE chat_id = %s' + filtro +
+                          ' AND (data, id) > (%s, %s) ORDER BY data, id LIMIT %s', (chat_id,) + parametri + tuple(dopo) + (n + 1,))
+                righe = c.fetchall()
+                return righe[:n], True, len(righe) > n
+            # Senza chiave si parte dalle partite più recenti
+            chiave = ' AND (data, id) < (%s, %s)' if prima_di is not None else ''
+            c.execute('SELECT id, data, squadra_a, squadra_b, risultato FROM partite WHERE chat_id = %s' + filtro + chiave +
+                      ' ORDER BY data DESC, id DESC LIMIT %s', (chat_id,) + parametri + tuple(prima_di or ()) + (n + 1,))
+            righe = c.fetchall()
+            return righe[:n][::-1], len(righe) > n, prima_di is not None
+
+    # --- Statistiche ---
+
+    def carica_storico(self, chat_id, periodo=None, blocco=STATISTICHE_BLOCCO):
+        # Un'unica scansione di partite e prestazioni in ordine cronologico (solo quelle del
+        # periodo, se indicato), letta a blocchi e inserita partita per partita in StoricoChat
+        storico = StoricoChat()
+        filtro, parametri = filtro_periodo(periodo, 'p.data')
+        with self.transazione() as c:
+            righe = self.scorri(c, """
+                SELECT p.id, p.data, p.squadra_a, p.squadra_b, p.risultato, pr.giocatore_id, g.nome, pr.squadra, pr.gol, pr.assist
+                FROM partite p
+                JOIN prestazioni pr ON pr.partita_id = p.id
+                JOIN giocatori g ON g.id = pr.giocatore_id
+                WHERE p.chat_id = %s""" + filtro + """
+                ORDER BY p.data, p.id
+            """, (chat_id,) + parametri, blocco)
+            partita, prestazioni = None, []
+            for r in righe:
+                if partita is not None and r[0] != partita[0]:
+                    self._aggiungi_a_storico(storico, partita, prestazioni)
+                    prestazioni = []
+                partita = r[:5]
+                prestazioni.append(r[5:])
+            if partita is not None:
+                self._aggiungi_a_storico(storico, partita, prestazioni)
+        return storico
+
+    def _aggiungi_a_storico(self, storico, partita, prestazioni):
+        # Le righe seguono l'ordine dei nomi in squadra_a/squadra_b, come nelle formazioni inserite
+        partita_id, data, squadra_a, squadra_b, risultato = partita
+        ordine = {nome: i for i, nome in enumerate(squadra_a.split(',') + squadra_b.split(','))}
+        prestazioni.sort(key=lambda pr: (pr[2], ordine.get(pr[1], len(ordine))))
+        storico.inserisci(partita_id, data, risultato, [(gid, sq, g, a) for gid, nome, sq, g, a in prestazioni])
+
+    def storico(self, chat_id, periodo=None):
+        # Storico colonnare della chat, dalla cache quando possibile. A cache fredda un report
+        # limitato a un periodo legge solo le partite del periodo, e non le mette in cache.
+        # La versione va letta prima della scansione: uno storico letto durante una scrittura
+        # resta marcato con la versione precedente e la prossima lettura lo ricarica
+        versione = self.versione_dati(chat_id)
+        storico = storico_cache.get(chat_id, versione)
+        if storico is None and periodo is not None:
+            return self.carica_storico(chat_id, periodo)
+        if storico is None:
+            storico = self.carica_storico(chat_id)
+            storico_cache.put(chat_id, versione, storico)
+        return storico
+
+    def medie_gol(self, chat_id):
+        # giocatore_id -> gol a partita in carriera, dalla tabella aggregata
+        with self.transazione() as c:
+            c.execute('SELECT giocatore_id, presenze, gol FROM statistiche_giocatori WHERE chat_id = %s AND presenze > 0', (chat_id,))
+            return {gid: gol / presenze for gid, presenze, gol in c.fetchall()}
+
+    def scheda_giocatore(self, nome, chat_id, top=3):
+        # Solo righe del giocatore: totali dalla tabella aggregata, compagni e avversari
+        # dalle sue prestazioni (indice chat_id, giocatore_id) unite alle altre 9 della partita
+        with self.transazione() as c:
+            c.execute("""
+                SELECT g.id, g.nome, COALESCE(s.presenze, 0), COALESCE(s.gol, 0), COALESCE(s.assist, 0),
+                       COALESCE(s.vittorie, 0), COALESCE(s.pareggi, 0), COALESCE(s.sconfitte, 0)
+                FROM giocatori g
+                LEFT JOIN statistiche_giocatori s ON s.chat_id = g.chat_id AND s.giocatore_id = g.id
+                WHERE g.chat_id = %s AND LOWER(g.nome) = LOWER(%s)
+            """, (chat_id, nome))
+            giocatore = c.fetchone()
+            if giocatore is None:
+                return None, [], []
+            c.execute("""
+                SELECT g.nome,
+                       SUM(CASE WHEN altri.squadra = mio.squadra THEN 1 ELSE 0 END),
+                       SUM(CASE WHEN altri.squadra <> mio.squadra THEN 1 ELSE 0 END)
+                FROM prestazioni mio
+                JOIN prestazioni altri ON altri.partita_id = mio.partita_id AND altri.giocatore_id <> mio.giocatore_id
+                JOIN giocatori g ON g.id = altri.giocatore_id
+                WHERE mio.chat_id = %s AND mio.giocatore_id = %s
+                GROUP BY g.nome
+            """, (chat_id, giocatore[0]))
+            incroci = c.fetchall()
+        compagni = sorted(((n, int(x)) for n, x, _ in incroci if x), key=lambda v: (-v[1], v[0]))[:top]
+        avversari = sorted(((n, int(x)) for n, _, x in incroci if x), key=lambda v: (-v[1], v[0]))[:top]
+        return giocatore, compagni, avversari
+
+    def dati_bilanciamento(self, nomi, chat_id):
+        # Totali dei 10 convocati e, per ogni coppia, le partite giocate nella stessa squadra
+        with self.transazione() as c:
+            ids = self._risolvi_giocatori(c, nomi, chat_id)
+            lista = list(ids.values())
+            c.execute('SELECT giocatore_id, presenze, gol, assist, vittorie, pareggi FROM statistiche_giocatori WHERE chat_id = %s AND giocatore_id IN ' + segnaposti_in(lista), (chat_id, *lista))
+            totali = {r[0]: r[1:] for r in c.fetchall()}
+            c.execute("""
+                SELECT a.giocatore_id, b.giocatore_id, COUNT(*), SUM(a.vittoria), SUM(a.pareggio)
+                FROM prestazioni a
+                JOIN prestazioni b ON b.partita_id = a.partita_id AND b.squadra = a.squadra AND b.giocatore_id > a.giocatore_id
+                WHERE a.chat_id = %s AND a.giocatore_id IN """ + segnaposti_in(lista) + """ AND b.giocatore_id IN """ + segnaposti_in(lista) + """
+                GROUP BY a.giocatore_id, b.giocatore_id
+            """, (chat_id, *lista, *lista))
+            coppie = {(r[0], r[1]): tuple(int(x) for x in r[2:]) for r in c.fetchall()}
+        return ids, totali, coppie
+
+    # --- Importazione ed esportazione ---
+
+    def esporta_partite(self, chat_id, blocco=1000):
+        # Partite in ordine cronologico con marcatori e assistman, a blocchi keyset: ogni blocco
+        # è una transazione breve e in memoria ce n'è uno solo alla volta
+        dopo = (date.min, 0)
+        while True:
+            with self.transazione() as c:
+                c.execute("""
+                    SELECT id, data, squadra_a, squadra_b, risultato FROM partite
+                    WHERE chat_id = %s AND (data, id) > (%s, %s)
+                    ORDER BY data, id LIMIT %s
+                """, (chat_id, *dopo, blocco))
+                partite = c.fetchall()
+                if not partite:
+                    return
+                ids = [p[0] for p in partite]
+                c.execute("""
+                    SELECT pr.partita_id, g.nome, pr.gol, pr.assist
+                    FROM prestazioni pr JOIN giocatori g ON g.id = pr.giocatore_id
+                    WHERE pr.chat_id = %s AND (pr.gol > 0 OR pr.assist > 0) AND pr.partita_id IN
+                """ + segnaposti_in(ids) + " ORDER BY g.nome", (chat_id, *ids))
+                gol, assist = defaultdict(dict), defaultdict(dict)
+                for partita_id, nome, g, a in c.fetchall():
+                    if g:
+                        gol[partita_id][nome] = g
+                    if a:
+                        assist[partita_id][nome] = a
+            for partita_id, data, squadra_a, squadra_b, risultato in partite:
+                yield {
+                    'data': data,
+                    'squadra_a': squadra_a.split(','),
+                    'squadra_b': squadra_b.split(','),
+                    'risultato': risultato,
+                    'gol': gol[partita_id],
+                    'assist': assist[partita_id],
+                }
+            dopo = (partite[-1][1], partite[-1][0])
+
+    def importa(self, chat_id, record, blocco=IMPORT_BLOCCO):
+        # record: iterabile (anche un generatore che legge il file) di ('giocatore', nome) e
+        # ('partita', dict già validato). Un'unica transazione: o entra tutto il file o niente.
+        # Le partite sono scritte a blocchi, quindi la memoria non cresce con la lunghezza del file.
+        # Una partita già presente nella chat (stessa data, formazioni e risultato) viene saltata:
+        # reimportare un'esportazione, anche in parte, non duplica le partite.
+        nuovi = {}
+        n_partite = n_saltate = 0
+        prima_data = None
+        with self.transazione() as c:
+            c.execute('SELECT nome, id FROM giocatori WHERE chat_id = %s', (chat_id,))
+            ids = dict(c.fetchall())
+
+            def registra(nomi):
+                mancanti = [n for n in dict.fromkeys(nomi) if n not in ids]
+                if mancanti:
+                    self.esegui_valori(c, 'INSERT INTO giocatori (nome, chat_id) VALUES %s ON CONFLICT (nome, chat_id) DO NOTHING',
+                                       [(n, chat_id) for n in mancanti])
+                    c.execute('SELECT nome, id FROM giocatori WHERE chat_id = %s AND nome IN ' + segnaposti_in(mancanti), (chat_id, *mancanti))
+                    trovati = dict(c.fetchall())
+                    ids.update(trovati)
+                    nuovi.update(trovati)
+
+            def scrivi(partite):
+                giorni = list({p['data'] for p in partite})
+                c.execute('SELECT data, squadra_a, squadra_b, risultato FROM partite WHERE chat_id = %s AND data IN ' + segnaposti_in(giorni),
+                          (chat_id, *giorni))
+                presenti = set(c.fetchall())
+                da_scrivere = []
+                for p in partite:
+                    chiave = (p['data'], ','.join(p['squadra_a']), ','.join(p['squadra_b']), p['risultato'])
+                    if chiave not in presenti:
+                        presenti.add(chiave)
+                        da_scrivere.append(p)
+                partite = da_scrivere
+                if not partite:
+                    return 0
+                registra(n for p in partite for n in p['squadra_a'] + p['squadra_b'])
+                righe_partite, righe_prestazioni = [], []
+                for partita_id, p in zip(self._riserva_id_partite(c, len(partite)), partite):
+                    righe_partite.append((partita_id, p['data'], ','.join(p['squadra_a']), ','.join(p['squadra_b']), p['risultato'], chat_id))
+                    esiti = esiti_squadre(p['risultato'])
+                    for squadra, nomi in (('A', p['squadra_a']), ('B', p['squadra_b'])):
+                        for nome in nomi:
+                            righe_prestazioni.append((partita_id, ids[nome], squadra, p['gol'].get(nome, 0), p['assist'].get(nome, 0)) + esiti[squadra] + (chat_id,))
+                self.copia_righe(c, 'partite', ('id', 'data', 'squadra_a', 'squadra_b', 'risultato', 'chat_id'), righe_partite)
+                self.copia_righe(c, 'prestazioni', ('partita_id', 'giocatore_id', 'squadra', 'gol', 'assist', 'vittoria', 'pareggio', 'sconfitta', 'chat_id'), righe_prestazioni)
+                self._aggiorna_aggregati(c, chat_id, delta_prestazioni([r[1:2] + r[3:8] for r in righe_prestazioni]))
+                return len(partite)
+
+            in_attesa = []
+            for tipo, valore in record:
+                if tipo == 'giocatore':
+                    registra([valore])
+                    continue
+                in_attesa.append(valore)
+                prima_data = valore['data'] if prima_data is None else min(prima_data, valore['data'])
+                if len(in_attesa) >= blocco:
+                    scritte = scrivi(in_attesa)
+                    n_partite += scritte
+                    n_saltate += len(in_attesa) - scritte
+                    in_attesa = []
+            if in_attesa:
+                scritte = scrivi(in_attesa)
+                n_partite += scritte
+                n_saltate += len(in_attesa) - scritte
+            if prima_data is not None:
+                # Le partite importate possono cadere prima di quelle esistenti: si rigioca dalla più vecchia
+                self._ricalcola_rating(c, chat_id, (prima_data, 0))
+            versione = self._nuova_versione(c, chat_id)
+        roster_cache.aggiungi(chat_id, versione, nuovi)
+        storico_cache.invalida(chat_id)
+        return n_partite, len(nuovi), n_saltate
+
+    # --- Rating Elo ---
+
+    def _riavvolgi_rating(self, c, chat_id, punto):
+        # Riporta i rating a prima di `punto` = (data, id) usando il valore "prima" della prima
+        # partita di ogni giocatore da lì in avanti, e cancella lo storico da rigiocare
+        c.execute('SELECT giocatore_id, rating, partite FROM rating_giocatori WHERE chat_id = %s', (chat_id,))
+        stato = {r[0]: (r[1], r[2]) for r in c.fetchall()}
+        c.execute("""
+            SELECT s.giocatore_id, s.prima FROM storico_rating s JOIN partite p ON p.id = s.partita_id
+            WHERE p.chat_id = %s AND (p.data, p.id) >= (%s, %s)
+            ORDER BY p.data DESC, p.id DESC
+        """, (chat_id, *punto))
+        toccati = set()
+        for gid, prima in c.fetchall():
+            partite = stato.get(gid, (ELO_INIZIALE, 1))[1]
+            stato[gid] = (prima, partite - 1)
+            toccati.add(gid)
+        c.execute('DELETE FROM storico_rating WHERE partita_id IN (SELECT id FROM partite WHERE chat_id = %s AND (data, id) >= (%s, %s))', (chat_id, *punto))
+        return stato, toccati
+
+    def _rigioca_rating(self, c, chat_id, punto, stato, toccati, blocco=1000):
+        # Rigioca in ordine cronologico le partite da `punto` in avanti: per una partita nuova
+        # in fondo allo storico è un aggiornamento incrementale dei soli 10 giocatori in campo.
+        # Le partite sono lette a pagine di `blocco`, così anche una ricostruzione completa
+        # dopo un'importazione non carica tutto lo storico in memoria.
+        toccati = set(toccati)
+        while True:
+            c.execute("""
+                SELECT p.id, p.risultato, pr.giocatore_id, pr.squadra, p.data
+                FROM partite p JOIN prestazioni pr ON pr.partita_id = p.id
+                WHERE p.id IN (
+                    SELECT id FROM partite WHERE chat_id = %s AND (data, id) >= (%s, %s) ORDER BY data, id LIMIT %s
+                )
+                ORDER BY p.data, p.id
+            """, (chat_id, *punto, blocco))
+            partite = []
+            for partita_id, risultato, gid, squadra, data in c.fetchall():
+                if not partite or partite[-1][0] != partita_id:
+                    partite.append((partita_id, risultato, []))
+                    punto = (data, partita_id + 1)
+                partite[-1][2].append((gid, squadra))
+            storico = rigioca_elo(stato, partite)
+            toccati.update(r[1] for r in storico)
+            if storico:
+                self.esegui_valori(c, 'INSERT INTO storico_rating (partita_id, giocatore_id, prima, dopo, chat_id) VALUES %s',
+                                   [r + (chat_id,) for r in storico])
+            if len(partite) < blocco:
+                break
+        # Chi è rimasto senza partite (tolto dalla sua unica partita) esce dalla classifica,
+        # come dopo una ricostruzione completa
+        senza_partite = [gid for gid in toccati if stato[gid][1] <= 0]
+        if senza_partite:
+            c.execute('DELETE FROM rating_giocatori WHERE chat_id = %s AND giocatore_id IN ' + segnaposti_in(senza_partite), (chat_id, *senza_partite))
+        aggiornati = [(chat_id, gid) + stato[gid] for gid in toccati if stato[gid][1] > 0]
+        if aggiornati:
+            self.esegui_valori(c, """
+                INSERT INTO rating_giocatori (chat_id, giocatore_id, rating, partite) VALUES %s
+                ON CONFLICT (chat_id, giocatore_id) DO UPDATE SET rating = EXCLUDED.rating, partite = EXCLUDED.partite
+            """, aggiornati)
+
+    def _ricalcola_rating(self, c, chat_id, punto):
+        stato, toccati = self._riavvolgi_rating(c, chat_id, punto)
+        self._rigioca_rating(c, chat_id, punto, stato, toccati)
+
+    def ricostruisci_rating(self, chat_id):
+        # Rating della chat ricalcolati da zero su tutto lo storico
+        with self.transazione() as c:
+            c.execute('DELETE FROM storico_rating WHERE chat_id = %s', (chat_id,))
+            c.execute('DELETE FROM rating_giocatori WHERE chat_id = %s', (chat_id,))
+            self._rigioca_rating(c, chat_id, (date.min, 0), {}, set())
+            self._nuova_versione(c, chat_id)
+
+    def inizializza_rating(self):
+        # Dopo la migrazione: calcola i rating delle chat che hanno partite ma nessun rating
+        with self.transazione() as c:
+            c.execute('SELECT DISTINCT chat_id FROM partite WHERE chat_id NOT IN (SELECT chat_id FROM rating_giocatori)')
+            chat = [r[0] for r in c.fetchall()]
+        for chat_id in chat:
+            self.ricostruisci_rating(chat_id)
+            print(f"[RATING] calcolati i rating della chat {chat_id}")
+
+    def classifica_elo(self, chat_id):
+        with self.transazione() as c:
+            c.execute("""
+                SELECT g.id, g.nome, r.rating, r.partite
+                FROM rating_giocatori r JOIN giocatori g ON g.id = r.giocatore_id
+                WHERE r.chat_id = %s AND r.partite > 0
+                ORDER BY r.rating DESC, g.nome
+            """, (chat_id,))
+            return c.fetchall()
+
+    def ricostruisci_aggregati(self, chat_id):
+        # Ricalcola da zero la tabella aggregata della chat e restituisce quante righe erano incoerenti
+        with self.transazione() as c:
+            c.execute("""
+                SELECT giocatore_id, COUNT(*), SUM(gol), SUM(assist), SUM(vittoria), SUM(pareggio), SUM(sconfitta)
+                FROM prestazioni WHERE chat_id = %s GROUP BY giocatore_id
+            """, (chat_id,))
+            attesi = {r[0]: tuple(int(x) for x in r[1:]) for r in c.fetchall()}
+            c.execute('SELECT giocatore_id, presenze, gol, assist, vittorie, pareggi, sconfitte FROM statistiche_giocatori WHERE chat_id = %s', (chat_id,))
+            salvati = {r[0]: tuple(r[1:]) for r in c.fetchall()}
+            zero = (0, 0, 0, 0, 0, 0)
+            incoerenti = sum(1 for gid in set(attesi) | set(salvati) if attesi.get(gid, zero) != salvati.get(gid, zero))
+            c.execute('DELETE FROM statistiche_giocatori WHERE chat_id = %s', (chat_id,))
+            if attesi:
+                self.esegui_valori(
+                    c,
+                    'INSERT INTO statistiche_giocatori (chat_id, giocatore_id, presenze, gol, assist, vittorie, pareggi, sconfitte) VALUES %s',
+                    [(chat_id, gid) + valori for gid, valori in attesi.items()]
+                )
+            self._nuova_versione(c, chat_id)
+        return len(attesi), incoerenti
+
+# --- Migrazioni dello schema ---
+# Ogni voce viene applicata una sola volta, in ordine, nella propria transazione.
+# Le istruzioni sono idempotenti perché i database esistenti hanno già le tabelle create a mano.
+MIGRAZIONI_POSTGRES = [
+    (1, "tabelle base", [
+        """
+        CREATE TABLE IF NOT EXISTS giocatori (
+            id SERIAL PRIMARY KEY,
+            nome TEXT NOT NULL,
+            chat_id BIGINT NOT NULL,
+            UNIQUE (nome, chat_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS partite (
+            id SERIAL PRIMARY KEY,
+            data TEXT NOT NULL,
+            squadra_a TEXT NOT NULL,
+            squadra_b TEXT NOT NULL,
+            risultato TEXT NOT NULL,
+            chat_id BIGINT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS prestazioni (
+            partita_id INTEGER NOT NULL REFERENCES partite(id) ON DELETE CASCADE,
+            giocatore_id INTEGER NOT NULL REFERENCES giocatori(id) ON DELETE CASCADE,
+            squadra CHAR(1) NOT NULL,
+            gol INTEGER NOT NULL DEFAULT 0,
+            assist INTEGER NOT NULL DEFAULT 0,
+            vittoria INTEGER NOT NULL DEFAULT 0,
+            pareggio INTEGER NOT NULL DEFAULT 0,
+            sconfitta INTEGER NOT NULL DEFAULT 0,
+            chat_id BIGINT NOT NULL,
+            UNIQUE (partita_id, giocatore_id)
+        )
+        """,
+    ]),
+    (2, "vincoli su tabelle create prima delle migrazioni", [
+        """
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'giocatori_nome_chat_id_key') THEN
+                ALTER TABLE giocatori ADD CONSTRAINT giocatori_nome_chat_id_key UNIQUE (nome, chat_id);
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'prestazioni_partita_id_giocatore_id_key') THEN
+                -- Prima del vincolo /nuovapartita accettava lo stesso giocatore due volte in una squadra:
+                -- delle righe doppie (identiche) se ne tiene una sola
+                DELETE FROM prestazioni a USING prestazioni b
+                WHERE a.partita_id = b.partita_id AND a.giocatore_id = b.giocatore_id AND a.ctid > b.ctid;
+                ALTER TABLE prestazioni ADD CONSTRAINT prestazioni_partita_id_giocatore_id_key UNIQUE (partita_id, giocatore_id);
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'prestazioni_partita_id_fkey') THEN
+                ALTER TABLE prestazioni ADD CONSTRAINT prestazioni_partita_id_fkey
+                    FOREIGN KEY (partita_id) REFERENCES partite(id) ON DELETE CASCADE;
+            END IF;
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'prestazioni_giocatore_id_fkey') THEN
+                ALTER TABLE prestazioni ADD CONSTRAINT prestazioni_giocatore_id_fkey
+                    FOREIGN KEY (giocatore_id) REFERENCES giocatori(id) ON DELETE CASCADE;
+            END IF;
+        END $$
+        """,
+    ]),
+    (3, "tabella aggregata statistiche_giocatori", [
+        """
+        CREATE TABLE IF NOT EXISTS statistiche_giocatori (
+            chat_id BIGINT NOT NULL,
+            giocatore_id INTEGER NOT NULL REFERENCES giocatori(id) ON DELETE CASCADE,
+            presenze INTEGER NOT NULL DEFAULT 0,
+            gol INTEGER NOT NULL DEFAULT 0,
+            assist INTEGER NOT NULL DEFAULT 0,
+            vittorie INTEGER NOT NULL DEFAULT 0,
+            pareggi INTEGER NOT NULL DEFAULT 0,
+            sconfitte INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, giocatore_id)
+        )
+        """,
+        """
+        INSERT INTO statistiche_giocatori (chat_id, giocatore_id, presenze, gol, assist, vittorie, pareggi, sconfitte)
+        SELECT chat_id, giocatore_id, COUNT(*), SUM(gol), SUM(assist), SUM(vittoria), SUM(pareggio), SUM(sconfitta)
+        FROM prestazioni GROUP BY chat_id, giocatore_id
+        ON CONFLICT (chat_id, giocatore_id) DO NOTHING
+        """,
+    ]),
+    (4, "indici per le query più frequenti", [
+        # Caricamento statistiche e dettaglio partita: tutte le colonne lette sono nell'indice
+        """
+        CREATE INDEX IF NOT EXISTS prestazioni_chat_partita_idx ON prestazioni (chat_id, partita_id)
+            INCLUDE (giocatore_id, squadra, gol, assist, vittoria, pareggio, sconfitta)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS prestazioni_chat_giocatore_idx ON prestazioni (chat_id, giocatore_id)
+            INCLUDE (partita_id, squadra, gol, assist, vittoria, pareggio, sconfitta)
+        """,
+        "CREATE INDEX IF NOT EXISTS partite_chat_data_idx ON partite (chat_id, data)",
+        "CREATE INDEX IF NOT EXISTS giocatori_chat_nome_idx ON giocatori (chat_id, nome)",
+    ]),
+    (5, "data delle partite come DATE", [
+        # Le date erano salvate come testo GG/MM/AAAA: l'ordinamento era lessicografico
+        """
+        DO $$
+        BEGIN
+            IF (SELECT data_type FROM information_schema.columns
+                WHERE table_name = 'partite' AND column_name = 'data') <> 'date' THEN
+                ALTER TABLE partite ALTER COLUMN data TYPE DATE USING to_date(data, 'DD/MM/YYYY');
+            END IF;
+        END $$
+        """,
+    ]),
+    (6, "indice (chat_id, data, id) per la paginazione di /partite", [
+        # Con id nell'indice anche il tie-break dell'ordinamento keyset viene letto dall'indice
+        "CREATE INDEX IF NOT EXISTS partite_chat_data_id_idx ON partite (chat_id, data, id)",
+        "DROP INDEX IF EXISTS partite_chat_data_idx",
+    ]),
+    (7, "rating Elo e relativo storico", [
+        """
+        CREATE TABLE IF NOT EXISTS rating_giocatori (
+            chat_id BIGINT NOT NULL,
+            giocatore_id INTEGER NOT NULL REFERENCES giocatori(id) ON DELETE CASCADE,
+            rating DOUBLE PRECISION NOT NULL,
+            partite INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, giocatore_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS storico_rating (
+            partita_id INTEGER NOT NULL REFERENCES partite(id) ON DELETE CASCADE,
+            giocatore_id INTEGER NOT NULL REFERENCES giocatori(id) ON DELETE CASCADE,
+            prima DOUBLE PRECISION NOT NULL,
+            dopo DOUBLE PRECISION NOT NULL,
+            chat_id BIGINT NOT NULL,
+            PRIMARY KEY (partita_id, giocatore_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS storico_rating_chat_giocatore_idx ON storico_rating (chat_id, giocatore_id)",
+        # I rating delle partite già salvate li calcola inizializza_rating() all'avvio
+    ]),
+    (8, "versione dei dati per chat", [
+        # Incrementata da ogni scrittura, nella stessa transazione: le cache di tutti i processi la confrontano
+        """
+        CREATE TABLE IF NOT EXISTS versioni_chat (
+            chat_id BIGINT PRIMARY KEY,
+            versione BIGINT NOT NULL
+        )
+        """,
+    ]),
+]
+
+# Query calde da verificare con EXPLAIN: (descrizione, sql, parametri, indici accettati)
+QUERY_INDICIZZATE = [
+    ("statistiche: storico della chat (partite e prestazioni)",
+     'SELECT p.id, p.data, p.squadra_a, p.squadra_b, p.risultato, pr.giocatore_id, g.nome, pr.squadra, pr.gol, pr.assist FROM partite p JOIN prestazioni pr ON pr.partita_id = p.id JOIN giocatori g ON g.id = pr.giocatore_id WHERE p.chat_id = %s ORDER BY p.data, p.id',
+     (0,), ['partite_chat_data_id_idx']),
+    ("statistiche: storico di una stagione (a cache fredda)",
+     'SELECT p.id, p.data, p.squadra_a, p.squadra_b, p.risultato, pr.giocatore_id, g.nome, pr.squadra, pr.gol, pr.assist FROM partite p JOIN prestazioni pr ON pr.partita_id = p.id JOIN giocatori g ON g.id = pr.giocatore_id WHERE p.chat_id = %s AND p.data >= %s AND p.data <= %s ORDER BY p.data, p.id',
+     (0, date(2024, 9, 1), date(2025, 8, 31)), ['partite_chat_data_id_idx']),
+    ("forma: totali per giocatore",
+     'SELECT giocatore_id, presenze, gol FROM statistiche_giocatori WHERE chat_id = %s AND presenze > 0',
+     (0,), ['statistiche_giocatori_pkey']),
+    ("partite: pagina keyset all'indietro",
+     'SELECT id, data, squadra_a, squadra_b, risultato FROM partite WHERE chat_id = %s AND (data, id) < (%s, %s) ORDER BY data DESC, id DESC LIMIT %s',
+     (0, date(2024, 1, 1), 0, 11), ['partite_chat_data_id_idx']),
+    ("partite / esportazione: pagina keyset in avanti in una stagione",
+     'SELECT id, data, squadra_a, squadra_b, risultato FROM partite WHERE chat_id = %s AND data >= %s AND data <= %s AND (data, id) > (%s, %s) ORDER BY data, id LIMIT %s',
+     (0, date(2024, 9, 1), date(2025, 8, 31), date(2024, 9, 1), 0, 11), ['partite_chat_data_id_idx']),
+    ("scheda: compagni e avversari del giocatore",
+     'SELECT altri.giocatore_id, COUNT(*) FROM prestazioni mio JOIN prestazioni altri ON altri.partita_id = mio.partita_id WHERE mio.chat_id = %s AND mio.giocatore_id = %s GROUP BY altri.giocatore_id',
+     (0, 0), ['prestazioni_chat_giocatore_idx']),
+    ("mostra_partita: partita per data",
+     'SELECT id, squadra_a, squadra_b, risultato FROM partite WHERE data = %s AND chat_id = %s',
+     (date(2024, 1, 1), 0), ['partite_chat_data_id_idx']),
+    ("mostra_partita / modifica_valore: prestazioni della partita",
+     'SELECT giocatori.nome, prestazioni.gol, prestazioni.assist, prestazioni.squadra FROM prestazioni JOIN giocatori ON prestazioni.giocatore_id = giocatori.id WHERE partita_id = %s AND prestazioni.chat_id = %s',
+     (0, 0), ['prestazioni_chat_partita_idx', 'prestazioni_partita_id_giocatore_id_key']),
+    ("modifica_valore: partita per id",
+     'SELECT squadra_a, squadra_b, risultato, data FROM partite WHERE id = %s AND chat_id = %s',
+     (0, 0), ['partite_pkey']),
+    ("salva_partita / modifica_valore / importazione: id dei giocatori",
+     'SELECT nome, id FROM giocatori WHERE chat_id = %s AND nome IN (%s, %s)',
+     (0, 'x', 'y'), ['giocatori_chat_nome_idx', 'giocatori_nome_chat_id_key']),
+]
+
+
+class PostgresStorage(Storage):
+    MIGRAZIONI = MIGRAZIONI_POSTGRES
+    DDL_MIGRAZIONI = """
+        CREATE TABLE IF NOT EXISTS schema_migrazioni (
+            versione INTEGER PRIMARY KEY,
+            descrizione TEXT NOT NULL,
+            applicata_il TIMESTAMPTZ NOT NULL DEFAULT now()
+        )
+    """
+
+    def __init__(self, dsn, minconn, maxconn):
+        self.maxconn = maxconn
+        self.pool = psycopg2.pool.ThreadedConnectionPool(minconn, maxconn, dsn)
+        # Nomi univoci per i cursori lato server di scorri()
+        self.cursori = count()
+
+    def chiudi(self):
+        self.pool.closeall()
+
+    def _connessione_valida(self, conn):
+        # Health check al prelievo: scarta le connessioni cadute (es. riavvio del database)
+        if conn.closed:
+            return False
+        try:
+            with conn.cursor() as c:
+                c.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _preleva_connessione(self):
+        # Al massimo maxconn tentativi: dopo un riavvio del database tutte le connessioni del pool possono essere morte
+        for _ in range(self.maxconn):
+            conn = self.pool.getconn()
+            if self._connessione_valida(conn):
+                return conn
+            self.pool.putconn(conn, close=True)
+        return self.pool.getconn()
+
+    @contextmanager
+    def transazione(self):
+        with metriche.cronometro('calcetto_db_connessione_secondi', backend='postgres'):
+            conn = self._preleva_connessione()
+        try:
+            with conn.cursor() as c:
+                yield Cursore(c)
+            conn.commit()
+        except Exception:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                pass
+            raise
+        finally:
+            self.pool.putconn(conn, close=bool(conn.closed))
+
+    def esegui_valori(self, c, sql, righe):
+        with c.misura(sql):
+            psycopg2.extras.execute_values(c.cursore, sql, righe)
+
+    def copia_righe(self, c, tabella, colonne, righe):
+        # COPY ... FROM STDIN: il blocco viaggia come un unico flusso di testo, senza un INSERT per riga
+        buffer = io.StringIO()
+        for riga in righe:
+            buffer.write('\t'.join(valore_copy(v) for v in riga) + '\n')
+        buffer.seek(0)
+        sql = f'COPY {tabella} ({", ".join(colonne)}) FROM STDIN'
+        with c.misura(sql):
+            c.cursore.copy_expert(sql, buffer)
+
+    def scorri(self, c, sql, parametri=(), blocco=STATISTICHE_BLOCCO):
+        # Cursore con nome (lato server): PostgreSQL tiene il risultato e lo consegna
+        # a blocchi di `blocco` righe, invece di trasferirlo tutto alla prima fetch
+        cursore = c.cursore.connection.cursor(name=f"scorri_{next(self.cursori)}")
+        cursore.itersize = blocco
+        try:
+            with c.misura(sql):
+                cursore.execute(sql, parametri)
+            while True:
+                righe = cursore.fetchmany(blocco)
+                if not righe:
+                    return
+                yield from righe
+        finally:
+            cursore.close()
+
+    def _riserva_id_partite(self, c, n):
+        c.execute("SELECT nextval(pg_get_serial_sequence('partite', 'id')) FROM generate_series(1, %s)", (n,))
+        return [r[0] for r in c.fetchall()]
+
+    def _blocca_migrazioni(self, c):
+        # Evita che due istanze applichino la stessa migrazione in contemporanea
+        c.execute('SELECT pg_advisory_xact_lock(%s)', (0x63616c63,))
+
+    def verifica_indici(self):
+        # Con le sequential scan disabilitate il planner deve poter usare un indice per ogni query calda
+        esito = True
+        with self.transazione() as c:
+            c.execute('SET LOCAL enable_seqscan = off')
+            for descrizione, sql, parametri, indici in QUERY_INDICIZZATE:
+                c.execute('EXPLAIN ' + sql, parametri)
+                piano = "\n".join(r[0] for r in c.fetchall())
+                ok = any(indice in piano for indice in indici)
+                esito = esito and ok
+                print(f"[{'OK' if ok else 'NO'}] {descrizione}")
+                if not ok:
+                    print(piano)
+        return esito
+
+# Schema completo per i database SQLite, che nascono già con la struttura attuale
+MIGRAZIONI_SQLITE = [
+    (1, "schema iniziale", [
+        """
+        CREATE TABLE giocatori (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            nome TEXT NOT NULL,
+            chat_id INTEGER NOT NULL,
+            UNIQUE (nome, chat_id)
+        )
+        """,
+        """
+        CREATE TABLE partite (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            data DATE NOT NULL,
+            squadra_a TEXT NOT NULL,
+            squadra_b TEXT NOT NULL,
+            risultato TEXT NOT NULL,
+            chat_id INTEGER NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE prestazioni (
+            partita_id INTEGER NOT NULL REFERENCES partite(id) ON DELETE CASCADE,
+            giocatore_id INTEGER NOT NULL REFERENCES giocatori(id) ON DELETE CASCADE,
+            squadra CHAR(1) NOT NULL,
+            gol INTEGER NOT NULL DEFAULT 0,
+            assist INTEGER NOT NULL DEFAULT 0,
+            vittoria INTEGER NOT NULL DEFAULT 0,
+            pareggio INTEGER NOT NULL DEFAULT 0,
+            sconfitta INTEGER NOT NULL DEFAULT 0,
+            chat_id INTEGER NOT NULL,
+            UNIQUE (partita_id, giocatore_id)
+        )
+        """,
+        """
+        CREATE TABLE statistiche_giocatori (
+            chat_id INTEGER NOT NULL,
+            giocatore_id INTEGER NOT NULL REFERENCES giocatori(id) ON DELETE CASCADE,
+            presenze INTEGER NOT NULL DEFAULT 0,
+            gol INTEGER NOT NULL DEFAULT 0,
+            assist INTEGER NOT NULL DEFAULT 0,
+            vittorie INTEGER NOT NULL DEFAULT 0,
+            pareggi INTEGER NOT NULL DEFAULT 0,
+            sconfitte INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, giocatore_id)
+        )
+        """,
+        "CREATE INDEX prestazioni_chat_partita_idx ON prestazioni (chat_id, partita_id)",
+        "CREATE INDEX prestazioni_chat_giocatore_idx ON prestazioni (chat_id, giocatore_id)",
+        "CREATE INDEX partite_chat_data_idx ON partite (chat_id, data)",
+        "CREATE INDEX giocatori_chat_nome_idx ON giocatori (chat_id, nome)",
+    ]),
+    (2, "indice (chat_id, data, id) per la paginazione di /partite", [
+        "CREATE INDEX partite_chat_data_id_idx ON partite (chat_id, data, id)",
+        "DROP INDEX partite_chat_data_idx",
+    ]),
+    (3, "rating Elo e relativo storico", [
+        """
+        CREATE TABLE rating_giocatori (
+            chat_id INTEGER NOT NULL,
+            giocatore_id INTEGER NOT NULL REFERENCES giocatori(id) ON DELETE CASCADE,
+            rating REAL NOT NULL,
+            partite INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_id, giocatore_id)
+        )
+        """,
+        """
+        CREATE TABLE storico_rating (
+            partita_id INTEGER NOT NULL REFERENCES partite(id) ON DELETE CASCADE,
+            giocatore_id INTEGER NOT NULL REFERENCES giocatori(id) ON DELETE CASCADE,
+            prima REAL NOT NULL,
+            dopo REAL NOT NULL,
+            chat_id INTEGER NOT NULL,
+            PRIMARY KEY (partita_id, giocatore_id)
+        )
+        """,
+        "CREATE INDEX storico_rating_chat_giocatore_idx ON storico_rating (chat_id, giocatore_id)",
+    ]),
+    (4, "versione dei dati per chat", [
+        """
+        CREATE TABLE versioni_chat (
+            chat_id INTEGER PRIMARY KEY,
+            versione INTEGER NOT NULL
+        )
+        """,
+    ]),
+]
+
+class SqliteStorage(Storage):
+    # Backend embedded per uso locale e benchmark: nessun server, un file (o ":memory:")
+    MIGRAZIONI = MIGRAZIONI_SQLITE
+
+    def __init__(self, percorso):
+        sqlite3.register_adapter(date, date.isoformat)
+        sqlite3.register_converter("DATE", lambda v: date.fromisoformat(v.decode()))
+        # Una sola connessione condivisa dai thread di db_executor, serializzata dal lock
+        self.conn = sqlite3.connect(percorso, detect_types=sqlite3.PARSE_DECLTYPES, check_same_thread=False, isolation_level=None)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        if percorso != ':memory:':
+            self.conn.execute('PRAGMA journal_mode = WAL')
+        self.lock = threading.Lock()
+
+    def chiudi(self):
+        self.conn.close()
+
+    @contextmanager
+    def transazione(self):
+        with metriche.cronometro('calcetto_db_connessione_secondi', backend='sqlite'):
+            self.lock.acquire()
+        try:
+            c = self.conn.cursor()
+            c.execute('BEGIN')
+            try:
+                yield Cursore(c, '?')
+                c.execute('COMMIT')
+            except Exception:
+                c.execute('ROLLBACK')
+                raise
+            finally:
+                c.close()
+        finally:
+            self.lock.release()
+
+    def esegui_valori(self, c, sql, righe, pagina=500):
+        for i in range(0, len(righe), pagina):
+            blocco = righe[i:i + pagina]
+            valori = ", ".join(segnaposti_in(r) for r in blocco)
+            c.execute(sql.replace('VALUES %s', 'VALUES ' + valori), [x for r in blocco for x in r])
+
+    def _riserva_id_partite(self, c, n):
+        # La transazione tiene il lock della connessione: nessun altro può inserire partite nel frattempo
+        c.execute("SELECT MAX(id) FROM partite")
+        ultimo = c.fetchone()[0] or 0
+        c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'partite'")
+        row = c.fetchone()
+        ultimo = max(ultimo, row[0] if row else 0)
+        return range(ultimo + 1, ultimo + n + 1)
+
+db = None
+
+def init_db():
+    global db
+    if db is None:
+        if STORAGE == 'sqlite':
+            db = SqliteStorage(SQLITE_PATH)
+        elif STORAGE == 'postgres':
+            db = PostgresStorage(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX)
+        else:
+            raise ValueError(f"STORAGE non supportato: {STORAGE}")
+    return db
+
+def chiudi_db():
+    global db
+    if db is not None:
+        db.chiudi()
+        db = None
+
+pdf_executor = None
+
+def init_pdf_executor():
+    global pdf_executor
+    if pdf_executor is None:
+        # "spawn": i worker non ereditano thread, connessioni o stato del bot
+        pdf_executor = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return pdf_executor
+
+def chiudi_pdf_executor():
+    global pdf_executor
+    if pdf_executor is not None:
+        pdf_executor.shutdown(cancel_futures=True)
+        pdf_executor = None
+
+async def esegui_pdf(func, *args):
+    # Il rendering ReportLab è CPU-bound: gira in un processo worker e restituisce i byte del PDF
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(init_pdf_executor(), func, *args)
+
+async def esegui_pdf_cronometrato(fase, func, *args):
+    # Il tempo include l'attesa di un worker libero e il trasferimento dei dati tra processi
+    with metriche.cronometro('calcetto_report_fase_secondi', fase=fase):
+        return await esegui_pdf(func, *args)
+
+async def esegui_db(func, *args, **kwargs):
+    # Esegue una funzione sincrona di accesso al database senza bloccare l'event loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, partial(func, *args, **kwargs))
+
+# Le tre cache marcano ogni voce con la versione dei dati della chat (Storage.versione_dati)
+# letta prima di caricarla, e la servono solo se coincide con quella corrente nel database:
+# così vedono anche le scritture fatte da altri processi, come --importa.
+
+class ReportCache:
+    # Cache LRU dei PDF per chat, limitata in byte
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.voci = OrderedDict()  # chiave -> (versione, documenti)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, chiave, versione):
+        with self.lock:
+            voce = self.voci.get(chiave)
+            if voce is None or voce[0] != versione:
+                self.misses += 1
+                return None
+            self.voci.move_to_end(chiave)
+            self.hits += 1
+            return voce[1]
+
+    def put(self, chiave, versione, documenti):
+        dimensione = sum(len(d) for d in documenti)
+        if dimensione > self.max_bytes:
+            return
+        with self.lock:
+            vecchia = self.voci.pop(chiave, None)
+            if vecchia is not None:
+                self.bytes -= sum(len(d) for d in vecchia[1])
+            self.voci[chiave] = (versione, documenti)
+            self.bytes += dimensione
+            while self.bytes > self.max_bytes:
+                _, (_, rimossi) = self.voci.popitem(last=False)
+                self.bytes -= sum(len(d) for d in rimossi)
+
+    def riepilogo(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'voci': len(self.voci), 'bytes': self.bytes}
+
+report_cache = ReportCache(int(REPORT_CACHE_MB * 1024 * 1024))
+
+# Roster per chat (nome -> id): i giocatori non vengono mai rinominati né cancellati,
+# quindi basta aggiungere i nuovi dopo ogni inserimento. Il TTL è solo una rete di sicurezza.
+
+class RosterCache:
+    # LRU sulle chat con scadenza per voce
+    def __init__(self, max_chat, ttl):
+        self.max_chat = max_chat
+        self.ttl = ttl
+        self.voci = OrderedDict()  # chat_id -> (scadenza, versione, {nome: id})
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, chat_id, versione=None):
+        # Senza versione va bene qualunque roster non scaduto: può mancare dei giocatori più
+        # recenti, ma gli id che contiene sono validi
+        with self.lock:
+            voce = self.voci.get(chat_id)
+            if voce is None or voce[0] < time.monotonic():
+                self.voci.pop(chat_id, None)
+                self.misses += 1
+                return None
+            if versione is not None and voce[1] != versione:
+                self.misses += 1
+                return None
+            self.voci.move_to_end(chat_id)
+            self.hits += 1
+            return voce[2]
+
+    def put(self, chat_id, versione, roster):
+        # Non sostituisce un roster di una versione più recente, messo in cache nel frattempo
+        with self.lock:
+            voce = self.voci.get(chat_id)
+            if voce is not None and voce[1] > versione:
+                return
+            self.voci[chat_id] = (time.monotonic() + self.ttl, versione, dict(roster))
+            self.voci.move_to_end(chat_id)
+            while len(self.voci) > self.max_chat:
+                self.voci.popitem(last=False)
+
+    def aggiungi(self, chat_id, versione, giocatori):
+        # Write-through dopo il commit della scrittura che ha prodotto `versione`, senza allungare
+        # la scadenza. Si applica solo al roster della versione immediatamente precedente: se in mezzo
+        # c'è stata un'altra scrittura (anche di un altro processo) il roster viene scartato.
+        # Il dizionario viene sostituito, non modificato: chi lo sta leggendo non lo vede cambiare.
+        with self.lock:
+            voce = self.voci.get(chat_id)
+            if voce is None or voce[1] >= versione:
+                return
+            if voce[1] == versione - 1:
+                self.voci[chat_id] = (voce[0], versione, {**voce[2], **giocatori})
+            else:
+                del self.voci[chat_id]
+
+    def invalida(self, chat_id):
+        with self.lock:
+            self.voci.pop(chat_id, None)
+
+    def riepilogo(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'voci': len(self.voci)}
+
+roster_cache = RosterCache(ROSTER_CHAT_MAX, ROSTER_TTL)
+
+# Storico colonnare per chat usato da /statistiche: tenuto in memoria per le chat più attive
+# e aggiornato in place dalle scritture, così il report non rilegge tutte le prestazioni
+
+# Finestre della forma (ultime N partite di ogni giocatore), dalla più corta alla più lunga
+FINESTRE_FORMA = (5, 10, 20)
+
+class FormaGiocatore:
+    # Finestra scorrevole sulle ultime partite di un giocatore, (esito, gol, assist) dalla più
+    # vecchia alla più recente, e serie in corso di vittorie e di risultati utili
+    __slots__ = ('ultime', 'serie_vittorie', 'serie_imbattuto')
+
+    def __init__(self):
+        self.ultime = deque(maxlen=FINESTRE_FORMA[-1])
+        self.serie_vittorie = 0
+        self.serie_imbattuto = 0
+
+    def aggiungi(self, esito, gol, assist):
+        self.ultime.append((esito, gol, assist))
+        self.serie_vittorie = self.serie_vittorie + 1 if esito == 1 else 0
+        self.serie_imbattuto = self.serie_imbattuto + 1 if esito >= 0 else 0
+
+    def finestra(self, n):
+        # (partite, vittorie, pareggi, sconfitte, gol, assist) delle ultime n partite
+        ultime = list(self.ultime)[-n:]
+        esiti = Counter(e for e, _, _ in ultime)
+        return (len(ultime), esiti[1], esiti[0], esiti[-1], sum(g for _, g, _ in ultime), sum(a for _, _, a in ultime))
+
+    def sequenza(self, n=10):
+        # "VVPSV": esiti delle ultime n partite, la più recente a destra
+        return "".join("SPV"[e + 1] for e, _, _ in list(self.ultime)[-n:])
+
+def chiudi_forma(stato):
+    # Da (ultime dalla più recente, _, serie) raccolti scorrendo all'indietro a FormaGiocatore
+    ultime, _, serie = stato
+    forma = FormaGiocatore()
+    forma.ultime.extend(reversed(ultime))
+    forma.serie_vittorie, forma.serie_imbattuto = serie
+    return forma
+
+def riepilogo_forma(forma):
+    # Copia piatta della forma, leggibile fuori dal lock dello storico
+    return {
+        'finestre': {n: forma.finestra(n) for n in FINESTRE_FORMA},
+        'sequenza': forma.sequenza(),
+        'serie_vittorie': forma.serie_vittorie,
+        'serie_imbattuto': forma.serie_imbattuto,
+    }
+
+def testo_finestra(finestra):
+    # "3-1-1": vittorie, pareggi e sconfitte nella finestra
+    partite, vittorie, pareggi, sconfitte, _, _ = finestra
+    return f"{vittorie}-{pareggi}-{sconfitte}" if partite else "-"
+
+def punti_per_partita(finestra):
+    partite, vittorie, pareggi, _, _, _ = finestra
+    return (3 * vittorie + pareggi) / partite if partite else 0
+
+class StoricoChat:
+    # Partite di una chat in colonne compatte (modulo array), in ordine cronologico (data, id).
+    # Per partita: id, giorno (ordinale della data), gol delle due squadre e prima riga.
+    # Per prestazione: indice del giocatore, squadra (0 = A, 1 = B), gol, assist ed esito
+    # (1 vittoria, 0 pareggio, -1 sconfitta). Le righe di una partita sono contigue e
+    # nell'ordine delle formazioni. Letture e scritture vanno fatte tenendo self.lock.
+    COLONNE_PARTITE = ('partita', 'giorno', 'gol_a', 'gol_b')
+    COLONNE_RIGHE = ('giocatore', 'squadra', 'gol', 'assist', 'esito')
+
+    def __init__(self):
+        self.partita = array('q')
+        self.giorno = array('i')
+        self.gol_a = array('H')
+        self.gol_b = array('H')
+        self.inizio = array('i', [0])  # righe della partita m: inizio[m] .. inizio[m + 1]
+        self.giocatore = array('H')
+        self.squadra = array('b')
+        self.gol = array('H')
+        self.assist = array('H')
+        self.esito = array('b')
+        self.giocatori = array('q')  # indice -> giocatore_id
+        self.indici = {}  # giocatore_id -> indice
+        self.posizioni = {}  # partita_id -> indice della partita
+        # Forma per indice di giocatore: aggiornata a ogni partita aggiunta in fondo; le modifiche
+        # al passato segnano solo i giocatori coinvolti, ricalcolati alla prima lettura
+        self.forma = {}
+        self.forma_da_ricalcolare = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.partita)
+
+    def _indice(self, gid):
+        i = self.indici.get(gid)
+        if i is None:
+            i = self.indici[gid] = len(self.giocatori)
+            self.giocatori.append(gid)
+        return i
+
+    def _sposta(self, m, delta):
+        # Dopo un inserimento o una rimozione in posizione m: righe e posizioni delle partite successive
+        for k in range(m + 1, len(self.inizio)):
+            self.inizio[k] += delta
+        for k in range(m, len(self.partita)):
+            self.posizioni[self.partita[k]] = k
+
+    def inserisci(self, partita_id, data, risultato, righe):
+        # righe: [(giocatore_id, 'A'/'B', gol, assist)] nell'ordine delle formazioni. In fondo allo
+        # storico è un append; una partita retrodatata sposta le colonne successive. Una partita
+        # già presente viene sostituita, quindi ripetere l'operazione non cambia il risultato.
+        # Tutti i nuovi valori vengono convertiti prima di toccare le colonne: se uno non entra
+        # nel tipo della colonna (es. gol negativi) lo storico resta com'era.
+        gol_a, gol_b = parse_risultato(risultato)
+        giorno = data.toordinal()
+        esiti = {'A': (gol_a > gol_b) - (gol_a < gol_b), 'B': (gol_b > gol_a) - (gol_b < gol_a)}
+        valori_partita = [array(getattr(self, nome).typecode, [valore]) for nome, valore in
+                          zip(self.COLONNE_PARTITE, (partita_id, giorno, gol_a, gol_b))]
+        valori_righe = [
+            array('b', [sq == 'B' for _, sq, _, _ in righe]),
+            array('H', [g for _, _, g, _ in righe]),
+            array('H', [a for _, _, _, a in righe]),
+            array('b', [esiti[sq] for _, sq, _, _ in righe]),
+        ]
+        indici = array('H', [self._indice(gid) for gid, *_ in righe])
+        self.rimuovi(partita_id)
+        m = bisect_right(self.giorno, giorno)
+        while m > 0 and self.giorno[m - 1] == giorno and self.partita[m - 1] > partita_id:
+            m -= 1
+        in_fondo = m == len(self.partita)
+        r = self.inizio[m]
+        for nome, valori in zip(self.COLONNE_RIGHE, [indici] + valori_righe):
+            getattr(self, nome)[r:r] = valori
+        for nome, valore in zip(self.COLONNE_PARTITE, valori_partita):
+            getattr(self, nome)[m:m] = valore
+        self.inizio.insert(m + 1, r)
+        self._sposta(m, len(righe))
+        if not in_fondo:
+            self._segna_forma(indici)
+            return
+        for i, (_, sq, g, a) in zip(indici, righe):
+            if i not in self.forma_da_ricalcolare:
+                forma = self.forma.get(i)
+                if forma is None:
+                    forma = self.forma[i] = FormaGiocatore()
+                forma.aggiungi(esiti[sq], g, a)
+
+    def rimuovi(self, partita_id):
+        m = self.posizioni.pop(partita_id, None)
+        if m is None:
+            return
+        r0, r1 = self.inizio[m], self.inizio[m + 1]
+        self._segna_forma(self.giocatore[r0:r1])
+        for nome in self.COLONNE_RIGHE:
+            del getattr(self, nome)[r0:r1]
+        for nome in self.COLONNE_PARTITE:
+            del getattr(self, nome)[m]
+        del self.inizio[m + 1]
+        self._sposta(m, r0 - r1)
+
+    def imposta_valori(self, partita_id, campo, valori):
+        # valori: giocatore_id -> nuovo numero di gol (o di assist) nella partita
+        m = self.posizioni.get(partita_id)
+        if m is None:
+            return
+        colonna = self.gol if campo == 'gol' else self.assist
+        valori = dict(zip(valori, array(colonna.typecode, valori.values())))
+        self._segna_forma(self.giocatore[self.inizio[m]:self.inizio[m + 1]])
+        for r in range(self.inizio[m], self.inizio[m + 1]):
+            gid = self.giocatori[self.giocatore[r]]
+            if gid in valori:
+                colonna[r] = valori[gid]
+
+    def imposta_risultato(self, partita_id, risultato):
+        m = self.posizioni.get(partita_id)
+        if m is None:
+            return
+        gol_a, gol_b = array(self.gol_a.typecode, parse_risultato(risultato))
+        self.gol_a[m], self.gol_b[m] = gol_a, gol_b
+        esiti = ((gol_a > gol_b) - (gol_a < gol_b), (gol_b > gol_a) - (gol_b < gol_a))
+        self._segna_forma(self.giocatore[self.inizio[m]:self.inizio[m + 1]])
+        for r in range(self.inizio[m], self.inizio[m + 1]):
+            self.esito[r] = esiti[self.squadra[r]]
+
+    def _segna_forma(self, indici):
+        for i in indici:
+            self.forma.pop(i, None)
+            self.forma_da_ricalcolare.add(i)
+
+    def forme(self, m0=0, m1=None):
+        # giocatore_id -> FormaGiocatore. Su tutto lo storico è quella mantenuta a ogni scrittura:
+        # i giocatori segnati vengono ricalcolati qui, con una sola scansione all'indietro.
+        # Sulle partite [m0, m1) è la forma alla fine dell'intervallo contando solo quelle partite.
+        if m1 is not None and (m0, m1) != (0, len(self.partita)):
+            forme = self._scansione_forme(None, self.inizio[m0], self.inizio[m1])
+            return {self.giocatori[i]: forma for i, forma in forme.items()}
+        if self.forma_da_ricalcolare:
+            self.forma.update(self._scansione_forme(self.forma_da_ricalcolare, 0, len(self.giocatore)))
+            self.forma_da_ricalcolare.clear()
+        return {self.giocatori[i]: forma for i, forma in self.forma.items()}
+
+    def _scansione_forme(self, indici, r0, r1):
+        # Dalla riga r1 - 1 indietro fino a r0. Con indici dati la scansione si ferma appena per
+        # ognuno la finestra più lunga è piena e le serie in corso si sono interrotte; con None
+        # vale per tutti i giocatori incontrati e percorre l'intero intervallo.
+        aperti = {i: ([], [True, True], [0, 0]) for i in indici or ()}
+        chiusi = {}
+        finestra = FINESTRE_FORMA[-1]
+        for r in range(r1 - 1, r0 - 1, -1):
+            i = self.giocatore[r]
+            stato = aperti.get(i)
+            if stato is None:
+                if indici is not None or i in chiusi:
+                    continue
+                stato = aperti[i] = ([], [True, True], [0, 0])
+            ultime, attive, serie = stato
+            esito = self.esito[r]
+            if len(ultime) < finestra:
+                ultime.append((esito, self.gol[r], self.assist[r]))
+            for k, continua in enumerate((esito == 1, esito >= 0)):
+                if attive[k]:
+                    if continua:
+                        serie[k] += 1
+                    else:
+                        attive[k] = False
+            if len(ultime) == finestra and not any(attive):
+                chiusi[i] = chiudi_forma(stato)
+                del aperti[i]
+                if not aperti and indici is not None:
+                    break
+        for i, stato in aperti.items():
+            if stato[0]:
+                chiusi[i] = chiudi_forma(stato)
+        return chiusi
+
+    def intervallo(self, periodo):
+        # Partite [m0, m1) del periodo: le date sono ordinate, basta una ricerca binaria
+        if periodo is None:
+            return 0, len(self.partita)
+        dal, al = periodo
+        m0 = bisect_left(self.giorno, dal.toordinal())
+        m1 = bisect_right(self.giorno, al.toordinal()) if al else len(self.partita)
+        return m0, max(m0, m1)
+
+    def totali(self, m0, m1):
+        # giocatore_id -> (presenze, gol, assist, vittorie, pareggi, sconfitte), per colonne:
+        # presenze ed esiti contati in C da Counter, gol e assist in una passata ciascuno
+        r0, r1 = self.inizio[m0], self.inizio[m1]
+        giocatore = self.giocatore[r0:r1]
+        presenze = Counter(giocatore)
+        esiti = Counter(zip(giocatore, self.esito[r0:r1]))
+        somme = []
+        for colonna in (self.gol, self.assist):
+            somma = [0] * len(self.giocatori)
+            for i, x in zip(giocatore, colonna[r0:r1]):
+                somma[i] += x
+            somme.append(somma)
+        return {
+            self.giocatori[i]: (n, somme[0][i], somme[1][i], esiti[i, 1], esiti[i, 0], esiti[i, -1])
+            for i, n in presenze.items()
+        }
+
+    def coppie(self, m0, m1):
+        # Matrici compagni/avversari con bitset: per ogni giocatore un intero con un bit per
+        # (partita, squadra) giocata. Le partite insieme sono il popcount dell'AND tra due
+        # giocatori, quelle contro l'AND con la maschera dell'altro a squadre scambiate.
+        # Risultato: giocatore_id -> {giocatore_id: partite}, per compagni e per avversari.
+        n_byte = (2 * (m1 - m0) + 7) // 8
+        buffer = {}
+        for m in range(m0, m1):
+            bit_partita = 2 * (m - m0)
+            r0, r1 = self.inizio[m], self.inizio[m + 1]
+            for i, sq in zip(self.giocatore[r0:r1], self.squadra[r0:r1]):
+                b = buffer.get(i)
+                if b is None:
+                    b = buffer[i] = bytearray(n_byte)
+                bit = bit_partita + sq
+                b[bit >> 3] |= 1 << (bit & 7)
+        pari = int.from_bytes(b'\x55' * n_byte, 'little')
+        maschere = [(self.giocatori[i], int.from_bytes(b, 'little')) for i, b in buffer.items()]
+        scambiate = [((x & pari) << 1) | ((x >> 1) & pari) for _, x in maschere]
+        compagni, avversari = defaultdict(dict), defaultdict(dict)
+        for k, (gid, x) in enumerate(maschere):
+            for h in range(k + 1, len(maschere)):
+                altro, y = maschere[h]
+                insieme = (x & y).bit_count()
+                if insieme:
+                    compagni[gid][altro] = compagni[altro][gid] = insieme
+                contro = (x & scambiate[h]).bit_count()
+                if contro:
+                    avversari[gid][altro] = avversari[altro][gid] = contro
+        return compagni, avversari
+
+    def righe_partite(self, m0, m1, nomi):
+        # Righe del PDF partite: squadre nell'ordine delle formazioni, marcatori e assist per squadra e nome
+        nomi_indice = [nomi.get(gid, '?') for gid in self.giocatori]
+        date_formattate = {}
+        righe = []
+        for m in range(m0, m1):
+            r0, r1 = self.inizio[m], self.inizio[m + 1]
+            squadre = ([], [])
+            dettaglio = []
+            for i, sq, g, a in zip(self.giocatore[r0:r1], self.squadra[r0:r1], self.gol[r0:r1], self.assist[r0:r1]):
+                squadre[sq].append(nomi_indice[i])
+                if g or a:
+                    dettaglio.append((sq, nomi_indice[i], g, a))
+            dettaglio.sort()
+            marcatori = [f"{nome} ({g})" for _, nome, g, a in dettaglio if g > 0]
+            assistman = [f"{nome} ({a})" for _, nome, g, a in dettaglio if a > 0]
+            giorno = self.giorno[m]
+            data = date_formattate.get(giorno)
+            if data is None:
+                data = date_formattate[giorno] = formatta_data(date.fromordinal(giorno))
+            righe.append([
+                data,
+                ", ".join(squadre[0]),
+                ", ".join(squadre[1]),
+                f"{self.gol_a[m]}-{self.gol_b[m]}",
+                "<br/>".join(marcatori) if marcatori else "-",
+                "<br/>".join(assistman) if assistman else "-"
+            ])
+        return righe
+
+    def memoria(self):
+        # Byte occupati: buffer delle colonne più i due dizionari di indici
+        colonne = self.COLONNE_PARTITE + self.COLONNE_RIGHE + ('inizio', 'giocatori')
+        return (sum(len(getattr(self, c)) * getattr(self, c).itemsize for c in colonne)
+                + sys.getsizeof(self.indici) + sys.getsizeof(self.posizioni)
+                + sum(sys.getsizeof(f.ultime) + sys.getsizeof(f) for f in self.forma.values()))
+
+class StoricoCache:
+    # LRU degli storici per chat, aggiornati in place dalle scritture
+    def __init__(self, max_chat):
+        self.max_chat = max_chat
+        self.voci = OrderedDict()  # chat_id -> (versione, StoricoChat)
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, chat_id, versione):
+        with self.lock:
+            voce = self.voci.get(chat_id)
+            if voce is None or voce[0] != versione:
+                self.misses += 1
+                return None
+            self.voci.move_to_end(chat_id)
+            self.hits += 1
+            return voce[1]
+
+    def put(self, chat_id, versione, storico):
+        # Non sostituisce uno storico di una versione più recente, messo in cache nel frattempo
+        with self.lock:
+            voce = self.voci.get(chat_id)
+            if voce is not None and voce[0] > versione:
+                return
+            self.voci[chat_id] = (versione, storico)
+            self.voci.move_to_end(chat_id)
+            while len(self.voci) > self.max_chat:
+                self.voci.popitem(last=False)
+
+    def _scarta(self, chat_id, voce):
+        with self.lock:
+            if self.voci.get(chat_id) is voce:
+                del self.voci[chat_id]
+
+    def aggiorna(self, chat_id, versione, operazione, *args):
+        # Write-through dopo il commit della scrittura che ha prodotto `versione`. Si applica solo
+        # allo storico della versione immediatamente precedente: se in mezzo c'è stata un'altra
+        # scrittura (anche di un altro processo) lo storico viene scartato. Le operazioni sono
+        # idempotenti: applicarle a uno storico caricato quando la scrittura era già visibile lo
+        # lascia invariato. Se l'operazione fallisce lo storico viene scartato: la prossima lettura
+        # lo ricarica dal database.
+        with self.lock:
+            voce = self.voci.get(chat_id)
+        if voce is None or voce[0] >= versione:
+            return
+        if voce[0] != versione - 1:
+            self._scarta(chat_id, voce)
+            return
+        storico = voce[1]
+        try:
+            with storico.lock:
+                getattr(storico, operazione)(*args)
+        except Exception as e:
+            print(f"[STORICO] chat {chat_id}: {operazione} non applicabile ({e!r}), storico scartato")
+            self._scarta(chat_id, voce)
+            return
+        with self.lock:
+            if self.voci.get(chat_id) is voce:
+                self.voci[chat_id] = (versione, storico)
+
+    def invalida(self, chat_id):
+        with self.lock:
+            self.voci.pop(chat_id, None)
+
+    def memoria_per_chat(self):
+        # Sotto il lock di ogni storico: memoria() scorre le forme, che i thread del database modificano
+        with self.lock:
+            voci = [(chat_id, storico) for chat_id, (_, storico) in self.voci.items()]
+        memoria = {}
+        for chat_id, storico in voci:
+            with storico.lock:
+                memoria[chat_id] = (len(storico), storico.memoria())
+        return memoria
+
+    def riepilogo(self):
+        memoria = self.memoria_per_chat()
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'voci': len(memoria), 'bytes': sum(b for _, b in memoria.values())}
+
+storico_cache = StoricoCache(STORICO_CHAT_MAX)
+
+# Report in preparazione per (chat_id, periodo): toccati solo dall'event loop, nessun lock
+report_in_corso = {}
+
+class LimitatoreChat:
+    # Token bucket per chat: al massimo `capacita` richieste di fila, poi una ogni finestra/capacita secondi
+    def __init__(self, capacita, finestra):
+        self.capacita = capacita
+        self.finestra = finestra
+        self.stato = {}  # chat_id -> (gettoni, istante dell'ultimo aggiornamento)
+
+    def consenti(self, chat_id):
+        # 0 se la richiesta è ammessa, altrimenti i secondi da aspettare
+        ora = time.monotonic()
+        gettoni, ultimo = self.stato.get(chat_id, (self.capacita, ora))
+        gettoni = min(self.capacita, gettoni + (ora - ultimo) * self.capacita / self.finestra)
+        if gettoni < 1:
+            self.stato[chat_id] = (gettoni, ora)
+            return (1 - gettoni) * self.finestra / self.capacita
+        self.stato[chat_id] = (gettoni - 1, ora)
+        return 0
+
+limitatore_report = LimitatoreChat(REPORT_RICHIESTE_MAX, REPORT_RICHIESTE_FINESTRA)
+
+def parse_risultato(risultato):
+    try:
+        gol_a, gol_b = map(int, risultato.split('-'))
+    except ValueError:
+        raise ValueError("Risultato non valido. Usa il formato 5-4.")
+    return gol_a, gol_b
+
+def esiti_squadre(risultato):
+    # (vittoria, pareggio, sconfitta) per ciascuna squadra
+    gol_a, gol_b = parse_risultato(risultato)
+    return {
+        'A': (int(gol_a>gol_b), int(gol_a==gol_b), int(gol_a<gol_b)),
+        'B': (int(gol_b>gol_a), int(gol_a==gol_b), int(gol_b<gol_a)),
+    }
+
+def rigioca_elo(stato, partite):
+    # stato: giocatore_id -> (rating, partite giocate), aggiornato sul posto.
+    # partite: [(partita_id, risultato, [(giocatore_id, squadra), ...])] in ordine cronologico.
+    # Elo a squadre: ogni squadra vale la media dei suoi rating e tutti i suoi giocatori
+    # ricevono la stessa variazione. Restituisce le righe di storico (partita_id, giocatore_id, prima, dopo).
+    storico = []
+    for partita_id, risultato, formazione in partite:
+        gol_a, gol_b = parse_risultato(risultato)
+        medie = {}
+        for squadra in ('A', 'B'):
+            rating = [stato.get(gid, (ELO_INIZIALE, 0))[0] for gid, sq in formazione if sq == squadra]
+            medie[squadra] = sum(rating) / len(rating) if rating else ELO_INIZIALE
+        atteso_a = 1 / (1 + 10 ** ((medie['B'] - medie['A']) / 400))
+        punteggio_a = 1 if gol_a > gol_b else 0.5 if gol_a == gol_b else 0
+        variazione = ELO_K * (punteggio_a - atteso_a)
+        for gid, squadra in formazione:
+            prima, giocate = stato.get(gid, (ELO_INIZIALE, 0))
+            dopo = prima + (variazione if squadra == 'A' else -variazione)
+            stato[gid] = (dopo, giocate + 1)
+            storico.append((partita_id, gid, prima, dopo))
+    return storico
+
+def delta_prestazioni(righe, segno=1):
+    # righe: (giocatore_id, gol, assist, vittoria, pareggio, sconfitta)
+    delta = defaultdict(lambda: [0, 0, 0, 0, 0, 0])
+    for gid, g, a, v, p, sc in righe:
+        d = delta[gid]
+        for i, x in enumerate((1, g, a, v, p, sc)):
+            d[i] += segno * x
+    return delta
 
 def parse_stats(s):
     d = {}
@@ -81,14 +1909,190 @@ def parse_stats(s):
 
 def valida_data(data_str):
     try:
-        dt = datetime.strptime(data_str, "%d/%m/%Y")
-        return dt.strftime("%d/%m/%Y")
+        return datetime.strptime(data_str, "%d/%m/%Y").date()
     except Exception:
         return None
 
+def formatta_data(d):
+    return d.strftime("%d/%m/%Y") if isinstance(d, date) else str(d)
+
+def parse_periodo(args):
+    # Nessun argomento: tutto lo storico. Accetta "2024" (anno solare), "2024/25" (stagione
+    # da settembre ad agosto), una data iniziale o una coppia di date GG/MM/AAAA.
+    if not args:
+        return None
+    if len(args) == 1 and args[0].isdigit() and len(args[0]) == 4:
+        anno = int(args[0])
+        return date(anno, 1, 1), date(anno, 12, 31)
+    if len(args) == 1 and len(args[0]) in (7, 9) and args[0][4] in '/-' and args[0][:4].isdigit():
+        anno = int(args[0][:4])
+        # La seconda parte deve essere l'anno successivo: "25" oppure "2025"
+        if args[0][5:] in (f"{(anno + 1) % 100:02d}", str(anno + 1)):
+            return date(anno, 9, 1), date(anno + 1, 8, 31)
+    if len(args) <= 2:
+        date_valide = [valida_data(a) for a in args]
+        if all(date_valide):
+            dal = date_valide[0]
+            al = date_valide[1] if len(date_valide) == 2 else None
+            if al is None or dal <= al:
+                return dal, al
+    raise ValueError("Periodo non valido. Usa un anno (2024), una stagione (2024/25) o due date GG/MM/AAAA.")
+
+def descrizione_periodo(periodo):
+    if periodo is None:
+        return ""
+    dal, al = periodo
+    return f" dal {formatta_data(dal)}" + (f" al {formatta_data(al)}" if al else "")
+
+def filtro_periodo(periodo, colonna='data'):
+    # Frammento SQL e parametri per limitare le partite al periodo (range scan su (chat_id, data))
+    if periodo is None:
+        return "", ()
+    dal, al = periodo
+    if al is None:
+        return f" AND {colonna} >= %s", (dal,)
+    return f" AND {colonna} >= %s AND {colonna} <= %s", (dal, al)
+
+# --- Importazione ed esportazione ---
+
+# CSV: una riga per partita, con squadre, marcatori e assist scritti come nella conversazione
+# /nuovapartita. JSON Lines: un oggetto per riga, con "tipo" giocatore o partita.
+COLONNE_CSV = ('data', 'squadra_a', 'squadra_b', 'risultato', 'gol', 'assist')
+# Prima riga dei JSON Lines di /esporta: un file senza intestazione è accettato (scritto a mano)
+VERSIONE_ESPORTAZIONE = 1
+FORMATI_FILE = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.json': 'jsonl'}
+
+def formato_da_nome(nome):
+    formato = FORMATI_FILE.get(os.path.splitext(nome.lower())[1])
+    if formato is None:
+        raise ValueError("Formato non riconosciuto: usa un file .csv o .jsonl.")
+    return formato
+
+def elenco_nomi(valore):
+    if isinstance(valore, list):
+        return [str(n).strip() for n in valore]
+    return [n.strip() for n in str(valore).split(',')]
+
+def elenco_stats(valore, campo):
+    try:
+        if isinstance(valore, dict):
+            return {str(n).strip(): int(v) for n, v in valore.items()}
+        return parse_stats(str(valore or ''))
+    except (ValueError, TypeError):
+        raise ValueError(f"{campo} non validi, usa il formato Rossi:2, Bianchi:1")
+
+def valida_partita_importata(data, squadra_a, squadra_b, risultato, gol, assist):
+    # Gli stessi controlli di squadre, data_partita e assist, su una riga del file
+    data_valida = valida_data(str(data).strip())
+    if not data_valida:
+        raise ValueError("data non valida, usa GG/MM/AAAA")
+    squadre = {'A': elenco_nomi(squadra_a), 'B': elenco_nomi(squadra_b)}
+    for nome, squadra in squadre.items():
+        if len(squadra) != 5 or not all(squadra) or len(set(squadra)) != 5:
+            raise ValueError(f"la Squadra {nome} deve avere esattamente 5 giocatori diversi")
+    if set(squadre['A']) & set(squadre['B']):
+        raise ValueError("un giocatore non può essere in entrambe le squadre")
+    risultato = str(risultato).strip()
+    parse_risultato(risultato)
+    in_campo = set(squadre['A'] + squadre['B'])
+    stats = {}
+    for campo, valore, ruolo in (('gol', gol, 'marcatori'), ('assist', assist, 'assistman')):
+        stats[campo] = elenco_stats(valore, campo)
+        fuori = [n for n in stats[campo] if n not in in_campo]
+        if fuori:
+            raise ValueError(f"{ruolo} non nelle formazioni: {', '.join(fuori)}")
+        if any(v < 0 for v in stats[campo].values()):
+            raise ValueError(f"{campo} negativi")
+    return {'data': data_valida, 'squadra_a': squadre['A'], 'squadra_b': squadre['B'], 'risultato': risultato, **stats}
+
+def leggi_importazione(file, formato):
+    # Generatore sulle righe del file: valida una riga alla volta e si ferma alla prima non valida
+    if formato == 'csv':
+        lettore = csv.DictReader(file)
+        mancanti = [c for c in COLONNE_CSV if c not in (lettore.fieldnames or [])]
+        if mancanti:
+            raise ValueError("Colonne mancanti nel CSV: " + ", ".join(mancanti))
+        for riga in lettore:
+            try:
+                partita = valida_partita_importata(*(riga[c] or '' for c in COLONNE_CSV))
+            except ValueError as e:
+                raise ValueError(f"Riga {lettore.line_num}: {e}")
+            yield 'partita', partita
+        return
+    elencati = None  # giocatori del file, se è un'esportazione: le partite non ne usano altri
+    for numero, testo in enumerate(file, 1):
+        if not testo.strip():
+            continue
+        try:
+            oggetto = json.loads(testo)
+            tipo = oggetto.get('tipo', 'partita')
+            if tipo == 'formato':
+                if oggetto.get('versione') != VERSIONE_ESPORTAZIONE:
+                    raise ValueError(f"versione del formato non supportata: {oggetto.get('versione')}")
+                elencati = set()
+                continue
+            if tipo == 'giocatore':
+                valore = str(oggetto['nome']).strip()
+                if not valore:
+                    raise ValueError("nome del giocatore vuoto")
+                if elencati is not None:
+                    elencati.add(valore)
+            elif tipo == 'partita':
+                valore = valida_partita_importata(*(oggetto.get(c, '') for c in COLONNE_CSV))
+                if elencati is not None:
+                    ignoti = [n for n in valore['squadra_a'] + valore['squadra_b'] if n not in elencati]
+                    if ignoti:
+                        raise ValueError("giocatori non elencati nel file: " + ", ".join(ignoti))
+            else:
+                raise ValueError(f"tipo sconosciuto: {tipo}")
+        except KeyError as e:
+            raise ValueError(f"Riga {numero}: campo mancante {e}")
+        except (ValueError, AttributeError) as e:
+            raise ValueError(f"Riga {numero}: {e}")
+        yield tipo, valore
+
+def scrivi_esportazione(storage, chat_id, file, formato):
+    # file è binario (file su disco o SpooledTemporaryFile): le righe sono scritte man mano
+    # che arrivano i blocchi di partite, senza tenere in memoria tutto lo storico
+    testo = io.TextIOWrapper(file, encoding='utf-8', newline='')
+    n = 0
+    try:
+        if formato == 'csv':
+            scrittore = csv.writer(testo)
+            scrittore.writerow(COLONNE_CSV)
+            for p in storage.esporta_partite(chat_id):
+                scrittore.writerow((
+                    formatta_data(p['data']), ', '.join(p['squadra_a']), ', '.join(p['squadra_b']), p['risultato'],
+                    ', '.join(f"{k}:{v}" for k, v in p['gol'].items()), ', '.join(f"{k}:{v}" for k, v in p['assist'].items()),
+                ))
+                n += 1
+        else:
+            testo.write(json.dumps({'tipo': 'formato', 'versione': VERSIONE_ESPORTAZIONE}) + '\n')
+            for nome in storage.lista_giocatori(chat_id):
+                testo.write(json.dumps({'tipo': 'giocatore', 'nome': nome}, ensure_ascii=False) + '\n')
+            for p in storage.esporta_partite(chat_id):
+                testo.write(json.dumps({'tipo': 'partita', **p, 'data': formatta_data(p['data'])}, ensure_ascii=False) + '\n')
+                n += 1
+        testo.flush()
+    finally:
+        # Il file resta aperto per chi lo deve inviare o chiudere
+        testo.detach()
+    return n
+
+def importa_da_file(storage, chat_id, percorso, formato):
+    try:
+        with open(percorso, encoding='utf-8-sig', newline='') as f:
+            return storage.importa(chat_id, leggi_importazione(f, formato))
+    except UnicodeDecodeError:
+        raise ValueError("Il file deve essere codificato in UTF-8.")
+
 def is_annulla(msg):
     return msg and msg.strip().lower() in ('annulla', '/annulla')
 
+def is_admin(update):
+    # Utenti in ADMIN_IDS: comandi costosi o con dati interni del bot (/metrics, /ricalcola)
+    return update.effective_user is not None and update.effective_user.id in ADMIN_IDS
+
 async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
         [KeyboardButton("/nuovapartita"), KeyboardButton("/statistiche")],
@@ -130,12 +2134,134 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 async def giocatori(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    nomi = lista_giocatori(chat_id)
+    nomi = await esegui_db(db.lista_giocatori, chat_id)
     if not nomi:
         await update.message.reply_text("Nessun giocatore registrato. Usa /aggiungi_giocatore per aggiungerli.")
     else:
         await update.message.reply_text("🏃 Elenco giocatori:\n" + "\n".join(sorted(nomi)))
 
+async def scheda(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    nome = " ".join(context.args).strip()
+    if not nome:
+        await update.message.reply_text("Uso: /scheda <nome del giocatore>")
+        return
+    giocatore, compagni, avversari = await esegui_db(db.scheda_giocatore, nome, chat_id)
+    if giocatore is None:
+        await update.message.reply_text(f"❌ Giocatore non trovato: {nome}. Usa /giocatori per l'elenco.")
+        return
+    _, nome, presenze, gol_tot, assist_tot, vittorie, pareggi, sconfitte = giocatore
+    def perc(n):
+        return f"{round(100*n/presenze,1)}%" if presenze else "0%"
+    media_gol = round(gol_tot/presenze,2) if presenze else 0
+    media_assist = round(assist_tot/presenze,2) if presenze else 0
+    righe = [
+        f"🧾 Scheda di {nome}",
+        f"Presenze: {presenze}",
+        f"⚽ Gol: {gol_tot} (media {media_gol})",
+        f"🎯 Assist: {assist_tot} (media {media_assist})",
+        f"✅ Vittorie: {vittorie} ({perc(vittorie)})",
+        f"➖ Pareggi: {pareggi} ({perc(pareggi)})",
+        f"❌ Sconfitte: {sconfitte} ({perc(sconfitte)})",
+        "🤝 Top compagni: " + (', '.join(f"{n} ({c})" for n, c in compagni) or "-"),
+        "⚔️ Top avversari: " + (', '.join(f"{n} ({c})" for n, c in avversari) or "-"),
+    ]
+    await update.message.reply_text("\n".join(righe))
+
+def dati_forma(chat_id):
+    # Nome -> (riepilogo della forma, media gol in carriera), dallo storico in memoria
+    storico = db.storico(chat_id)
+    nomi = {gid: nome for nome, gid in db.roster(chat_id).items()}
+    # La media in carriera viene dalla tabella aggregata: niente scansione dello storico a ogni richiesta
+    medie = db.medie_gol(chat_id)
+    with storico.lock:
+        return {
+            nomi.get(gid, '?'): (riepilogo_forma(forma), medie.get(gid, 0))
+            for gid, forma in storico.forme().items() if forma.ultime
+        }
+
+async def forma(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    nome = " ".join(context.args).strip()
+    forme = await esegui_db(dati_forma, chat_id)
+    if not forme:
+        await update.message.reply_text("Nessuna partita giocata. Inserisci almeno una partita!")
+        return
+    corta = FINESTRE_FORMA[0]
+    if not nome:
+        # Classifica per punti a partita nella finestra più corta, poi per serie di risultati utili
+        classifica = sorted(forme.items(), key=lambda v: (-punti_per_partita(v[1][0]['finestre'][corta]), -v[1][0]['serie_imbattuto'], v[0]))
+        righe = [f"📈 Forma (ultime {corta} partite, la più recente a destra):"]
+        for i, (n, (f, _)) in enumerate(classifica[:15], 1):
+            righe.append(f"{i}. {n} — {f['sequenza'][-corta:]}, {punti_per_partita(f['finestre'][corta]):.1f} pt/p, serie {f['serie_vittorie']}V/{f['serie_imbattuto']} utili")
+        righe.append("\nUsa /forma <nome> per il dettaglio di un giocatore.")
+        await update.message.reply_text("\n".join(righe))
+        return
+    trovato = next((n for n in forme if n.lower() == nome.lower()), None)
+    if trovato is None:
+        await update.message.reply_text(f"❌ Nessuna partita trovata per {nome}. Usa /giocatori per l'elenco.")
+        return
+    f, media_gol = forme[trovato]
+    righe = [f"📈 Forma di {trovato}", f"Ultime partite: {f['sequenza']} (la più recente a destra)"]
+    for n in FINESTRE_FORMA:
+        partite, vittorie, pareggi, sconfitte, gol_f, assist_f = f['finestre'][n]
+        righe.append(
+            f"Ultime {n}: {vittorie}V {pareggi}P {sconfitte}S su {partite}, {punti_per_partita(f['finestre'][n]):.1f} pt/p, "
+            f"⚽ {gol_f / partite:.2f} gol/p, 🎯 {assist_f / partite:.2f} assist/p"
+        )
+    partite_c, _, _, _, gol_c, _ = f['finestre'][corta]
+    righe.append(f"Media gol in carriera: {media_gol:.2f} (ultime {corta}: {gol_c / partite_c - media_gol:+.2f})")
+    righe.append(f"🔥 Serie in corso: {f['serie_vittorie']} vittorie, {f['serie_imbattuto']} risultati utili")
+    await update.message.reply_text("\n".join(righe))
+
+async def bilancia(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    nomi = [n.strip() for n in " ".join(context.args).split(',') if n.strip()]
+    if len(nomi) != 10 or len(set(nomi)) != 10:
+        await update.message.reply_text("Uso: /bilancia nome1, nome2, ..., nome10 (10 giocatori diversi, separati da virgola)")
+        return
+    try:
+        ids, totali, coppie = await esegui_db(db.dati_bilanciamento, nomi, chat_id)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    proposte = bilancia_squadre(nomi, ids, totali, coppie, BILANCIA_PROPOSTE)
+    righe = ["⚖️ Le squadre più equilibrate secondo lo storico:"]
+    for i, (differenza, squadra_a, squadra_b, valore_a, valore_b) in enumerate(proposte, 1):
+        righe.append(
+            f"\n{i}) Squadra A: {', '.join(squadra_a)}\n"
+            f"   Squadra B: {', '.join(squadra_b)}\n"
+            f"   Forza {valore_a:.2f} contro {valore_b:.2f} (differenza {differenza:.2f})"
+        )
+    tastiera = InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"▶️ Nuova partita con la proposta {i}", callback_data=f"bil_{i - 1}")]
+        for i in range(1, len(proposte) + 1)
+    ])
+    messaggio = await update.message.reply_text("\n".join(righe), reply_markup=tastiera)
+    # Proposte legate al messaggio: i pulsanti di un /bilancia precedente restano validi
+    salvate = context.chat_data.setdefault('proposte_bilancia', {})
+    salvate[messaggio.message_id] = [(p[1], p[2]) for p in proposte]
+    while len(salvate) > 5:
+        del salvate[next(iter(salvate))]
+
+async def usa_bilanciamento(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Entry point di /nuovapartita: squadre già scelte, si riparte dalla data
+    query = update.callback_query
+    await query.answer()
+    proposte = context.chat_data.get('proposte_bilancia', {}).get(query.message.message_id, [])
+    indice = int(query.data.split("_")[1])
+    if indice >= len(proposte):
+        await query.message.reply_text("❌ Proposta non più disponibile. Usa di nuovo /bilancia.")
+        return ConversationHandler.END
+    squadra_a, squadra_b = proposte[indice]
+    context.user_data['squadra_a'] = list(squadra_a)
+    context.user_data['squadra_b'] = list(squadra_b)
+    await query.message.reply_text(
+        f"✅ Squadra A: {', '.join(squadra_a)}\nSquadra B: {', '.join(squadra_b)}\n\nInserisci la data della partita (GG/MM/AAAA):",
+        reply_markup=ReplyKeyboardMarkup([["/annulla"]], resize_keyboard=True, one_time_keyboard=True)
+    )
+    return DATA
+
 async def aggiungi_giocatore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "Inserisci uno o più nomi di giocatori separati da virgola (es: Rossi, Bianchi, Verdi):",
@@ -152,14 +2278,14 @@ async def aggiungi_giocatore_salva(update: Update, context: ContextTypes.DEFAULT
     if not nomi:
         await update.message.reply_text("Nessun nome valido inserito. Riprova o /annulla.")
         return AGGIUNGI_GIOCATORE
-    aggiungi_giocatori_db(nomi, chat_id)
+    await esegui_db(db.aggiungi_giocatori, nomi, chat_id)
     await update.message.reply_text("✅ Giocatore/i aggiunto/i: " + ", ".join(nomi))
     await menu(update, context)
     return ConversationHandler.END
 
 async def nuova_partita(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    nomi = lista_giocatori(chat_id)
+    nomi = await esegui_db(db.lista_giocatori, chat_id)
     if not nomi:
         await update.message.reply_text("⚠️ Nessun giocatore registrato. Usa prima /aggiungi_giocatore.")
         return ConversationHandler.END
@@ -186,6 +2312,9 @@ async def squadre(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Inserisci esattamente 5 giocatori tra quelli registrati:\n" + ", ".join(sorted(giocatori_registrati))
             )
             return SQUADRE
+        if len(set(squadra_a)) != 5:
+            await update.message.reply_text("❌ Errore. Lo stesso giocatore non può comparire due volte nella squadra!")
+            return SQUADRE
         context.user_data['squadra_a'] = squadra_a
         await update.message.reply_text("Inserisci i nomi dei 5 giocatori della Squadra B, separati da virgola:")
         context.user_data['step'] = 1
@@ -199,6 +2328,9 @@ async def squadre(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"Inserisci esattamente 5 giocatori tra quelli registrati:\n" + ", ".join(sorted(giocatori_registrati))
             )
             return SQUADRE
+        if len(set(squadra_b)) != 5:
+            await update.message.reply_text("❌ Errore. Lo stesso giocatore non può comparire due volte nella squadra!")
+            return SQUADRE
         if set(context.user_data['squadra_a']) & set(squadra_b):
             await update.message.reply_text("❌ Errore. Un giocatore non può essere in entrambe le squadre!")
             return SQUADRE
@@ -238,8 +2370,13 @@ async def assist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     context.user_data['assist'] = update.message.text
     squadra = set(context.user_data['squadra_a'] + context.user_data['squadra_b'])
-    marcatori = set(parse_stats(context.user_data['gol']).keys())
-    assistman = set(parse_stats(context.user_data['assist']).keys())
+    gol_inseriti = parse_stats(context.user_data['gol'])
+    assist_inseriti = parse_stats(context.user_data['assist'])
+    if any(v < 0 for v in list(gol_inseriti.values()) + list(assist_inseriti.values())):
+        await update.message.reply_text("❌ Gol e assist non possono essere negativi. Correggi e reinserisci marcatori e assist.")
+        return ASSIST
+    marcatori = set(gol_inseriti.keys())
+    assistman = set(assist_inseriti.keys())
     non_in_sq_marc = [n for n in marcatori if n not in squadra]
     non_in_sq_assist = [n for n in assistman if n not in squadra]
     if non_in_sq_marc or non_in_sq_assist:
@@ -251,7 +2388,7 @@ async def assist(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += "Correggi e reinserisci marcatori e assist."
         await update.message.reply_text(msg)
         return ASSIST
-    salva_partita(context.user_data, chat_id)
+    await esegui_db(db.salva_partita, context.user_data, chat_id)
     await update.message.reply_text(
         "✅ Partita salvata!",
         reply_markup=ReplyKeyboardMarkup([["/menu", "/statistiche"]], resize_keyboard=True, one_time_keyboard=True)
@@ -259,177 +2396,206 @@ async def assist(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await menu(update, context)
     return ConversationHandler.END
 
+# Pesi del bilanciamento: le medie di chi ha giocato poco vengono avvicinate a quelle
+# del gruppo come se avesse PARTITE_PRIOR partite "medie" in più
+PARTITE_PRIOR = 5
+PESO_CONTRIBUTO = 0.25
+PESO_SINERGIA = 0.5
+
+def bilancia_squadre(nomi, ids, totali, coppie, top=3):
+    # Forza di ogni giocatore e sinergia di ogni coppia vengono calcolate una volta sola;
+    # i 126 modi di dividere 10 giocatori in 5+5 (il primo sempre in A) sono poi solo somme.
+    indici = [ids[n] for n in nomi]
+    zero = (0, 0, 0, 0, 0)
+    presenze_tot = sum(totali.get(g, zero)[0] for g in indici)
+    media_contributo = sum(totali.get(g, zero)[1] + totali.get(g, zero)[2] for g in indici) / presenze_tot if presenze_tot else 0
+    forza = []
+    for g in indici:
+        presenze, gol, assist, vittorie, pareggi = totali.get(g, zero)
+        punti = (vittorie + 0.5 * pareggi + 0.5 * PARTITE_PRIOR) / (presenze + PARTITE_PRIOR)
+        contributo = (gol + assist + media_contributo * PARTITE_PRIOR) / (presenze + PARTITE_PRIOR)
+        forza.append(punti + PESO_CONTRIBUTO * contributo)
+    sinergia = [[0.0] * 10 for _ in range(10)]
+    for i, j in combinations(range(10), 2):
+        chiave = (indici[i], indici[j]) if indici[i] < indici[j] else (indici[j], indici[i])
+        insieme, vittorie, pareggi = coppie.get(chiave, (0, 0, 0))
+        # Rendimento della coppia rispetto al 50%: positivo se insieme vincono più del normale
+        sinergia[i][j] = sinergia[j][i] = PESO_SINERGIA * ((vittorie + 0.5 * pareggi + 0.5 * PARTITE_PRIOR) / (insieme + PARTITE_PRIOR) - 0.5)
+
+    def valore(squadra):
+        return sum(forza[i] for i in squadra) + sum(sinergia[i][j] for i, j in combinations(squadra, 2))
+
+    proposte = []
+    for resto in combinations(range(1, 10), 4):
+        squadra_a = (0,) + resto
+        squadra_b = tuple(i for i in range(10) if i not in squadra_a)
+        valore_a, valore_b = valore(squadra_a), valore(squadra_b)
+        proposte.append((abs(valore_a - valore_b), [nomi[i] for i in squadra_a], [nomi[i] for i in squadra_b], valore_a, valore_b))
+    proposte.sort(key=lambda p: p[0])
+    return proposte[:top]
+
+def prepara_statistiche(chat_id, periodo=None):
+    # Solo dati "piatti" (liste di stringhe): il rendering PDF avviene in un processo separato
+    with metriche.cronometro('calcetto_report_fase_secondi', fase='caricamento'):
+        storico = db.storico(chat_id, periodo)
+        nomi = {gid: nome for nome, gid in db.roster(chat_id).items()}
+        # Rating attuali (su tutto lo storico anche quando il report è limitato a un periodo)
+        classifica_rating = db.classifica_elo(chat_id)
+    inizio = time.perf_counter()
+    statistiche = []
+    forma_tab = []
+    rating = {r[0]: r[2] for r in classifica_rating}
+
+    # Totali, coppie e righe del PDF partite dalle colonne del periodo, senza query
+    with storico.lock:
+        m0, m1 = storico.intervallo(periodo)
+        totali = storico.totali(m0, m1)
+        compagni_dict, avversari_dict = storico.coppie(m0, m1)
+        partite_data = storico.righe_partite(m0, m1, nomi)
+        # In un report limitato a un periodo la forma è quella alla fine del periodo
+        forme = {gid: riepilogo_forma(forma) for gid, forma in storico.forme(m0, m1).items()}
+    giocatori = [(gid, nome) + totali.get(gid, (0, 0, 0, 0, 0, 0)) for gid, nome in sorted(nomi.items())]
+
+    def top(conteggi, n=3):
+        # A parità di partite in ordine di nome, come /scheda
+        return sorted(((nomi.get(altro, '?'), volte) for altro, volte in conteggi.items()), key=lambda v: (-v[1], v[0]))[:n]
+
+    for gid, nome, presenze, gol_tot, assist_tot, vittorie, pareggi, sconfitte in giocatori:
+        media_gol = round(gol_tot/presenze,2) if presenze else 0
+        media_assist = round(assist_tot/presenze,2) if presenze else 0
+        perc_vittorie = f"{round(100*vittorie/presenze,1)}%" if presenze else "0%"
+        perc_pareggi = f"{round(100*pareggi/presenze,1)}%" if presenze else "0%"
+        perc_sconfitte = f"{round(100*sconfitte/presenze,1)}%" if presenze else "0%"
+        compagni, avversari = top(compagni_dict.get(gid, {})), top(avversari_dict.get(gid, {}))
+        compagni_top = ', '.join([f"{n} ({c})" for n,c in compagni]) if compagni else "-"
+        avversari_top = ', '.join([f"{n} ({c})" for n,c in avversari]) if avversari else "-"
+        forma = forme.get(gid)
+        if forma:
+            partite_5, _, _, _, gol_5, _ = forma['finestre'][FINESTRE_FORMA[0]]
+            forma_tab.append([nome] + [testo_finestra(forma['finestre'][n]) for n in FINESTRE_FORMA] + [
+                f"{forma['serie_vittorie']}/{forma['serie_imbattuto']}",
+                f"{gol_5 / partite_5:.2f} ({gol_5 / partite_5 - media_gol:+.2f})",
+            ])
+        else:
+            forma_tab.append([nome] + ["-"] * (len(FINESTRE_FORMA) + 2))
+        statistiche.append([
+            str(nome),
+            str(round(rating[gid])) if gid in rating else "-",
+            str(presenze),
+            str(gol_tot),
+            str(media_gol),
+            str(assist_tot),
+            str(media_assist),
+            str(vittorie),
+            str(perc_vittorie),
+            str(pareggi),
+            str(perc_pareggi),
+            str(sconfitte),
+            str(perc_sconfitte),
+            str(compagni_top),
+            str(avversari_top)
+        ])
+    header = [
+        "Nome", "Elo", "Pres.", "Gol", "Media Gol", "Assist", "Media Assist",
+        "Vittorie", "%Vitt", "Pareggi", "%Par", "Sconfitte", "%Sco",
+        "Top Compagni", "Top Avversari"
+    ]
+
+    # FORMA: tabella a parte, la tabella principale non ha spazio per altre colonne
+    forma_header = ["Giocatore", *[f"Forma {n} (V-P-S)" for n in FINESTRE_FORMA], "Serie vittorie / utili", f"Gol/p ult. {FINESTRE_FORMA[0]} (vs media)"]
+
+    # CLASSIFICA CANNONIERI
+    classifica_gol = [(g[1], g[3]) for g in giocatori]
+    classifica_gol.sort(key=lambda x: (-x[1], x[0]))
+    cannonieri = [["Pos", "Giocatore", "Gol"]] + [[str(i+1), n, str(g)] for i, (n, g) in enumerate(classifica_gol)]
+
+    # CLASSIFICA ASSISTMAN
+    classifica_assist = [(g[1], g[4]) for g in giocatori]
+    classifica_assist.sort(key=lambda x: (-x[1], x[0]))
+    assistman = [["Pos", "Giocatore", "Assist"]] + [[str(i+1), n, str(a)] for i, (n, a) in enumerate(classifica_assist)]
+
+    # CLASSIFICA PRESENZE
+    classifica_presenze = [(g[1], g[2]) for g in giocatori]
+    classifica_presenze.sort(key=lambda x: (-x[1], x[0]))
+    presenze_tab = [["Pos", "Giocatore", "Presenze"]] + [[str(i+1), n, str(p)] for i, (n, p) in enumerate(classifica_presenze)]
+
+    # CLASSIFICA ELO
+    elo_tab = [["Pos", "Giocatore", "Elo", "Partite"]] + [[str(i+1), n, str(round(r)), str(p)] for i, (_, n, r, p) in enumerate(classifica_rating)]
+
+    # --- PDF partite con marcatori e assist: righe già calcolate dallo storico ---
+    partite_header = ["Data", "Squadra A", "Squadra B", "Risultato", "Marcatori", "Assistman"]
+    metriche.osserva('calcetto_report_fase_secondi', time.perf_counter() - inizio, fase='aggregazione')
+
+    return {
+        'statistiche': [header]+statistiche,
+        'forma': [forma_header]+forma_tab,
+        'cannonieri': cannonieri,
+        'assistman': assistman,
+        'presenze': presenze_tab,
+        'elo': elo_tab,
+        'partite': [partite_header]+partite_data,
+    }
+
 async def statistiche(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
-        with get_conn() as conn:
-            with conn.cursor() as c:
-                c.execute('SELECT id, nome FROM giocatori WHERE chat_id = %s', (chat_id,))
-                giocatori = c.fetchall()
-                statistiche = []
-                compagni_dict = {}
-                avversari_dict = {}
-
-                c.execute('SELECT id, data, squadra_a, squadra_b, risultato FROM partite WHERE chat_id = %s ORDER BY data', (chat_id,))
-                partite = c.fetchall()
-                c.execute('SELECT partita_id, giocatore_id, squadra, gol, assist, vittoria, pareggio, sconfitta FROM prestazioni WHERE chat_id = %s', (chat_id,))
-                prestazioni = c.fetchall()
-
-                partite_map = {p[0]: p for p in partite}
-                giocatore_nome = {gid: nome for gid, nome in giocatori}
-                nome_id = {nome: gid for gid, nome in giocatori}
-                giocatore_partite = defaultdict(list)
-                for pr in prestazioni:
-                    giocatore_partite[pr[1]].append(pr)  # pr[1]=giocatore_id
-
-                # Avanzate
-                for gid, nome in giocatori:
-                    compagni = Counter()
-                    avversari = Counter()
-                    partite_giocatore = giocatore_partite[gid]
-                    for pr in partite_giocatore:
-                        partita_id = pr[0]
-                        squadra_gioc = pr[2]
-                        prs = [p for p in prestazioni if p[0] == partita_id]
-                        for p in prs:
-                            if p[1] == gid:
-                                continue
-                            if p[2] == squadra_gioc:
-                                compagni[giocatore_nome[p[1]]] += 1
-                            else:
-                                avversari[giocatore_nome[p[1]]] += 1
-                    compagni_dict[nome] = compagni.most_common(3)
-                    avversari_dict[nome] = avversari.most_common(3)
-
-                for gid, nome in giocatori:
-                    prs = giocatore_partite[gid]
-                    presenze = len(prs)
-                    gol_tot = sum(p[3] for p in prs)
-                    assist_tot = sum(p[4] for p in prs)
-                    vittorie = sum(p[5] for p in prs)
-                    pareggi = sum(p[6] for p in prs)
-                    sconfitte = sum(p[7] for p in prs)
-                    media_gol = round(gol_tot/presenze,2) if presenze else 0
-                    media_assist = round(assist_tot/presenze,2) if presenze else 0
-                    perc_vittorie = f"{round(100*vittorie/presenze,1)}%" if presenze else "0%"
-                    perc_pareggi = f"{round(100*pareggi/presenze,1)}%" if presenze else "0%"
-                    perc_sconfitte = f"{round(100*sconfitte/presenze,1)}%" if presenze else "0%"
-                    compagni_top = ', '.join([f"{n} ({c})" for n,c in compagni_dict[nome]]) if compagni_dict[nome] else "-"
-                    avversari_top = ', '.join([f"{n} ({c})" for n,c in avversari_dict[nome]]) if avversari_dict[nome] else "-"
-                    statistiche.append([
-                        str(nome),
-                        str(presenze),
-                        str(gol_tot),
-                        str(media_gol),
-                        str(assist_tot),
-                        str(media_assist),
-                        str(vittorie),
-                        str(perc_vittorie),
-                        str(pareggi),
-                        str(perc_pareggi),
-                        str(sconfitte),
-                        str(perc_sconfitte),
-                        str(compagni_top),
-                        str(avversari_top)
-                    ])
-                header = [
-                    "Nome", "Pres.", "Gol", "Media Gol", "Assist", "Media Assist",
-                    "Vittorie", "%Vitt", "Pareggi", "%Par", "Sconfitte", "%Sco",
-                    "Top Compagni", "Top Avversari"
-                ]
-
-                # CLASSIFICA CANNONIERI
-                classifica_gol = []
-                for gid, nome in giocatori:
-                    tot_gol = sum(p[3] for p in giocatore_partite[gid])
-                    classifica_gol.append((nome, tot_gol))
-                classifica_gol.sort(key=lambda x: (-x[1], x[0]))
-                cannonieri = [["Pos", "Giocatore", "Gol"]] + [[str(i+1), n, str(g)] for i, (n, g) in enumerate(classifica_gol)]
-
-                # CLASSIFICA ASSISTMAN
-                classifica_assist = []
-                for gid, nome in giocatori:
-                    tot_assist = sum(p[4] for p in giocatore_partite[gid])
-                    classifica_assist.append((nome, tot_assist))
-                classifica_assist.sort(key=lambda x: (-x[1], x[0]))
-                assistman = [["Pos", "Giocatore", "Assist"]] + [[str(i+1), n, str(a)] for i, (n, a) in enumerate(classifica_assist)]
-
-                # CLASSIFICA PRESENZE
-                classifica_presenze = []
-                for gid, nome in giocatori:
-                    presenze = len(giocatore_partite[gid])
-                    classifica_presenze.append((nome, presenze))
-                classifica_presenze.sort(key=lambda x: (-x[1], x[0]))
-                presenze_tab = [["Pos", "Giocatore", "Presenze"]] + [[str(i+1), n, str(p)] for i, (n, p) in enumerate(classifica_presenze)]
-
-                filename = "statistiche_avanzate.pdf"
-                genera_pdf_multi(
-                    [header]+statistiche,
-                    cannonieri,
-                    assistman,
-                    presenze_tab,
-                    filename
-                )
+        periodo = parse_periodo(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
+        return
+    chiave = (chat_id, periodo)
+    # Single-flight: chi chiede lo stesso report mentre è in preparazione non avvia un secondo calcolo
+    if chiave in report_in_corso:
+        await update.message.reply_text("⏳ Le statistiche sono già in preparazione, arrivano a breve.")
+        return
+    attesa = limitatore_report.consenti(chat_id)
+    if attesa:
+        await update.message.reply_text(f"🐢 Troppe richieste di statistiche. Riprova tra {math.ceil(attesa)} secondi.")
+        return
+    # La versione va letta prima di caricare i dati: una scrittura concorrente rende la voce già vecchia
+    versione = await esegui_db(db.versione_dati, chat_id)
+    documenti = report_cache.get(chiave, versione)
+    if documenti is not None:
+        await invia_report(update.message, documenti, periodo)
+        return
+    # Calcolo e PDF girano in un job in background: l'handler libera subito la chat
+    messaggio_attesa = await update.message.reply_text("⏳ Sto generando le statistiche" + descrizione_periodo(periodo) + "...")
+    job = context.application.create_task(genera_report(update.message, messaggio_attesa, chat_id, periodo, versione))
+    report_in_corso[chiave] = job
+    job.add_done_callback(lambda _: report_in_corso.pop(chiave, None))
 
-                # --- PDF partite con marcatori e assist ---
-                c.execute("SELECT id, data, squadra_a, squadra_b, risultato FROM partite WHERE chat_id = %s ORDER BY data", (chat_id,))
-                partite_rows = c.fetchall()
-                partite_data = []
-                styles = getSampleStyleSheet()
-                para_style = ParagraphStyle(
-                    'MyStyle',
-                    fontName='Helvetica',
-                    fontSize=8,
-                    leading=10,
-                    alignment=TA_LEFT
-                )
-                for row in partite_rows:
-                    partita_id, data, squadra_a, squadra_b, risultato = row
-                    c.execute("""
-                        SELECT giocatori.nome, prestazioni.gol, prestazioni.assist, prestazioni.squadra
-                        FROM prestazioni JOIN giocatori ON prestazioni.giocatore_id = giocatori.id
-                        WHERE partita_id = %s AND prestazioni.chat_id = %s AND (gol > 0 OR assist > 0)
-                        ORDER BY prestazioni.squadra, giocatori.nome
-                    """, (partita_id, chat_id))
-                    dettaglio = c.fetchall()
-                    marcatori = [f"{nome} ({gol})" for nome, gol, assist, sq in dettaglio if gol > 0]
-                    assistman = [f"{nome} ({assist})" for nome, gol, assist, sq in dettaglio if assist > 0]
-
-                    partite_data.append([
-                        Paragraph(str(data), para_style),
-                        Paragraph(squadra_a.replace(",", ", "), para_style),
-                        Paragraph(squadra_b.replace(",", ", "), para_style),
-                        Paragraph(str(risultato), para_style),
-                        Paragraph("<br/>".join(marcatori) if marcatori else "-", para_style),
-                        Paragraph("<br/>".join(assistman) if assistman else "-", para_style)
-                    ])
-                partite_header = [
-                    Paragraph("Data", para_style),
-                    Paragraph("Squadra A", para_style),
-                    Paragraph("Squadra B", para_style),
-                    Paragraph("Risultato", para_style),
-                    Paragraph("Marcatori", para_style),
-                    Paragraph("Assistman", para_style)
-                ]
-                partite_pdf_filename = "partite.pdf"
-                genera_pdf_partite([partite_header]+partite_data, partite_pdf_filename)
-
-        if len(statistiche) == 0:
-            await update.message.reply_text("Nessuna statistica disponibile. Inserisci almeno una partita!")
-            return
-        await update.message.reply_document(
-            document=InputFile(open(filename, "rb"), filename=filename),
-            caption="📊 Statistiche avanzate, cannonieri, assistman e presenze"
-        )
-        await update.message.reply_document(
-            document=InputFile(open(partite_pdf_filename, "rb"), filename=partite_pdf_filename),
-            caption="📅 Lista partite con marcatori e assist"
-        )
+async def genera_report(messaggio, messaggio_attesa, chat_id, periodo, versione):
+    try:
+        with metriche.cronometro('calcetto_report_fase_secondi', fase='totale'):
+            report = await esegui_db(prepara_statistiche, chat_id, periodo)
+            if len(report['statistiche']) == 1:
+                await messaggio_attesa.edit_text("Nessuna statistica disponibile. Inserisci almeno una partita!")
+                return
+            # I due PDF vengono generati in parallelo nei processi worker
+            documenti = await asyncio.gather(
+                esegui_pdf_cronometrato('pdf_statistiche', genera_pdf_multi, report['statistiche'], report['cannonieri'], report['assistman'], report['presenze'], report['elo'], report['forma']),
+                esegui_pdf_cronometrato('pdf_partite', genera_pdf_partite, report['partite'])
+            )
+            report_cache.put((chat_id, periodo), versione, documenti)
+            await messaggio_attesa.edit_text("✅ Statistiche pronte" + descrizione_periodo(periodo) + "!")
+            await invia_report(messaggio, documenti, periodo)
     except Exception as e:
         print("[ERRORE]", e)
-        await update.message.reply_text("Si è verificato un errore nel generare le statistiche: " + str(e))
+        await messaggio_attesa.edit_text("Si è verificato un errore nel generare le statistiche: " + str(e))
+
+async def invia_report(messaggio, documenti, periodo):
+    pdf_statistiche, pdf_partite = documenti
+    with metriche.cronometro('calcetto_report_fase_secondi', fase='invio'):
+        await messaggio.reply_document(
+            document=InputFile(pdf_statistiche, filename="statistiche_avanzate.pdf"),
+            caption="📊 Statistiche avanzate, cannonieri, assistman e presenze" + descrizione_periodo(periodo)
+        )
+        await messaggio.reply_document(
+            document=InputFile(pdf_partite, filename="partite.pdf"),
+            caption="📅 Lista partite con marcatori e assist" + descrizione_periodo(periodo)
+        )
 
-def genera_pdf_multi(statistiche, cannonieri, assistman, presenze, filename):
+def genera_pdf_multi(statistiche, cannonieri, assistman, presenze, elo, forma):
     from reportlab.lib.pagesizes import landscape, letter
     from reportlab.platypus import Table, TableStyle, SimpleDocTemplate, Paragraph, Spacer, PageBreak
     from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -487,7 +2653,8 @@ def genera_pdf_multi(statistiche, cannonieri, assistman, presenze, filename):
             wrapped.append([Paragraph(str(x), styles['Heading6'] if i==0 else para_style) for x in row])
         return wrapped
 
-    doc = SimpleDocTemplate(filename, pagesize=landscape(letter), rightMargin=margin, leftMargin=margin)
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=landscape(letter), rightMargin=margin, leftMargin=margin)
     elements = []
 
     table_style = TableStyle([
@@ -512,6 +2679,15 @@ def genera_pdf_multi(statistiche, cannonieri, assistman, presenze, filename):
     elements.append(table1)
     elements.append(PageBreak())
 
+    # Forma recente
+    if len(forma) > 1:
+        elements.append(Paragraph("Forma recente", styles['Title']))
+        elements.append(Spacer(1,8))
+        table_forma = Table(wrap_classifica(forma), repeatRows=1, colWidths=classifica_colwidths(forma))
+        table_forma.setStyle(table_style)
+        elements.append(table_forma)
+        elements.append(PageBreak())
+
     # Cannonieri
     elements.append(Paragraph("Classifica cannonieri", styles['Title']))
     elements.append(Spacer(1,8))
@@ -534,9 +2710,19 @@ def genera_pdf_multi(statistiche, cannonieri, assistman, presenze, filename):
     table4 = Table(wrap_classifica(presenze), repeatRows=1, colWidths=classifica_colwidths(presenze))
     table4.setStyle(table_style)
     elements.append(table4)
+
+    # Elo
+    if len(elo) > 1:
+        elements.append(PageBreak())
+        elements.append(Paragraph("Classifica Elo (rating attuale)", styles['Title']))
+        elements.append(Spacer(1,8))
+        table5 = Table(wrap_classifica(elo), repeatRows=1, colWidths=classifica_colwidths(elo))
+        table5.setStyle(table_style)
+        elements.append(table5)
     doc.build(elements)
+    return buffer.getvalue()
 
-def genera_pdf_partite(data, filename):
+def genera_pdf_partite(data):
     from reportlab.lib.pagesizes import landscape, letter
     from reportlab.platypus import Table, TableStyle, SimpleDocTemplate, Paragraph, Spacer
     from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
@@ -568,12 +2754,10 @@ def genera_pdf_partite(data, filename):
         alignment=TA_LEFT
     )
 
-    def wrap_row(row):
-        return [Paragraph(str(cell).replace(", ", ",<br/>"), para_style) if isinstance(cell, str) else cell for cell in row]
+    data_wrapped = [[Paragraph(str(cell), para_style) for cell in row] for row in data]
 
-    data_wrapped = [wrap_row(row) for row in data]
-
-    doc = SimpleDocTemplate(filename, pagesize=landscape(letter), rightMargin=margin, leftMargin=margin)
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=landscape(letter), rightMargin=margin, leftMargin=margin)
     style = TableStyle([
         ('BACKGROUND', (0,0), (-1,0), colors.lightblue),
         ('TEXTCOLOR',(0,0),(-1,0),colors.black),
@@ -599,31 +2783,63 @@ def genera_pdf_partite(data, filename):
     elements.append(Spacer(1,8))
     elements.append(table)
     doc.build(elements)
+    return buffer.getvalue()
+
+def testo_pagina_partite(righe, periodo):
+    lines = [f"📅 Partite giocate{descrizione_periodo(periodo)} ({formatta_data(righe[0][1])} - {formatta_data(righe[-1][1])}):", ""]
+    for p in righe:
+        lines.append(
+            f"{formatta_data(p[1])} | Risultato: {p[4]} | Squadra A: {p[2]} | Squadra B: {p[3]}"
+        )
+    return "\n".join(lines)
+
+def tastiera_pagina_partite(righe, altre_prima, altre_dopo, periodo):
+    # La chiave della pagina e il periodo viaggiano nel callback_data (max 64 byte): nessuno stato lato bot
+    dal, al = periodo if periodo else (None, None)
+    coda = f"{dal.isoformat() if dal else ''}_{al.isoformat() if al else ''}"
+    pulsanti = []
+    if altre_prima:
+        pulsanti.append(InlineKeyboardButton("⬅️ Precedenti", callback_data=f"pag_p_{righe[0][1].isoformat()}_{righe[0][0]}_{coda}"))
+    if altre_dopo:
+        pulsanti.append(InlineKeyboardButton("Successive ➡️", callback_data=f"pag_s_{righe[-1][1].isoformat()}_{righe[-1][0]}_{coda}"))
+    return InlineKeyboardMarkup([pulsanti]) if pulsanti else None
 
 async def tutte_le_partite(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
-    with get_conn() as conn:
-        with conn.cursor() as c:
-            c.execute('SELECT data, squadra_a, squadra_b, risultato FROM partite WHERE chat_id = %s ORDER BY data', (chat_id,))
-            partite = c.fetchall()
-    if not partite:
-        await update.message.reply_text("Nessuna partita registrata.")
+    try:
+        periodo = parse_periodo(context.args)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e}")
         return
-    lines = []
-    for p in partite:
-        lines.append(
-            f"{p[0]} | Risultato: {p[3]} | Squadra A: {p[1]} | Squadra B: {p[2]}"
-        )
-    testo = "\n".join(lines)
-    if len(testo) > 4000:
-        with open("tutte_le_partite.txt", "w", encoding="utf-8") as f:
-            f.write(testo)
-        await update.message.reply_document(
-            document=InputFile(open("tutte_le_partite.txt", "rb"), filename="tutte_le_partite.txt"),
-            caption="Elenco completo partite"
-        )
-    else:
-        await update.message.reply_text("Ecco la lista di tutte le partite giocate:\n\n" + testo)
+    righe, altre_prima, altre_dopo = await esegui_db(db.pagina_partite, chat_id, periodo, n=PARTITE_PER_PAGINA)
+    if not righe:
+        await update.message.reply_text("Nessuna partita registrata" + descrizione_periodo(periodo) + ".")
+        return
+    await update.message.reply_text(
+        testo_pagina_partite(righe, periodo),
+        reply_markup=tastiera_pagina_partite(righe, altre_prima, altre_dopo, periodo)
+    )
+
+async def pagina_partite_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+    chat_id = query.message.chat_id
+    _, verso, data, partita_id, dal, al = query.data.split("_")
+    periodo = (date.fromisoformat(dal), date.fromisoformat(al) if al else None) if dal else None
+    chiave = (date.fromisoformat(data), int(partita_id))
+    righe, altre_prima, altre_dopo = await esegui_db(
+        db.pagina_partite, chat_id, periodo,
+        prima_di=chiave if verso == "p" else None,
+        dopo=chiave if verso == "s" else None,
+        n=PARTITE_PER_PAGINA
+    )
+    if not righe:
+        await query.edit_message_text("Nessun'altra partita" + descrizione_periodo(periodo) + ".")
+        return
+    await query.edit_message_text(
+        testo_pagina_partite(righe, periodo),
+        reply_markup=tastiera_pagina_partite(righe, altre_prima, altre_dopo, periodo)
+    )
 
 async def partita(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Inserisci la data della partita che vuoi visualizzare (GG/MM/AAAA):")
@@ -638,21 +2854,16 @@ async def mostra_partita(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not data_valida:
         await update.message.reply_text("❌ Formato data non valido. Scrivi la data in formato GG/MM/AAAA (es: 04/04/2024):")
         return 20
-    with get_conn() as conn:
-        with conn.cursor() as c:
-            c.execute('SELECT id, squadra_a, squadra_b, risultato FROM partite WHERE data = %s AND chat_id = %s', (data_valida, chat_id))
-            row = c.fetchone()
-            if not row:
-                await update.message.reply_text("❌ Nessuna partita trovata per questa data.")
-                await menu(update, context)
-                return ConversationHandler.END
-            partita_id, squadra_a, squadra_b, risultato = row
-            c.execute('SELECT giocatori.nome, prestazioni.gol, prestazioni.assist, prestazioni.squadra FROM prestazioni JOIN giocatori ON prestazioni.giocatore_id = giocatori.id WHERE partita_id = %s AND prestazioni.chat_id = %s', (partita_id, chat_id))
-            dettagli = c.fetchall()
+    row, dettagli = await esegui_db(db.dettaglio_partita, data_valida, chat_id)
+    if not row:
+        await update.message.reply_text("❌ Nessuna partita trovata per questa data.")
+        await menu(update, context)
+        return ConversationHandler.END
+    partita_id, squadra_a, squadra_b, risultato = row
     tabella = [['Nome', 'Squadra', 'Gol', 'Assist']]
     for nome, gol, assist, squadra in dettagli:
         tabella.append([nome, squadra, str(gol), str(assist)])
-    testo = f"📅 Partita del {data_valida}\nRisultato: {risultato}\nSquadra A: {squadra_a}\nSquadra B: {squadra_b}\n"
+    testo = f"📅 Partita del {formatta_data(data_valida)}\nRisultato: {risultato}\nSquadra A: {squadra_a}\nSquadra B: {squadra_b}\n"
     testo += "\nMarcatori e assist:\n"
     for r in tabella[1:]:
         testo += f"{r[0]} (Squadra {r[1]}): Gol {r[2]}, Assist {r[3]}\n"
@@ -660,6 +2871,100 @@ async def mostra_partita(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await menu(update, context)
     return ConversationHandler.END
 
+async def ricalcola(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Ricostruzione completa di aggregati e rating: solo per gli amministratori
+    if not is_admin(update):
+        await update.message.reply_text("⛔ Comando riservato agli amministratori.")
+        return
+    chat_id = update.effective_chat.id
+    roster_cache.invalida(chat_id)
+    storico_cache.invalida(chat_id)
+    n_giocatori, incoerenti = await esegui_db(db.ricostruisci_aggregati, chat_id)
+    await esegui_db(db.ricostruisci_rating, chat_id)
+    await update.message.reply_text(
+        f"✅ Statistiche e rating Elo ricalcolati per {n_giocatori} giocatori. Righe incoerenti corrette: {incoerenti}."
+    )
+
+def dividi_messaggio(righe, limite=4000):
+    # Raggruppa le righe in testi sotto il limite di 4096 caratteri di un messaggio Telegram
+    testi, blocco, lunghezza = [], [], 0
+    for riga in righe:
+        if blocco and lunghezza + 1 + len(riga) > limite:
+            testi.append("\n".join(blocco))
+            blocco, lunghezza = [], 0
+        blocco.append(riga)
+        lunghezza += len(riga) + (1 if lunghezza else 0)
+    if blocco:
+        testi.append("\n".join(blocco))
+    return testi
+
+async def classifica_elo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    classifica = await esegui_db(db.classifica_elo, chat_id)
+    if not classifica:
+        await update.message.reply_text("Nessun rating disponibile. Inserisci almeno una partita!")
+        return
+    righe = ["🏆 Classifica Elo:"]
+    for i, (_, nome, rating, partite) in enumerate(classifica, 1):
+        righe.append(f"{i}. {nome} — {round(rating)} ({partite} partite)")
+    # Con molti giocatori la classifica supera il limite di Telegram: più messaggi, a righe intere
+    for testo in dividi_messaggio(righe):
+        await update.message.reply_text(testo)
+
+async def esporta(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    formato = context.args[0].lower() if context.args else 'csv'
+    if formato not in ('csv', 'jsonl'):
+        await update.message.reply_text("❌ Formato non valido. Usa /esporta csv oppure /esporta jsonl.")
+        return
+    # Fino a qualche MB l'esportazione resta in memoria, oltre finisce su un file temporaneo
+    with tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024) as file:
+        n = await esegui_db(scrivi_esportazione, db, chat_id, file, formato)
+        if not n:
+            await update.message.reply_text("Nessuna partita da esportare.")
+            return
+        file.seek(0)
+        await update.message.reply_document(
+            document=InputFile(file, filename=f"partite_{chat_id}.{formato}"),
+            caption=f"📤 {n} partite esportate. Puoi reimportarle con /importa."
+        )
+
+async def importa(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(
+        "📥 Invia il file da importare come documento:\n"
+        "• CSV con le colonne " + ", ".join(COLONNE_CSV) + " (data GG/MM/AAAA, squadre e marcatori come in /nuovapartita)\n"
+        "• JSON Lines come quello prodotto da /esporta jsonl\n"
+        "I giocatori mancanti vengono aggiunti automaticamente, le partite già presenti vengono saltate.",
+        reply_markup=ReplyKeyboardMarkup([["/annulla"]], resize_keyboard=True, one_time_keyboard=True)
+    )
+    return IMPORTA
+
+async def importa_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    documento = update.message.document
+    try:
+        formato = formato_da_nome(documento.file_name or '')
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e} Riprova o /annulla.")
+        return IMPORTA
+    if documento.file_size and documento.file_size > IMPORT_MAX_MB * 1024 * 1024:
+        await update.message.reply_text(f"❌ File troppo grande (massimo {IMPORT_MAX_MB:g} MB).")
+        return IMPORTA
+    messaggio_attesa = await update.message.reply_text("⏳ Importazione in corso...")
+    with tempfile.TemporaryDirectory() as cartella:
+        percorso = os.path.join(cartella, 'importazione')
+        file = await documento.get_file()
+        await file.download_to_drive(percorso)
+        try:
+            n_partite, n_giocatori, n_saltate = await esegui_db(importa_da_file, db, chat_id, percorso, formato)
+        except ValueError as e:
+            await messaggio_attesa.edit_text(f"❌ {e}\nNessuna partita importata: correggi il file e rimandalo, oppure /annulla.")
+            return IMPORTA
+    saltate = f" {n_saltate} partite erano già presenti e sono state saltate." if n_saltate else ""
+    await messaggio_attesa.edit_text(f"✅ Importate {n_partite} partite ({n_giocatori} nuovi giocatori).{saltate}")
+    await menu(update, context)
+    return ConversationHandler.END
+
 async def elimina_partita(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("Inserisci la data della partita da eliminare (GG/MM/AAAA):")
     return ELIMINA_PARTITA_SELEZIONE
@@ -673,10 +2978,7 @@ async def elimina_partita_data(update: Update, context: ContextTypes.DEFAULT_TYP
     if not data_valida:
         await update.message.reply_text("❌ Formato data non valido. Scrivi la data in formato GG/MM/AAAA (es: 04/04/2024):")
         return ELIMINA_PARTITA_SELEZIONE
-    with get_conn() as conn:
-        with conn.cursor() as c:
-            c.execute('SELECT id, squadra_a, squadra_b, risultato FROM partite WHERE data = %s AND chat_id = %s', (data_valida, chat_id))
-            partite = c.fetchall()
+    partite = await esegui_db(db.partite_per_data, data_valida, chat_id)
     if not partite:
         await update.message.reply_text("❌ Nessuna partita trovata per questa data.")
         await menu(update, context)
@@ -697,10 +2999,7 @@ async def elimina_partita_callback(update: Update, context: ContextTypes.DEFAULT
     chat_id = query.message.chat_id
     if query.data.startswith("del_"):
         partita_id = int(query.data.split("_")[1])
-        with get_conn() as conn:
-            with conn.cursor() as c:
-                c.execute('DELETE FROM prestazioni WHERE partita_id = %s AND chat_id = %s', (partita_id, chat_id))
-                c.execute('DELETE FROM partite WHERE id = %s AND chat_id = %s', (partita_id, chat_id))
+        await esegui_db(db.elimina_partita, partita_id, chat_id)
         await query.edit_message_text("✅ Partita eliminata.")
         try:
             await menu(update, context)
@@ -720,10 +3019,7 @@ async def modifica_partita_data(update: Update, context: ContextTypes.DEFAULT_TY
     if not data_valida:
         await update.message.reply_text("❌ Formato data non valido. Scrivi la data in formato GG/MM/AAAA (es: 04/04/2024):")
         return MODIFICA_PARTITA_SELEZIONE
-    with get_conn() as conn:
-        with conn.cursor() as c:
-            c.execute('SELECT id, squadra_a, squadra_b, risultato FROM partite WHERE data = %s AND chat_id = %s', (data_valida, chat_id))
-            partite = c.fetchall()
+    partite = await esegui_db(db.partite_per_data, data_valida, chat_id)
     if not partite:
         await update.message.reply_text("❌ Nessuna partita trovata per questa data.")
         await menu(update, context)
@@ -771,52 +3067,239 @@ async def modifica_valore(update: Update, context: ContextTypes.DEFAULT_TYPE):
     campo = context.user_data['campo_modifica']
     partita_id = context.user_data['modifica_id']
     nuovo_valore = update.message.text.strip()
-    with get_conn() as conn:
-        with conn.cursor() as c:
-            if campo in ['squadra_a', 'squadra_b', 'risultato']:
-                c.execute(f'UPDATE partite SET {campo} = %s WHERE id = %s AND chat_id = %s', (nuovo_valore, partita_id, chat_id))
-            elif campo == 'gol' or campo == 'assist':
-                c.execute('SELECT squadra_a, squadra_b, risultato FROM partite WHERE id = %s AND chat_id = %s', (partita_id, chat_id))
-                row = c.fetchone()
-                squadra_a = row[0].split(',')
-                squadra_b = row[1].split(',')
-                risultato = row[2]
-                c.execute('SELECT giocatori.nome, prestazioni.gol, prestazioni.assist, prestazioni.squadra FROM prestazioni JOIN giocatori ON prestazioni.giocatore_id = giocatori.id WHERE partita_id = %s AND prestazioni.chat_id = %s', (partita_id, chat_id))
-                prestazioni = c.fetchall()
-                if campo == 'gol':
-                    nuovo_gol = parse_stats(nuovo_valore)
-                    assist_esist = {nome: a for nome, g, a, sq in prestazioni}
-                    gol_esist = {nome: g for nome, g, a, sq in prestazioni}
-                else:
-                    nuovo_assist = parse_stats(nuovo_valore)
-                    gol_esist = {nome: g for nome, g, a, sq in prestazioni}
-                    assist_esist = {nome: a for nome, g, a, sq in prestazioni}
-                c.execute('DELETE FROM prestazioni WHERE partita_id = %s AND chat_id = %s', (partita_id, chat_id))
-                gol_a, gol_b = map(int, risultato.split('-'))
-                for nome in squadra_a:
-                    c.execute('SELECT id FROM giocatori WHERE nome=%s AND chat_id=%s', (nome, chat_id))
-                    giocatore_id = c.fetchone()[0]
-                    g = nuovo_gol.get(nome, gol_esist.get(nome,0)) if campo == 'gol' else gol_esist.get(nome,0)
-                    a = nuovo_assist.get(nome, assist_esist.get(nome,0)) if campo == 'assist' else assist_esist.get(nome,0)
-                    c.execute('INSERT INTO prestazioni (partita_id, giocatore_id, squadra, gol, assist, vittoria, pareggio, sconfitta, chat_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                              (partita_id, giocatore_id, 'A', g, a, int(gol_a>gol_b), int(gol_a==gol_b), int(gol_a<gol_b), chat_id))
-                for nome in squadra_b:
-                    c.execute('SELECT id FROM giocatori WHERE nome=%s AND chat_id=%s', (nome, chat_id))
-                    giocatore_id = c.fetchone()[0]
-                    g = nuovo_gol.get(nome, gol_esist.get(nome,0)) if campo == 'gol' else gol_esist.get(nome,0)
-                    a = nuovo_assist.get(nome, assist_esist.get(nome,0)) if campo == 'assist' else assist_esist.get(nome,0)
-                    c.execute('INSERT INTO prestazioni (partita_id, giocatore_id, squadra, gol, assist, vittoria, pareggio, sconfitta, chat_id) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)',
-                              (partita_id, giocatore_id, 'B', g, a, int(gol_b>gol_a), int(gol_a==gol_b), int(gol_b<gol_a), chat_id))
+    try:
+        await esegui_db(db.modifica_partita, partita_id, campo, nuovo_valore, chat_id)
+    except ValueError as e:
+        await update.message.reply_text(f"❌ {e} Reinserisci il valore o /annulla.")
+        return MODIFICA_VALORE
     await update.message.reply_text("✅ Modifica effettuata.")
     await menu(update, context)
     return ConversationHandler.END
 
+# --- Metriche ---
+
+NOMI_STATI = {
+    SQUADRE: 'squadre', DATA: 'data', RISULTATO: 'risultato', GOL: 'gol', ASSIST: 'assist',
+    MODIFICA_PARTITA_SELEZIONE: 'modifica_selezione', MODIFICA_CAMPO: 'modifica_campo', MODIFICA_VALORE: 'modifica_valore',
+    ELIMINA_PARTITA_SELEZIONE: 'elimina_selezione', AGGIUNGI_GIOCATORE: 'aggiungi_giocatore', IMPORTA: 'importa', 20: 'partita',
+}
+
+def cronometrato(callback, stato='-'):
+    @wraps(callback)
+    async def handler(update, context):
+        inizio = time.perf_counter()
+        esito = 'ok'
+        try:
+            return await callback(update, context)
+        except Exception:
+            esito = 'errore'
+            raise
+        finally:
+            metriche.osserva('calcetto_handler_secondi', time.perf_counter() - inizio, handler=callback.__name__, stato=stato, esito=esito)
+    return handler
+
+def strumenta_handler(app):
+    # Avvolge i callback già registrati, etichettandoli con lo stato di conversazione in cui girano
+    for gruppo in app.handlers.values():
+        for handler in gruppo:
+            if isinstance(handler, ConversationHandler):
+                for h in handler.entry_points:
+                    h.callback = cronometrato(h.callback, 'ingresso')
+                for stato, lista in handler.states.items():
+                    for h in lista:
+                        h.callback = cronometrato(h.callback, NOMI_STATI.get(stato, str(stato)))
+                for h in handler.fallbacks:
+                    h.callback = cronometrato(h.callback, 'fallback')
+            else:
+                handler.callback = cronometrato(handler.callback)
+
+async def esegui_in_thread(func):
+    # Le metriche dello storico aspettano il lock di ogni chat, che un report tiene anche per
+    # secondi: vanno calcolate fuori dall'event loop. Non nel pool del database, per non
+    # togliere un thread alle query mentre aspettano.
+    return await asyncio.get_running_loop().run_in_executor(None, func)
+
+def testo_metriche():
+    righe = metriche.esporta()
+    cache = report_cache.riepilogo()
+    righe.append("# TYPE calcetto_report_cache_hits_total counter")
+    righe.append(f"calcetto_report_cache_hits_total {cache['hits']}")
+    righe.append("# TYPE calcetto_report_cache_misses_total counter")
+    righe.append(f"calcetto_report_cache_misses_total {cache['misses']}")
+    righe.append("# TYPE calcetto_report_cache_voci gauge")
+    righe.append(f"calcetto_report_cache_voci {cache['voci']}")
+    righe.append("# TYPE calcetto_report_cache_bytes gauge")
+    righe.append(f"calcetto_report_cache_bytes {cache['bytes']}")
+    roster = roster_cache.riepilogo()
+    righe.append("# TYPE calcetto_roster_cache_hits_total counter")
+    righe.append(f"calcetto_roster_cache_hits_total {roster['hits']}")
+    righe.append("# TYPE calcetto_roster_cache_misses_total counter")
+    righe.append(f"calcetto_roster_cache_misses_total {roster['misses']}")
+    righe.append("# TYPE calcetto_roster_cache_voci gauge")
+    righe.append(f"calcetto_roster_cache_voci {roster['voci']}")
+    storico = storico_cache.riepilogo()
+    righe.append("# TYPE calcetto_storico_cache_hits_total counter")
+    righe.append(f"calcetto_storico_cache_hits_total {storico['hits']}")
+    righe.append("# TYPE calcetto_storico_cache_misses_total counter")
+    righe.append(f"calcetto_storico_cache_misses_total {storico['misses']}")
+    righe.append("# TYPE calcetto_storico_bytes gauge")
+    for chat_id, (partite, byte) in storico_cache.memoria_per_chat().items():
+        righe.append(f'calcetto_storico_bytes{{chat="{chat_id}"}} {byte}')
+    return "\n".join(righe) + "\n"
+
+async def servi_metriche(reader, writer):
+    # HTTP minimale per lo scraping di Prometheus: solo GET /metrics
+    try:
+        richiesta = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=5)
+        parti = richiesta.split(b" ", 2)
+        if len(parti) >= 2 and parti[0] == b"GET" and parti[1].split(b"?")[0] == b"/metrics":
+            stato, corpo = "200 OK", (await esegui_in_thread(testo_metriche)).encode("utf-8")
+        else:
+            stato, corpo = "404 Not Found", b"not found\n"
+        writer.write(
+            f"HTTP/1.1 {stato}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(corpo)}\r\nConnection: close\r\n\r\n".encode("ascii") + corpo
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+async def avvia_server_metriche(app):
+    if METRICS_PORT:
+        app.bot_data['server_metriche'] = await asyncio.start_server(servi_metriche, METRICS_HOST, METRICS_PORT)
+        print(f"[METRICHE] http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def ferma_server_metriche(app):
+    server = app.bot_data.pop('server_metriche', None)
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+
+def riepilogo_metriche():
+    righe = ["⏱️ Handler (chiamate, media, max):"]
+    for etichette, n, media, massimo in metriche.riepilogo('calcetto_handler_secondi')[:15]:
+        errori = " ⚠️" if etichette['esito'] == 'errore' else ""
+        righe.append(f"{etichette['handler']} [{etichette['stato']}]{errori}: {n}, {media * 1000:.0f} ms, {massimo * 1000:.0f} ms")
+    righe.append("\n📄 Fasi report:")
+    for etichette, n, media, massimo in metriche.riepilogo('calcetto_report_fase_secondi'):
+        righe.append(f"{etichette['fase']}: {n}, {media * 1000:.0f} ms, {massimo * 1000:.0f} ms")
+    righe.append("\n🗄️ Query:")
+    for etichette, n, media, massimo in metriche.riepilogo('calcetto_query_secondi')[:15]:
+        righe.append(f"{etichette['query']}: {n}, {media * 1000:.1f} ms, {massimo * 1000:.0f} ms")
+    for etichette, n, media, massimo in metriche.riepilogo('calcetto_db_connessione_secondi'):
+        righe.append(f"\n🔌 Attesa connessione ({etichette['backend']}): {n}, {media * 1000:.1f} ms, {massimo * 1000:.0f} ms")
+    cache = report_cache.riepilogo()
+    righe.append(f"\n💾 Cache report: {cache['hits']} hit, {cache['misses']} miss, {cache['voci']} voci, {cache['bytes'] // 1024} KB")
+    roster = roster_cache.riepilogo()
+    righe.append(f"👥 Cache roster: {roster['hits']} hit, {roster['misses']} miss, {roster['voci']} chat")
+    storico = storico_cache.riepilogo()
+    righe.append(f"📚 Storico in memoria: {storico['hits']} hit, {storico['misses']} miss, {storico['voci']} chat, {storico['bytes'] // 1024} KB")
+    per_chat = sorted(storico_cache.memoria_per_chat().items(), key=lambda v: -v[1][1])
+    for chat_id, (partite, byte) in per_chat[:10]:
+        righe.append(f"  chat {chat_id}: {partite} partite, {byte // 1024} KB")
+    return "\n".join(righe)
+
+async def mostra_metriche(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update):
+        await update.message.reply_text("⛔ Comando riservato agli amministratori.")
+        return
+    testo = await esegui_in_thread(riepilogo_metriche)
+    if len(testo) > 4000:
+        await update.message.reply_document(
+            document=InputFile(io.BytesIO(testo.encode("utf-8")), filename="metriche.txt"),
+            caption="⏱️ Metriche del bot"
+        )
+    else:
+        await update.message.reply_text(testo)
+
+# --- Concorrenza ---
+
+class ApplicationPerChat(Application):
+    # Update di chat diverse in parallelo (al massimo CONCURRENT_UPDATES handler attivi),
+    # quelli della stessa chat uno alla volta e nell'ordine di arrivo: le conversazioni
+    # a più passi non vedono mai due messaggi dello stesso gruppo elaborati insieme.
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.lock_chat = {}  # chat_id -> [lock, update in attesa o in corso]
+        self.slot_handler = asyncio.Semaphore(CONCURRENT_UPDATES)
+
+    async def process_update(self, update):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            async with self.slot_handler:
+                return await super().process_update(update)
+        # Il lock della chat si prende prima dello slot: gli update in coda dietro la
+        # stessa chat non occupano posti che potrebbero servire ad altri gruppi
+        voce = self.lock_chat.setdefault(chat.id, [asyncio.Lock(), 0])
+        voce[1] += 1
+        try:
+            async with voce[0]:
+                async with self.slot_handler:
+                    await super().process_update(update)
+        finally:
+            voce[1] -= 1
+            if voce[1] == 0:
+                del self.lock_chat[chat.id]
+
 def main():
+    parser = argparse.ArgumentParser(description="Bot Telegram per le statistiche del calcetto")
+    parser.add_argument('--migra', action='store_true', help="applica le migrazioni dello schema ed esce")
+    parser.add_argument('--verifica-indici', action='store_true', help="controlla con EXPLAIN che le query principali usino gli indici ed esce")
+    parser.add_argument('--esporta', nargs=2, metavar=('CHAT_ID', 'FILE'), help="esporta le partite della chat in FILE (.csv o .jsonl) ed esce")
+    parser.add_argument('--importa', nargs=2, metavar=('CHAT_ID', 'FILE'), help="importa le partite di FILE (.csv o .jsonl) nella chat ed esce; "
+                        "un bot già avviato le vede alla richiesta successiva, senza riavvio")
+    parser.add_argument('--formato', choices=('csv', 'jsonl'), help="formato di --esporta/--importa (predefinito: dall'estensione)")
+    args = parser.parse_args()
+    if args.esporta or args.importa:
+        chat_id, percorso = args.esporta or args.importa
+        init_db()
+        try:
+            db.applica_migrazioni()
+            formato = args.formato or formato_da_nome(percorso)
+            if args.esporta:
+                with open(percorso, 'wb') as f:
+                    n = scrivi_esportazione(db, int(chat_id), f, formato)
+                print(f"{n} partite esportate in {percorso}")
+            else:
+                n_partite, n_giocatori, n_saltate = importa_da_file(db, int(chat_id), percorso, formato)
+                print(f"{n_partite} partite importate ({n_giocatori} nuovi giocatori, {n_saltate} già presenti e saltate)")
+        except ValueError as e:
+            print(f"Errore: {e}")
+            sys.exit(1)
+        finally:
+            chiudi_db()
+        return
+    if args.migra or args.verifica_indici:
+        init_db()
+        try:
+            db.applica_migrazioni()
+            db.inizializza_rating()
+            if args.verifica_indici:
+                if not hasattr(db, 'verifica_indici'):
+                    print("La verifica degli indici con EXPLAIN è disponibile solo con PostgreSQL.")
+                elif not db.verifica_indici():
+                    sys.exit(1)
+        finally:
+            chiudi_db()
+        return
+
     token = os.environ.get('TOKEN') or "INSERISCI_IL_TUO_TOKEN"
-    app = Application.builder().token(token).build()
+    # Il limite del builder conta anche gli update fermi sul lock della propria chat:
+    # il numero di handler davvero in esecuzione lo limita ApplicationPerChat
+    app = (
+        Application.builder()
+        .token(token)
+        .application_class(ApplicationPerChat)
+        .concurrent_updates(max(256, CONCURRENT_UPDATES))
+        .post_init(avvia_server_metriche)
+        .post_shutdown(ferma_server_metriche)
+        .build()
+    )
 
     conv_nuova = ConversationHandler(
-        entry_points=[CommandHandler('nuovapartita', nuova_partita)],
+        entry_points=[CommandHandler('nuovapartita', nuova_partita), CallbackQueryHandler(usa_bilanciamento, pattern="^bil_")],
         states={
             SQUADRE: [MessageHandler(filters.TEXT, squadre)],
             DATA: [MessageHandler(filters.TEXT, data_partita)],
@@ -837,6 +3320,15 @@ def main():
         allow_reentry=True
     )
 
+    conv_importa = ConversationHandler(
+        entry_points=[CommandHandler('importa', importa)],
+        states={
+            IMPORTA: [MessageHandler(filters.Document.ALL, importa_file)],
+        },
+        fallbacks=[CommandHandler('annulla', annulla), MessageHandler(filters.TEXT, annulla)],
+        allow_reentry=True
+    )
+
     conv_partita = ConversationHandler(
         entry_points=[CommandHandler('partita', partita)],
         states={
@@ -871,9 +3363,18 @@ def main():
     app.add_handler(conv_nuova)
     app.add_handler(conv_aggiungi)
     app.add_handler(CommandHandler('giocatori', giocatori))
+    app.add_handler(CommandHandler('scheda', scheda))
+    app.add_handler(CommandHandler('forma', forma))
+    app.add_handler(CommandHandler('bilancia', bilancia))
     app.add_handler(CommandHandler('statistiche', statistiche))
+    app.add_handler(CommandHandler('ricalcola', ricalcola))
+    app.add_handler(CommandHandler('classifica_elo', classifica_elo))
+    app.add_handler(CommandHandler('esporta', esporta))
+    app.add_handler(conv_importa)
+    app.add_handler(CommandHandler('metrics', mostra_metriche))
     app.add_handler(conv_partita)
     app.add_handler(CommandHandler('partite', tutte_le_partite))
+    app.add_handler(CallbackQueryHandler(pagina_partite_callback, pattern="^pag_"))
     app.add_handler(conv_elimina)
     app.add_handler(CallbackQueryHandler(elimina_partita_callback, pattern="^del_"))
     app.add_handler(conv_modifica)
@@ -884,8 +3385,27 @@ def main():
     app.add_handler(MessageHandler(filters.Regex('^(\/reset|reset)$'), reset))  # <--- NUOVO HANDLER
 
     app.add_handler(MessageHandler(filters.TEXT, annulla))  # fallback finale
+    strumenta_handler(app)
 
-    app.run_polling()
+    init_db()
+    db.applica_migrazioni()
+    db.inizializza_rating()
+    init_pdf_executor()
+    try:
+        if WEBHOOK_URL:
+            # Richiede python-telegram-bot[webhooks]: Telegram invia gli update a WEBHOOK_URL/WEBHOOK_PATH
+            app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL.rstrip('/') + '/' + WEBHOOK_PATH,
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            app.run_polling()
+    finally:
+        chiudi_pdf_executor()
+        chiudi_db()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
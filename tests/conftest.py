@@ -0,0 +1,64 @@
+import os
+import sys
+import random
+import asyncio
+from types import SimpleNamespace
+from datetime import date, timedelta
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot
+
+@pytest.fixture
+def storage():
+    # SQLite in memoria al posto di PostgreSQL, con le cache svuotate tra un test e l'altro
+    storage = bot.SqliteStorage(':memory:')
+    storage.applica_migrazioni()
+    bot.db = storage
+    yield storage
+    # Ogni test riparte dalla versione 0: nessuna voce deve sopravvivere al database che l'ha prodotta
+    for chat_id in list(bot.storico_cache.voci):
+        bot.storico_cache.invalida(chat_id)
+    for chat_id in list(bot.roster_cache.voci):
+        bot.roster_cache.invalida(chat_id)
+    bot.report_cache = bot.ReportCache(bot.report_cache.max_bytes)
+    storage.chiudi()
+    bot.db = None
+
+def crea_chat(storage, chat_id, n_partite, seme=0):
+    # n_partite casuali tra 12 giocatori, salvate come da /nuovapartita
+    rnd = random.Random(seme)
+    nomi = [f"G{i:02d}" for i in range(12)]
+    storage.aggiungi_giocatori(nomi, chat_id)
+    for i in range(n_partite):
+        campo = rnd.sample(nomi, 10)
+        storage.salva_partita({
+            'data': date(2024, 1, 1) + timedelta(days=i),
+            'squadra_a': campo[:5],
+            'squadra_b': campo[5:],
+            'risultato': f"{rnd.randint(0, 6)}-{rnd.randint(0, 6)}",
+            'gol': f"{campo[0]}:1, {campo[5]}:2",
+            'assist': f"{campo[1]}:1",
+        }, chat_id)
+
+class Messaggio:
+    # Quel che serve ai handler di update.message: il testo e le risposte inviate
+    def __init__(self, testo):
+        self.text = testo
+        self.risposte = []
+
+    async def reply_text(self, testo, **kwargs):
+        self.risposte.append(testo)
+
+    async def reply_document(self, document, **kwargs):
+        self.risposte.append(document)
+
+def invia(handler, testo, user_data=None, chat_id=1, utente=1, args=()):
+    # Esegue un handler su un update finto e restituisce lo stato e le risposte
+    messaggio = Messaggio(testo)
+    update = SimpleNamespace(message=messaggio, effective_chat=SimpleNamespace(id=chat_id), effective_user=SimpleNamespace(id=utente))
+    context = SimpleNamespace(user_data={} if user_data is None else user_data, args=list(args))
+    stato = asyncio.run(handler(update, context))
+    return stato, messaggio.risposte
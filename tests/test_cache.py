@@ -0,0 +1,74 @@
+from datetime import date
+from contextlib import contextmanager
+
+import pytest
+
+import bot
+from conftest import crea_chat
+
+def test_roster_letto_prima_di_un_inserimento_non_entra_in_cache(storage, monkeypatch):
+    storage.aggiungi_giocatori(["Rossi", "Bianchi"], 1)
+    bot.roster_cache.invalida(1)
+    originale = storage.transazione
+    transazioni = []
+
+    @contextmanager
+    def transazione_con_inserimento():
+        # Il nuovo giocatore viene registrato tra la lettura del roster (dopo quella della
+        # versione) e il suo ingresso in cache
+        with originale() as c:
+            yield c
+        transazioni.append(c)
+        if len(transazioni) == 2:
+            monkeypatch.setattr(storage, 'transazione', originale)
+            storage.aggiungi_giocatori(["Verdi"], 1)
+
+    monkeypatch.setattr(storage, 'transazione', transazione_con_inserimento)
+    assert sorted(storage.roster(1)) == ["Bianchi", "Rossi"]
+    assert sorted(storage.roster(1)) == ["Bianchi", "Rossi", "Verdi"]
+
+def test_le_cache_vedono_le_scritture_di_un_altro_processo(tmp_path, monkeypatch):
+    percorso = str(tmp_path / 'calcetto.db')
+    storage = bot.SqliteStorage(percorso)
+    storage.applica_migrazioni()
+    crea_chat(storage, 1, 5)
+    storico, versione = storage.storico(1), storage.versione_dati(1)
+    storage.roster(1)
+    assert storage.storico(1) is storico and bot.roster_cache.get(1, versione) is not None
+    # Un secondo processo (es. --importa) scrive sullo stesso database senza toccare queste cache
+    for cache, metodo in ((bot.storico_cache, 'aggiorna'), (bot.storico_cache, 'invalida'), (bot.roster_cache, 'aggiungi')):
+        monkeypatch.setattr(cache, metodo, lambda *args: None)
+    altro = bot.SqliteStorage(percorso)
+    altro.aggiungi_giocatori(["Nuovo"], 1)
+    altro.salva_partita({'data': date(2025, 1, 1), 'squadra_a': ["Nuovo"], 'squadra_b': ["G00"],
+                         'risultato': "1-0", 'gol': "Nuovo:1", 'assist': ""}, 1)
+    altro.chiudi()
+    monkeypatch.undo()
+    assert storage.versione_dati(1) == versione + 2
+    assert len(storage.storico(1)) == 6
+    assert "Nuovo" in storage.roster(1)
+    storage.chiudi()
+
+def colonne(storico):
+    return {c: list(getattr(storico, c)) for c in bot.StoricoChat.COLONNE_PARTITE + bot.StoricoChat.COLONNE_RIGHE + ('inizio',)}
+
+def test_inserimento_non_valido_lascia_lo_storico_invariato():
+    storico = bot.StoricoChat()
+    storico.inserisci(1, date(2024, 1, 1), "2-1", [(10, 'A', 2, 0), (20, 'B', 1, 1)])
+    prima = colonne(storico)
+    with pytest.raises(OverflowError):
+        storico.inserisci(2, date(2024, 1, 2), "1-0", [(10, 'A', -1, 0), (20, 'B', 0, 0)])
+    with pytest.raises(OverflowError):
+        storico.inserisci(1, date(2024, 1, 1), "2-1", [(10, 'A', 2, -1), (20, 'B', 1, 1)])
+    with pytest.raises(OverflowError):
+        storico.imposta_valori(1, 'gol', {10: 3, 20: -1})
+    assert colonne(storico) == prima
+
+def test_storico_scartato_se_la_scrittura_non_si_applica(storage):
+    crea_chat(storage, 1, 5)
+    storico = storage.storico(1)
+    partita_id = storico.partita[0]
+    versione = storage.versione_dati(1)
+    bot.storico_cache.aggiorna(1, versione + 1, 'imposta_valori', partita_id, 'gol', {storico.giocatori[0]: -1})
+    assert bot.storico_cache.get(1, versione) is None
+    assert colonne(storage.storico(1)) == colonne(storage.carica_storico(1))
@@ -0,0 +1,51 @@
+import time
+import asyncio
+import threading
+
+import bot
+
+from conftest import crea_chat, invia
+
+def test_ricalcola_solo_per_gli_amministratori(storage, monkeypatch):
+    crea_chat(storage, 1, 5)
+    monkeypatch.setattr(bot, 'ADMIN_IDS', {42})
+    chiamate = []
+    monkeypatch.setattr(storage, 'ricostruisci_aggregati', lambda chat_id: chiamate.append(chat_id) or (12, 0))
+    _, risposte = invia(bot.ricalcola, "/ricalcola", utente=7)
+    assert risposte[0].startswith("⛔")
+    assert chiamate == []
+    _, risposte = invia(bot.ricalcola, "/ricalcola", utente=42)
+    assert risposte[0].startswith("✅")
+    assert chiamate == [1]
+
+def test_metriche_non_bloccano_l_event_loop(storage, monkeypatch):
+    crea_chat(storage, 1, 5)
+    storico = storage.storico(1)
+    monkeypatch.setattr(bot, 'ADMIN_IDS', {42})
+    preso = threading.Event()
+
+    def report_in_corso():
+        # Un report tiene il lock dello storico mentre calcola
+        with storico.lock:
+            preso.set()
+            time.sleep(0.3)
+
+    battiti = []
+
+    async def metriche_con_battito(update, context):
+        async def battito():
+            while True:
+                battiti.append(None)
+                await asyncio.sleep(0.01)
+        compito = asyncio.create_task(battito())
+        await bot.mostra_metriche(update, context)
+        compito.cancel()
+
+    report = threading.Thread(target=report_in_corso)
+    report.start()
+    preso.wait()
+    _, risposte = invia(metriche_con_battito, "/metrics", utente=42)
+    report.join()
+    assert "Storico in memoria" in risposte[0]
+    # L'event loop ha continuato a girare mentre le metriche aspettavano il lock
+    assert len(battiti) >= 10
@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime
+
+from telegram import Update, Message, Chat
+from telegram.ext import Application
+
+import bot
+
+def crea_update(update_id, chat_id):
+    chat = Chat(id=chat_id, type='group')
+    return Update(update_id=update_id, message=Message(message_id=update_id, date=datetime.now(), chat=chat, text="/menu"))
+
+def esegui(monkeypatch, n_chat, per_chat, durata=0.05):
+    # Invia gli update delle chat alternati tra loro e registra (chat, update, inizio, fine) di ogni handler
+    eseguiti = []
+    attivi = [0, 0]  # in esecuzione ora, massimo
+
+    async def handler_finto(self, update):
+        attivi[0] += 1
+        attivi[1] = max(attivi[1], attivi[0])
+        inizio = asyncio.get_running_loop().time()
+        await asyncio.sleep(durata)
+        attivi[0] -= 1
+        eseguiti.append((update.effective_chat.id, update.update_id, inizio, asyncio.get_running_loop().time()))
+
+    monkeypatch.setattr(Application, 'process_update', handler_finto)
+
+    async def scenario():
+        app = Application.builder().token("123:finto").application_class(bot.ApplicationPerChat).build()
+        updates = [crea_update(i * n_chat + c, 100 + c) for i in range(per_chat) for c in range(n_chat)]
+        await asyncio.gather(*(app.process_update(u) for u in updates))
+        return app
+
+    app = asyncio.run(scenario())
+    assert app.lock_chat == {}
+    return eseguiti, attivi[1]
+
+def test_stessa_chat_in_ordine_chat_diverse_in_parallelo(monkeypatch):
+    eseguiti, massimo = esegui(monkeypatch, n_chat=3, per_chat=4)
+    assert len(eseguiti) == 12
+    for chat_id in (100, 101, 102):
+        della_chat = sorted((e for e in eseguiti if e[0] == chat_id), key=lambda e: e[2])
+        # Nell'ordine di arrivo e mai sovrapposti
+        assert [e[1] for e in della_chat] == sorted(e[1] for e in della_chat)
+        for prima, dopo in zip(della_chat, della_chat[1:]):
+            assert dopo[2] >= prima[3]
+    assert massimo == 3
+
+def test_limite_di_handler_attivi(monkeypatch):
+    monkeypatch.setattr(bot, 'CONCURRENT_UPDATES', 2)
+    _, massimo = esegui(monkeypatch, n_chat=5, per_chat=2)
+    assert massimo == 2
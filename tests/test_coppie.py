@@ -0,0 +1,24 @@
+import bot
+import benchmark
+
+from conftest import crea_chat
+
+def test_coppie_uguali_al_ciclo_annidato_originale(storage):
+    crea_chat(storage, benchmark.CHAT_ID, 150, seme=3)
+    storico = storage.storico(benchmark.CHAT_ID)
+    compagni, avversari = storico.coppie(0, len(storico))
+    vecchi_compagni, vecchi_avversari = benchmark.coppie_ciclo_annidato(benchmark.leggi_prestazioni(storage))
+    # Conteggi identici; l'ordine dei primi 3 a parità di partite no (ora è per nome)
+    assert {g: dict(c) for g, c in compagni.items()} == {g: c for g, c in vecchi_compagni.items() if c}
+    assert {g: dict(c) for g, c in avversari.items()} == {g: c for g, c in vecchi_avversari.items() if c}
+
+def test_coppie_di_un_periodo(storage):
+    crea_chat(storage, benchmark.CHAT_ID, 60, seme=4)
+    storico = storage.storico(benchmark.CHAT_ID)
+    m0, m1 = 20, 45
+    ids = set(storico.partita[m0:m1])
+    prestazioni = [p for p in benchmark.leggi_prestazioni(storage) if p[0] in ids]
+    compagni, avversari = storico.coppie(m0, m1)
+    vecchi_compagni, vecchi_avversari = benchmark.coppie_ciclo_annidato(prestazioni)
+    assert {g: dict(c) for g, c in compagni.items()} == {g: c for g, c in vecchi_compagni.items() if c}
+    assert {g: dict(c) for g, c in avversari.items()} == {g: c for g, c in vecchi_avversari.items() if c}
@@ -0,0 +1,31 @@
+import time
+import asyncio
+
+import bot
+
+def test_due_chat_lente_si_sovrappongono():
+    # Due query lente di chat diverse girano nel pool di thread, non una dopo l'altra
+    def query_lenta(chat_id):
+        time.sleep(0.5)
+        return chat_id
+
+    async def due_chat():
+        return await asyncio.gather(bot.esegui_db(query_lenta, 1), bot.esegui_db(query_lenta, 2))
+
+    inizio = time.perf_counter()
+    risultati = asyncio.run(due_chat())
+    durata = time.perf_counter() - inizio
+    assert risultati == [1, 2]
+    assert durata < 0.8
+
+def test_event_loop_libero_durante_la_query():
+    # Mentre una chat aspetta il database, l'event loop continua a servire le altre
+    async def scenario():
+        lenta = asyncio.ensure_future(bot.esegui_db(time.sleep, 0.5))
+        inizio = time.perf_counter()
+        await asyncio.sleep(0.05)
+        attesa = time.perf_counter() - inizio
+        await lenta
+        return attesa
+
+    assert asyncio.run(scenario()) < 0.3
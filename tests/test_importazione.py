@@ -0,0 +1,102 @@
+import io
+import json
+
+import pytest
+
+import bot
+from conftest import crea_chat
+
+def esporta(storage, chat_id, formato):
+    file = io.BytesIO()
+    bot.scrivi_esportazione(storage, chat_id, file, formato)
+    return file.getvalue().decode('utf-8')
+
+def importa(storage, chat_id, testo, formato):
+    return storage.importa(chat_id, bot.leggi_importazione(io.StringIO(testo, newline=''), formato))
+
+def tabelle(chat_id):
+    # Le righe dei giocatori seguono l'ordine di registrazione, che un CSV non conserva
+    return {nome: [righe[0]] + sorted(righe[1:]) for nome, righe in bot.prepara_statistiche(chat_id).items()}
+
+def elo(storage, chat_id):
+    return [(nome, rating, partite) for _, nome, rating, partite in storage.classifica_elo(chat_id)]
+
+def riga(**campi):
+    partita = {'tipo': 'partita', 'data': "01/03/2024", 'squadra_a': ["A1", "A2", "A3", "A4", "A5"],
+               'squadra_b': ["B1", "B2", "B3", "B4", "B5"], 'risultato': "2-1", 'gol': {"A1": 2, "B1": 1}, 'assist': {"A2": 1}}
+    return json.dumps({**partita, **campi}) + '\n'
+
+def giocatori(nomi):
+    return ''.join(json.dumps({'tipo': 'giocatore', 'nome': n}) + '\n' for n in nomi)
+
+INTESTAZIONE = json.dumps({'tipo': 'formato', 'versione': bot.VERSIONE_ESPORTAZIONE}) + '\n'
+SQUADRE = ["A1", "A2", "A3", "A4", "A5", "B1", "B2", "B3", "B4", "B5"]
+
+@pytest.mark.parametrize('formato', ['csv', 'jsonl'])
+def test_esportazione_e_reimportazione_danno_le_stesse_statistiche(storage, formato):
+    crea_chat(storage, 1, 60)
+    assert importa(storage, 2, esporta(storage, 1, formato), formato) == (60, 12, 0)
+    assert tabelle(2) == tabelle(1)
+    assert elo(storage, 2) == elo(storage, 1)
+    assert esporta(storage, 2, formato) == esporta(storage, 1, formato)
+
+def test_versione_del_formato_non_supportata(storage):
+    testo = json.dumps({'tipo': 'formato', 'versione': 99}) + '\n' + giocatori(SQUADRE) + riga()
+    with pytest.raises(ValueError, match="Riga 1: versione del formato non supportata: 99"):
+        importa(storage, 1, testo, 'jsonl')
+    assert storage.lista_giocatori(1) == []
+
+def test_giocatori_non_elencati_in_un_esportazione(storage):
+    testo = INTESTAZIONE + giocatori(SQUADRE[:-1]) + riga()
+    with pytest.raises(ValueError, match="Riga 11: giocatori non elencati nel file: B5"):
+        importa(storage, 1, testo, 'jsonl')
+    assert storage.lista_giocatori(1) == []
+
+def test_giocatori_mancanti_aggiunti_senza_intestazione(storage):
+    storage.aggiungi_giocatori(["A1"], 1)
+    assert importa(storage, 1, riga(), 'jsonl') == (1, 9, 0)
+    assert storage.lista_giocatori(1) == sorted(SQUADRE)
+
+@pytest.mark.parametrize('testo, errore', [
+    (riga() + '{"tipo": "partita", "data": ', "Riga 2: "),
+    (riga() + riga(data="31/02/2024"), "Riga 2: data non valida"),
+    (riga() + riga(squadra_a=["A1", "A2", "A3", "A4"]), "Riga 2: la Squadra A deve avere esattamente 5 giocatori diversi"),
+    (riga() + riga(squadra_b=["A1", "B2", "B3", "B4", "B5"]), "Riga 2: un giocatore non può essere in entrambe le squadre"),
+    (riga() + riga(gol={"A1": -1}), "Riga 2: gol negativi"),
+    (riga() + riga(assist={"Z9": 1}), "Riga 2: assistman non nelle formazioni: Z9"),
+    (riga() + riga(risultato="due a uno"), "Riga 2: "),
+    (riga() + json.dumps({'tipo': 'giocatore'}) + '\n', "Riga 2: campo mancante 'nome'"),
+    (riga() + json.dumps({'tipo': 'squadra'}) + '\n', "Riga 2: tipo sconosciuto: squadra"),
+])
+def test_righe_non_valide_annullano_tutta_l_importazione(storage, testo, errore):
+    with pytest.raises(ValueError, match=errore):
+        importa(storage, 1, testo, 'jsonl')
+    assert storage.lista_giocatori(1) == []
+    assert list(storage.esporta_partite(1)) == []
+
+def test_csv_senza_colonne_o_con_righe_non_valide(storage):
+    with pytest.raises(ValueError, match="Colonne mancanti nel CSV: assist"):
+        importa(storage, 1, "data,squadra_a,squadra_b,risultato,gol\n", 'csv')
+    testo = ("data,squadra_a,squadra_b,risultato,gol,assist\n"
+             '01/03/2024,"A1, A2, A3, A4, A5","B1, B2, B3, B4, B5",2-1,A1:2,\n'
+             '02/03/2024,"A1, A2, A3, A4, A5","B1, B2, B3, B4, B5",2-1,A1:due,\n')
+    with pytest.raises(ValueError, match="Riga 3: gol non validi"):
+        importa(storage, 1, testo, 'csv')
+    assert list(storage.esporta_partite(1)) == []
+
+def test_importazione_in_una_chat_con_partite(storage):
+    crea_chat(storage, 1, 40)
+    testo = esporta(storage, 1, 'jsonl')
+    prima = bot.prepara_statistiche(1)
+    # Reimportare lo stesso file non duplica nulla
+    assert importa(storage, 1, testo, 'jsonl') == (0, 0, 40)
+    assert bot.prepara_statistiche(1) == prima
+    # Un file con partite già presenti e partite nuove (anche precedenti a quelle della chat)
+    crea_chat(storage, 2, 40)
+    nuove = riga(data="15/12/2023", squadra_a=["G00", "G01", "G02", "G03", "G04"], squadra_b=["G05", "G06", "G07", "G08", "G09"],
+                 gol={"G00": 1}, assist={})
+    assert importa(storage, 2, testo + nuove, 'jsonl') == (1, 0, 40)
+    assert bot.prepara_statistiche(2) != prima
+    incrementale = elo(storage, 2)
+    storage.ricostruisci_rating(2)
+    assert elo(storage, 2) == incrementale
@@ -0,0 +1,55 @@
+from datetime import date
+
+import pytest
+
+import bot
+from conftest import invia
+
+NOMI = [f"P{i}" for i in range(12)]
+
+def nuova_partita(storage, chat_id=1, gol="P0:2, P5:1", assist="P1:1"):
+    storage.aggiungi_giocatori(NOMI, chat_id)
+    return storage.salva_partita({
+        'data': date(2024, 5, 1),
+        'squadra_a': NOMI[:5],
+        'squadra_b': NOMI[5:10],
+        'risultato': "2-1",
+        'gol': gol,
+        'assist': assist,
+    }, chat_id)
+
+def prestazioni(storage, partita_id):
+    with storage.transazione() as c:
+        c.execute('SELECT giocatore_id, squadra, gol, assist FROM prestazioni WHERE partita_id = %s ORDER BY giocatore_id', (partita_id,))
+        return c.fetchall()
+
+@pytest.mark.parametrize('valore', ["P10", "P0, P1, P2, P3, P10, P11", "P0, P0, P1, P2, P3"])
+def test_modifica_squadra_richiede_5_giocatori_diversi(storage, valore):
+    partita_id = nuova_partita(storage)
+    prima = prestazioni(storage, partita_id)
+    with pytest.raises(ValueError):
+        storage.modifica_partita(partita_id, 'squadra_a', valore, 1)
+    assert prestazioni(storage, partita_id) == prima
+
+@pytest.mark.parametrize('passo', [0, 1])
+def test_nuovapartita_rifiuta_giocatore_ripetuto(passo):
+    user_data = {'step': passo, 'giocatori_registrati': set(NOMI), 'squadra_a': NOMI[5:10]}
+    stato, risposte = invia(bot.squadre, "P0, P0, P1, P2, P3", user_data)
+    assert stato == bot.SQUADRE
+    assert risposte[0].startswith("❌")
+    assert user_data['step'] == passo
+
+def test_modifica_gol_negativi(storage):
+    partita_id = nuova_partita(storage)
+    with pytest.raises(ValueError):
+        storage.modifica_partita(partita_id, 'gol', "P0:-1", 1)
+
+def test_nuovapartita_rifiuta_gol_negativi(storage):
+    storage.aggiungi_giocatori(NOMI, 1)
+    user_data = {'squadra_a': NOMI[:5], 'squadra_b': NOMI[5:10], 'data': date(2024, 5, 1), 'risultato': "1-0", 'gol': "P0:-1"}
+    stato, risposte = invia(bot.assist, "P1:1", user_data)
+    assert stato == bot.ASSIST
+    assert risposte[0].startswith("❌")
+    with storage.transazione() as c:
+        c.execute('SELECT COUNT(*) FROM partite')
+        assert c.fetchone()[0] == 0
@@ -0,0 +1,22 @@
+from datetime import date
+
+import pytest
+
+import bot
+
+@pytest.mark.parametrize('testo', ["2024/25", "2024-25", "2024/2025", "2024-2025"])
+def test_stagione(testo):
+    assert bot.parse_periodo([testo]) == (date(2024, 9, 1), date(2025, 8, 31))
+
+def test_stagione_a_cavallo_del_secolo():
+    assert bot.parse_periodo(["1999/00"]) == (date(1999, 9, 1), date(2000, 8, 31))
+
+@pytest.mark.parametrize('testo', ["2024/xx", "2024/2030", "2024/24", "2024/2024", "2024/26"])
+def test_stagione_non_valida(testo):
+    with pytest.raises(ValueError):
+        bot.parse_periodo([testo])
+
+def test_anno_e_date():
+    assert bot.parse_periodo(["2024"]) == (date(2024, 1, 1), date(2024, 12, 31))
+    assert bot.parse_periodo(["01/09/2024", "31/12/2024"]) == (date(2024, 9, 1), date(2024, 12, 31))
+    assert bot.parse_periodo([]) is None
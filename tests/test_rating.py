@@ -0,0 +1,96 @@
+import random
+from datetime import date, timedelta
+
+import pytest
+
+import bot
+from conftest import invia
+
+NOMI = [f"R{i:02d}" for i in range(14)]
+
+def leggi_rating(storage, chat_id):
+    with storage.transazione() as c:
+        c.execute('SELECT giocatore_id, rating, partite FROM rating_giocatori WHERE chat_id = %s ORDER BY giocatore_id', (chat_id,))
+        rating = c.fetchall()
+        c.execute('SELECT partita_id, giocatore_id, prima, dopo FROM storico_rating WHERE chat_id = %s ORDER BY partita_id, giocatore_id', (chat_id,))
+        return rating, c.fetchall()
+
+def confronta_con_ricostruzione(storage, chat_id):
+    incrementale = leggi_rating(storage, chat_id)
+    storage.ricostruisci_rating(chat_id)
+    completo = leggi_rating(storage, chat_id)
+    for righe_i, righe_c in zip(incrementale, completo):
+        assert [r[:-2] for r in righe_i] == [r[:-2] for r in righe_c]
+        for r_i, r_c in zip(righe_i, righe_c):
+            assert r_i[-2:] == pytest.approx(r_c[-2:])
+
+def salva(storage, rnd, giorno, chat_id=1):
+    campo = rnd.sample(NOMI, 10)
+    return storage.salva_partita({
+        'data': date(2024, 1, 1) + timedelta(days=giorno),
+        'squadra_a': campo[:5],
+        'squadra_b': campo[5:],
+        'risultato': f"{rnd.randint(0, 5)}-{rnd.randint(0, 5)}",
+        'gol': f"{campo[0]}:1",
+        'assist': "",
+    }, chat_id)
+
+@pytest.mark.parametrize('seme', [1, 2, 3])
+def test_rating_incrementali_uguali_alla_ricostruzione(storage, seme):
+    rnd = random.Random(seme)
+    storage.aggiungi_giocatori(NOMI, 1)
+    partite = [salva(storage, rnd, g) for g in range(30)]
+    for passo in range(60):
+        operazione = rnd.random()
+        if operazione < 0.35:
+            # In fondo o retrodatata
+            partite.append(salva(storage, rnd, rnd.choice([40 + passo, rnd.randint(0, 39)])))
+        elif operazione < 0.55:
+            storage.modifica_partita(rnd.choice(partite), 'risultato', f"{rnd.randint(0, 5)}-{rnd.randint(0, 5)}", 1)
+        elif operazione < 0.7:
+            partita_id = rnd.choice(partite)
+            with storage.transazione() as c:
+                c.execute('SELECT squadra_b FROM partite WHERE id = %s', (partita_id,))
+                squadra_b = c.fetchone()[0].split(',')
+            squadra_a = rnd.sample([n for n in NOMI if n not in squadra_b], 5)
+            storage.modifica_partita(partita_id, 'squadra_a', ", ".join(squadra_a), 1)
+        elif operazione < 0.8:
+            storage.modifica_partita(rnd.choice(partite), 'gol', f"{rnd.choice(NOMI)}:2", 1)
+        else:
+            partita_id = partite.pop(rnd.randrange(len(partite)))
+            storage.elimina_partita(partita_id, 1)
+        if passo % 10 == 9:
+            confronta_con_ricostruzione(storage, 1)
+    confronta_con_ricostruzione(storage, 1)
+
+def test_giocatore_tolto_dalla_sua_unica_partita(storage):
+    rnd = random.Random(5)
+    storage.aggiungi_giocatori(NOMI + ["Nuovo"], 1)
+    for g in range(5):
+        salva(storage, rnd, g)
+    partita_id = storage.salva_partita({
+        'data': date(2024, 1, 3), 'squadra_a': ["Nuovo"] + NOMI[:4], 'squadra_b': NOMI[4:9],
+        'risultato': "3-1", 'gol': "", 'assist': "",
+    }, 1)
+    assert "Nuovo" in [r[1] for r in storage.classifica_elo(1)]
+    storage.modifica_partita(partita_id, 'squadra_a', ", ".join(NOMI[9:14]), 1)
+    assert "Nuovo" not in [r[1] for r in storage.classifica_elo(1)]
+    confronta_con_ricostruzione(storage, 1)
+    storage.modifica_partita(partita_id, 'squadra_a', ", ".join(["Nuovo"] + NOMI[:4]), 1)
+    storage.elimina_partita(partita_id, 1)
+    assert "Nuovo" not in [r[1] for r in storage.classifica_elo(1)]
+    confronta_con_ricostruzione(storage, 1)
+
+def test_classifica_elo_divisa_in_piu_messaggi(storage):
+    nomi = [f"Giocatore{i:03d}" for i in range(200)]
+    storage.aggiungi_giocatori(nomi, 1)
+    rnd = random.Random(6)
+    for g in range(120):
+        campo = rnd.sample(nomi, 10)
+        storage.salva_partita({'data': date(2024, 1, 1) + timedelta(days=g), 'squadra_a': campo[:5], 'squadra_b': campo[5:],
+                               'risultato': "1-0", 'gol': "", 'assist': ""}, 1)
+    _, risposte = invia(bot.classifica_elo, "/classifica_elo")
+    assert len(risposte) > 1
+    assert all(len(r) <= 4096 for r in risposte)
+    righe = "\n".join(risposte).split("\n")
+    assert len(righe) == 1 + len(storage.classifica_elo(1))
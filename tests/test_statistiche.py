@@ -0,0 +1,54 @@
+from datetime import date
+
+import bot
+from bot import Cursore
+
+from conftest import crea_chat
+
+def query_per_statistiche(chat_id):
+    # Query di un /statistiche a cache fredde
+    bot.storico_cache.invalida(chat_id)
+    bot.roster_cache.invalida(chat_id)
+    prima = Cursore.query_eseguite
+    report = bot.prepara_statistiche(chat_id)
+    return Cursore.query_eseguite - prima, report
+
+def test_query_costanti_al_crescere_delle_partite(storage):
+    crea_chat(storage, 1, 10)
+    crea_chat(storage, 2, 200, seme=1)
+    query_10, report_10 = query_per_statistiche(1)
+    query_200, report_200 = query_per_statistiche(2)
+    assert len(report_10['partite']) == 1 + 10  # intestazione + partite
+    assert len(report_200['partite']) == 1 + 200
+    assert query_200 <= query_10
+
+def test_report_di_un_periodo_a_cache_fredda(storage):
+    crea_chat(storage, 1, 120)
+    periodo = (date(2024, 2, 1), date(2024, 3, 31))
+    bot.storico_cache.invalida(1)
+    freddo = bot.prepara_statistiche(1, periodo)
+    assert bot.storico_cache.get(1, storage.versione_dati(1)) is None
+    assert len(storage.storico(1, periodo)) == 60
+    storage.storico(1)
+    caldo = bot.prepara_statistiche(1, periodo)
+    assert freddo == caldo
+
+def test_forma_usa_la_tabella_aggregata(storage, monkeypatch):
+    crea_chat(storage, 1, 40)
+    storico = storage.storico(1)
+    with storico.lock:
+        totali = storico.totali(0, len(storico))
+    nomi = {gid: nome for nome, gid in storage.roster(1).items()}
+    # /forma non deve riscorrere tutto lo storico per la media in carriera
+    monkeypatch.setattr(bot.StoricoChat, 'totali', None)
+    forme = bot.dati_forma(1)
+    assert {nome: media for nome, (_, media) in forme.items()} == {nomi[gid]: t[1] / t[0] for gid, t in totali.items()}
+
+def test_forma_in_una_tabella_a_parte(storage):
+    crea_chat(storage, 1, 30)
+    report = bot.prepara_statistiche(1)
+    assert len(report['statistiche'][0]) == 15
+    assert [r[0] for r in report['forma'][1:]] == [r[0] for r in report['statistiche'][1:]]
+    assert len(report['forma'][0]) == 2 + len(bot.FINESTRE_FORMA) + 1
+    pdf = bot.genera_pdf_multi(report['statistiche'], report['cannonieri'], report['assistman'], report['presenze'], report['elo'], report['forma'])
+    assert pdf.startswith(b'%PDF')